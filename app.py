@@ -1,208 +1,56 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, stream_with_context, g
 from werkzeug.security import generate_password_hash, check_password_hash
-import mysql.connector
+from itsdangerous import URLSafeSerializer, BadSignature
 from config import Config
+import db
+import metrics
+import lexicon
+from db import get_db_connection
+from catalog import get_catalog, invalidate_products
+from search import search_products
+from facets import facet_counts, parse_selection, sql_filters, matches as facet_matches
+from http_cache import conditional, bump_user_state
+from carts import (lock_cart_rows, lock_cart_line, upsert_cart_items, adjust_cart_summary,
+                   clear_cart_summary, read_cart_summary, reconcile_cart_summaries,
+                   get_guest_cart, save_guest_cart, add_to_guest_cart, set_guest_cart_quantity,
+                   quantity_error, guest_cart_items, guest_cart_totals, merge_guest_cart)
+from basket import (parse_basket_text, find_suggestions, best_combos, parse_cache, parse_cache_key,
+                    read_ndjson, bulk_map)
 import re
+import math
 from datetime import datetime
 import json
+from concurrent.futures import ThreadPoolExecutor
 
-import re
 from collections import defaultdict
-
-# --- Normalization helpers ---
-def normalize_text(s):
-    if not s:
-        return ""
-    s = s.lower()
-    # remove punctuation except spaces
-    s = re.sub(r'[^\w\s]', ' ', s)
-    s = re.sub(r'\s+', ' ', s).strip()
-    return s
-
-# synonyms for product types -> normalized type key
-TYPE_SYNONYMS = {
-    'jacket': ['jacket', 'leather jacket', 'denim jacket', 'blazer'],
-    'shirt': ['shirt', 'tshirt', 'tee', 'white shirt', 'formal shirt', 'casual shirt'],
-    'pant': ['pant','pants','jeans','trouser','trousers','chinos'],
-    'shoe': ['shoe','shoes','sneakers','formal shoes','canvas shoes','loafers','running shoes'],
-    'belt': ['belt'],
-    'accessory': ['wallet','watch','sunglasses','backpack','bag','belt'],
-    'electronics': ['earbuds','smart watch','speaker','laptop bag','usb','headphones'],
-}
-
-# invert synonyms for quick lookup (word -> canonical type)
-TYPE_MAP = {}
-for canon, words in TYPE_SYNONYMS.items():
-    for w in words:
-        TYPE_MAP[normalize_text(w)] = canon
-
-# colors mapping / fuzzy groups
-COLOR_MAP = {
-    'black': ['black', 'jet black', 'charcoal', 'ebony'],
-    'white': ['white', 'off white', 'ivory', 'cream'],
-    'blue': ['blue', 'navy', 'royal blue', 'azure', 'sky'],
-    'brown': ['brown','tan','camel'],
-    'grey': ['grey','gray','slate'],
-    'silver': ['silver','steel'],
-    'red': ['red','maroon','burgundy'],
-    'green': ['green','olive'],
-}
-
-# invert color map
-COLOR_KEY = {}
-for k,v in COLOR_MAP.items():
-    for w in v:
-        COLOR_KEY[normalize_text(w)] = k
-
-def canonical_type_from_phrase(phrase):
-    # try to match canonical type using substring matching
-    phrase = normalize_text(phrase)
-    # check multi-word synonyms first
-    for key in sorted(TYPE_MAP.keys(), key=lambda x: -len(x)):
-        if key in phrase:
-            return TYPE_MAP[key]
-    # fallback: check tokens
-    for token in phrase.split():
-        if token in TYPE_MAP:
-            return TYPE_MAP[token]
-    return None
-
-def canonical_color_from_phrase(phrase):
-    phrase = normalize_text(phrase)
-    for key in sorted(COLOR_KEY.keys(), key=lambda x: -len(x)):
-        if key in phrase:
-            return COLOR_KEY[key]
-    for token in phrase.split():
-        if token in COLOR_KEY:
-            return COLOR_KEY[token]
-    return None
-
-# match product record to a requested item (phrase)
-def score_product_against_request(product, req_type, req_color):
-    # product is dict-like with fields: id, name, category_name or category_id, color, stock
-    score = 0
-    name = normalize_text(product.get('name') or '')
-    color = normalize_text(product.get('color') or '')
-    category = normalize_text(product.get('category_name') or str(product.get('category_id') or ''))
-
-    # Type match: check product name or category for canonical type
-    prod_type = None
-    # try to infer product type from name using our TYPE_MAP
-    for key in TYPE_MAP:
-        if key in name:
-            prod_type = TYPE_MAP[key]
-            break
-    # also check category name
-    for key in TYPE_MAP:
-        if key in category:
-            prod_type = TYPE_MAP[key]
-            break
-
-    if prod_type == req_type:
-        score += 3
-    # allow partial matches: e.g. 'jeans' matched as pant
-    else:
-        # check if request type word appears in product name
-        if req_type and req_type in name:
-            score += 2
-
-    # Color match
-    if req_color:
-        if req_color == color:
-            score += 2
-        else:
-            # try fuzzy via COLOR_KEY mapping in name & color
-            prod_color_canon = COLOR_KEY.get(color)
-            if prod_color_canon == req_color:
-                score += 2
-            else:
-                # check name for color words
-                for cword, canon in COLOR_KEY.items():
-                    if cword in name and canon == req_color:
-                        score += 1
-
-    # prefer in-stock
-    try:
-        if int(product.get('stock', 0)) > 0:
-            score += 1
-    except:
-        pass
-
-    return score
-
-def find_best_products_for_requests(db_conn, requested_phrases, products_cache=None):
-    """
-    requested_phrases: list of strings like "1 white shirt", "1 black pant"
-    returns: list of matched product dicts (best per request)
-    """
-
-    # Parse each phrase into (req_type, req_color)
-    requests = []
-    for phrase in requested_phrases:
-        norm = normalize_text(phrase)
-        color = canonical_color_from_phrase(norm)
-        rtype = canonical_type_from_phrase(norm)
-        # if no explicit type but phrase contains 'shirt' in plural etc, try tokens
-        if not rtype:
-            for token in norm.split():
-                if token in TYPE_MAP:
-                    rtype = TYPE_MAP[token]
-                    break
-        requests.append({'phrase': phrase, 'type': rtype, 'color': color})
-
-    # Load products once (if not provided)
-    products = []
-    if products_cache:
-        products = products_cache
-    else:
-        cur = db_conn.cursor(dictionary=True)
-        cur.execute("SELECT p.id, p.name, p.description, p.price, p.category_id, c.name as category_name, p.image_url, p.stock, p.color FROM products p LEFT JOIN categories c ON p.category_id = c.id")
-        products = cur.fetchall()
-        cur.close()
-
-    # For each request, pick best-scoring product
-    results = []
-    used_product_ids = set()
-    for req in requests:
-        best = None
-        best_score = -999
-        for prod in products:
-            # skip product if already used for another requested item (optional)
-            # We may still allow reuse if you want variants; keep skipping to avoid duplicates
-            if prod['id'] in used_product_ids:
-                continue
-            s = score_product_against_request(prod, req.get('type'), req.get('color'))
-            if s > best_score:
-                best_score = s
-                best = prod
-        # Only accept if we at least matched the type (score threshold)
-        if best and best_score >= 3:
-            results.append({'request': req, 'product': best, 'score': best_score})
-            used_product_ids.add(best['id'])
-        else:
-            # fallback: if no strong match, try permissive match (type or color)
-            # choose highest score even if <3, but prefer type
-            permissive_best = None
-            permissive_score = -999
-            for prod in products:
-                if prod['id'] in used_product_ids:
-                    continue
-                s = score_product_against_request(prod, req.get('type'), req.get('color'))
-                if s > permissive_score:
-                    permissive_score = s
-                    permissive_best = prod
-            if permissive_best and permissive_score >= 1:
-                results.append({'request': req, 'product': permissive_best, 'score': permissive_score})
-                used_product_ids.add(permissive_best['id'])
-            else:
-                # no match found; append None so UI can show missing item
-                results.append({'request': req, 'product': None, 'score': 0})
-
-    return results
-
+from matching import find_best_products_for_requests
+import typeahead
+import reservations
+from reservations import (reserve_stock, reservation_deadline, extend_hold, order_quantities,
+                          take_order_stock, sweep_expired)
+from mysql.connector import errors as mysql_errors
+import webhooks
+from webhooks import (create_dispatcher, register_dispatcher, idempotency_key, in_process_delivery,
+                      record_outbox, clear_outbox, stale_outbox)
+from event_log import create_payment_event_writer, payment_event_row
+from retention import apply_retention
 
 app = Flask(__name__)
 app.config.from_object(Config)
+db.init_app(app)
+metrics.init_app(app)
+lexicon.init_app(app)
+reservations.init_app(app)
+parse_cache.max_entries = app.config['VIRTUAL_BASKET_CACHE_ENTRIES']
+parse_cache.max_bytes = app.config['VIRTUAL_BASKET_CACHE_BYTES']
+# Shared by all bulk parse requests; threads so workers share the in-memory indexes
+bulk_executor = ThreadPoolExecutor(max_workers=app.config['BULK_PARSE_WORKERS'],
+                                   thread_name_prefix='basket-bulk')
+# Gateway webhooks are delivered off the request thread, with retries
+webhook_dispatcher = register_dispatcher(create_dispatcher(app, '/mock-gateway/webhook'))
+webhooks.init_app(app, webhook_dispatcher)
+# payment_events audit rows are buffered and written in batches
+payment_events = create_payment_event_writer(app)
 
 # ---------------------------
 # Register wishlist blueprint
@@ -215,16 +63,6 @@ from wishlist import wishlist_bp
 app.register_blueprint(wishlist_bp)
 # ---------------------------
 
-# Database connection helper
-def get_db_connection():
-    connection = mysql.connector.connect(
-        host=app.config['MYSQL_HOST'],
-        user=app.config['MYSQL_USER'],
-        password=app.config['MYSQL_PASSWORD'],
-        database=app.config['MYSQL_DB']
-    )
-    return connection
-
 # Helper function to check if user is logged in
 def is_logged_in():
     return 'user_id' in session
@@ -248,26 +86,15 @@ def get_user_wishlist_ids(user_id):
 
 # ==================== HOME PAGE ====================
 @app.route('/')
+@conditional()
 def home():
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
+    catalog = get_catalog()
+
     # Get all categories
-    cursor.execute("SELECT * FROM categories")
-    categories = cursor.fetchall()
-    
+    categories = catalog.categories
+
     # Get featured products (latest 8 products)
-    cursor.execute("""
-        SELECT p.*, c.name as category_name 
-        FROM products p 
-        JOIN categories c ON p.category_id = c.id 
-        ORDER BY p.created_at DESC 
-        LIMIT 8
-    """)
-    featured_products = cursor.fetchall()
-    
-    cursor.close()
-    conn.close()
+    featured_products = catalog.newest(8)
 
     wishlist_ids = []
     if is_logged_in():
@@ -280,44 +107,158 @@ def home():
                          wishlist_ids=wishlist_ids)
 
 # ==================== PRODUCTS PAGE ====================
-@app.route('/products')
-def products():
+# Columns products.html actually renders
+LISTING_COLUMNS = """
+    p.id, p.name, p.description, p.price, p.image_url, p.stock, p.color,
+    p.category_id, p.created_at, c.name as category_name
+"""
+
+# Listing keys are (created_at, id), search keys (score, id): each kind is
+# signed with its own salt so one can never be replayed as the other
+PAGE_TOKEN_KINDS = {
+    'listing': (str, int),
+    'search': (float, int),
+}
+
+def _page_serializer(kind):
+    return URLSafeSerializer(app.config['SECRET_KEY'], salt=f'products-page-{kind}')
+
+def encode_page_token(key, kind):
+    return _page_serializer(kind).dumps(key)
+
+def decode_page_token(token, kind):
+    # Tampered, stale or mismatched tokens just restart from the first page
+    if not token:
+        return None
+    try:
+        key = _page_serializer(kind).loads(token)
+    except BadSignature:
+        return None
+    types = PAGE_TOKEN_KINDS[kind]
+    if (not isinstance(key, list) or len(key) != len(types) or
+            not all(isinstance(v, t) and not isinstance(v, bool) for v, t in zip(key, types))):
+        return None
+    return key
+
+def get_page_size():
+    size = request.args.get('per_page', type=int) or app.config['PRODUCTS_PAGE_SIZE']
+    return max(1, min(size, app.config['PRODUCTS_MAX_PAGE_SIZE']))
+
+def fetch_product_page(category_id, after, page_size, selected=None):
+    """Keyset page of the listing ordered by (created_at, id) DESC.
+
+    `after` is the (created_at, id) of the last row on the previous page.
+    Served by idx_products_created / idx_products_category_created.
+    """
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
-    
-    # Get filter parameters
-    category_id = request.args.get('category', type=int)
-    search_query = request.args.get('search', '')
-    
-    # Build query
-    query = """
-        SELECT p.*, c.name as category_name 
+
+    query = f"""
+        SELECT {LISTING_COLUMNS}
         FROM products p 
         JOIN categories c ON p.category_id = c.id 
         WHERE 1=1
     """
     params = []
-    
+
     if category_id:
         query += " AND p.category_id = %s"
         params.append(category_id)
+
+    facet_clauses, facet_params = sql_filters(selected or {})
+    for clause in facet_clauses:
+        query += " AND " + clause
+    params.extend(facet_params)
+
+    if after:
+        created_at, last_id = after
+        query += " AND (p.created_at < %s OR (p.created_at = %s AND p.id < %s))"
+        params.extend([created_at, created_at, last_id])
+
+    # one extra row tells us whether there is a next page
+    query += " ORDER BY p.created_at DESC, p.id DESC LIMIT %s"
+    params.append(page_size + 1)
+
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+
+    next_key = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        created_at = last['created_at']
+        if isinstance(created_at, datetime):
+            created_at = created_at.isoformat(sep=' ')
+        next_key = [created_at, last['id']]
+    return rows, next_key
+
+def search_product_page(ranked, category_id, after, page_size, selected=None):
+    # Ranked results are keyed on (score, id) DESC instead of recency
+    if category_id:
+        ranked = [(p, score) for p, score in ranked if p['category_id'] == category_id]
+    if selected:
+        ranked = [(p, score) for p, score in ranked if facet_matches(p, selected)]
+    if after:
+        last_score, last_id = after
+        ranked = [(p, score) for p, score in ranked
+                  if score < last_score or (score == last_score and p['id'] < last_id)]
+
+    next_key = None
+    if len(ranked) > page_size:
+        ranked = ranked[:page_size]
+        last, score = ranked[-1]
+        next_key = [float(score), last['id']]
+    return [p for p, _ in ranked], next_key
+
+@app.before_request
+def record_product_search():
+    # Runs ahead of @conditional, so a repeat search answered with a 304 is
+    # still counted; the view reuses the results instead of searching again
+    if request.endpoint != 'products':
+        return
+    search_query = request.args.get('search', '')
+    if not search_query or request.args.get('after'):
+        return
+    g.search_results = search_products(search_query)
+    if g.search_results:
+        typeahead.record_search(search_query, session.get('user_id') or request.remote_addr)
+
+@app.route('/products')
+@conditional()
+def products():
+    catalog = get_catalog()
     
-    if search_query:
-        query += " AND (p.name LIKE %s OR p.description LIKE %s)"
-        search_param = f"%{search_query}%"
-        params.extend([search_param, search_param])
+    # Get filter parameters
+    category_id = request.args.get('category', type=int)
+    search_query = request.args.get('search', '')
+    page_size = get_page_size()
+    page_kind = 'search' if search_query else 'listing'
+    after = decode_page_token(request.args.get('after'), page_kind)
     
-    query += " ORDER BY p.created_at DESC"
+    selected = parse_selection(request.args)
     
-    cursor.execute(query, params)
-    products_list = cursor.fetchall()
+    # Search results come back ranked by relevance; otherwise newest first
+    if search_query:
+        ranked = g.pop('search_results', None)
+        if ranked is None:
+            ranked = search_products(search_query)
+        products_list, next_key = search_product_page(ranked, category_id, after, page_size, selected)
+        facets = facet_counts(selected, category_id, [p['id'] for p, _ in ranked])
+    else:
+        products_list, next_key = fetch_product_page(category_id, after, page_size, selected)
+        facets = facet_counts(selected, category_id)
     
-    # Get all categories for filter
-    cursor.execute("SELECT * FROM categories")
-    categories = cursor.fetchall()
+    def page_url(after=None):
+        return url_for('products', category=category_id or None, search=search_query or None,
+                       per_page=request.args.get('per_page', type=int), after=after,
+                       **{f: sorted(v) for f, v in selected.items()})
+
+    next_url = page_url(encode_page_token(next_key, page_kind)) if next_key else None
     
-    cursor.close()
-    conn.close()
+    # Get all categories for filter
+    categories = catalog.categories
 
     wishlist_ids = []
     if is_logged_in():
@@ -328,41 +269,39 @@ def products():
                          categories=categories,
                          selected_category=category_id,
                          search_query=search_query,
+                         facets=facets,
+                         selected_facets=selected,
+                         next_url=next_url,
+                         first_url=page_url(),
+                         is_first_page=after is None,
                          is_logged_in=is_logged_in(),
                          wishlist_ids=wishlist_ids)
 
+@app.route('/api/typeahead')
+def typeahead_suggestions():
+    """Ranked completions for the search box and the basket textarea."""
+    query = request.args.get('q', '')[:100]
+    limit = max(1, min(request.args.get('limit', 8, type=int), typeahead.MAX_LIMIT))
+    get_catalog()  # rebuilds the index when the catalog changed
+    response = jsonify({'q': query, 'suggestions': typeahead.complete(query, limit)})
+    # Same answer for everyone, so let browsers and proxies reuse it
+    response.headers['Cache-Control'] = f"public, max-age={app.config['TYPEAHEAD_MAX_AGE']}"
+    return response
+
 # ==================== PRODUCT DETAIL PAGE ====================
 @app.route('/product/<int:product_id>')
+@conditional()
 def product_detail(product_id):
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
+    catalog = get_catalog()
     
     # Get product details
-    cursor.execute("""
-        SELECT p.*, c.name as category_name 
-        FROM products p 
-        JOIN categories c ON p.category_id = c.id 
-        WHERE p.id = %s
-    """, (product_id,))
-    product = cursor.fetchone()
+    product = catalog.get(product_id)
     
     if not product:
-        cursor.close()
-        conn.close()
         return "Product not found", 404
     
     # Get related products (same category)
-    cursor.execute("""
-        SELECT p.*, c.name as category_name 
-        FROM products p 
-        JOIN categories c ON p.category_id = c.id 
-        WHERE p.category_id = %s AND p.id != %s 
-        LIMIT 4
-    """, (product['category_id'], product_id))
-    related_products = cursor.fetchall()
-    
-    cursor.close()
-    conn.close()
+    related_products = catalog.related(product, limit=4)
 
     wishlist_ids = []
     if is_logged_in():
@@ -382,6 +321,32 @@ def virtual_basket():
         wishlist_ids = get_user_wishlist_ids(session.get('user_id'))
     return render_template('virtual_basket.html', is_logged_in=is_logged_in(), wishlist_ids=wishlist_ids)
 
+def basket_options(data):
+    """(combo_count, max_budget) from a parse request body; ValueError if malformed."""
+    try:
+        combo_count = int(data.get('combos') or app.config['VIRTUAL_BASKET_COMBOS'])
+        max_budget = float(data['max_budget']) if data.get('max_budget') not in (None, '') else None
+    except (TypeError, ValueError):
+        raise ValueError('Invalid combos or max_budget')
+    if max_budget is not None and not math.isfinite(max_budget):
+        # "inf"/"nan" parse as floats but cannot be turned into cents
+        raise ValueError('Invalid combos or max_budget')
+    return max(1, min(combo_count, app.config['VIRTUAL_BASKET_MAX_COMBOS'])), max_budget
+
+def basket_payload_json(text_input, combo_count, max_budget, fingerprint=None):
+    """Serialized parse payload, served from parse_cache when possible.
+
+    Same text against the same catalog gives the same payload. Pass the
+    catalog fingerprint to pin a batch to one snapshot.
+    """
+    cache_key = parse_cache_key(text_input, combo_count, max_budget, fingerprint=fingerprint)
+    body = parse_cache.get(cache_key)
+    if body is None:
+        payload = build_basket_payload(text_input, combo_count, max_budget, refresh=fingerprint is None)
+        body = app.json.dumps(payload).encode()
+        parse_cache.put(cache_key, body)
+    return body
+
 @app.route('/api/virtual-basket/parse', methods=['POST'])
 def parse_virtual_basket():
     data = request.get_json() or {}
@@ -390,350 +355,211 @@ def parse_virtual_basket():
     if not text_input:
         return jsonify({'error': 'No input provided'}), 400
     
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
+    try:
+        combo_count, max_budget = basket_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    # Define comprehensive patterns for ALL items in database
-    patterns = [
-        { 'key': 'laptop_bag', 'pattern': r'(\d+)?\s*(laptop|computer)\s+(bags?|backpacks?)',
-          'search_terms': ['Laptop', 'laptop'], 'priority': 1 },
-        { 'key': 'formal_shoes', 'pattern': r'(\d+)?\s*(?:pairs?\s+of\s+)?(\w+)?\s*(formal\s*shoes?|loafers?)',
-          'search_terms': ['Formal', 'formal', 'Loafer', 'loafer'], 'priority': 2 },
-        { 'key': 'usb_hub', 'pattern': r'(\d+)?\s*(usb|usb-c|type-c)?\s*(hub|adapter)',
-          'search_terms': ['USB', 'Hub', 'hub'], 'priority': 3 },
-        { 'key': 'bluetooth_speaker', 'pattern': r'(\d+)?\s*(bluetooth|wireless)\s+speakers?',
-          'search_terms': ['Bluetooth', 'Speaker', 'speaker'], 'priority': 4 },
-        { 'key': 'wireless_earbuds', 'pattern': r'(\d+)?\s*(wireless|bluetooth)\s+(earbuds?|headphones?)',
-          'search_terms': ['Wireless', 'Earbuds', 'earbuds', 'Bluetooth'], 'priority': 5 },
-        { 'key': 'smart_watch', 'pattern': r'(\d+)?\s*smart\s*watches?',
-          'search_terms': ['Smart', 'Watch', 'watch'], 'priority': 6 },
-        { 'key': 'leather_jacket', 'pattern': r'(\d+)?\s*leather\s+jackets?',
-          'search_terms': ['Leather', 'Jacket', 'jacket'], 'priority': 7 },
-        { 'key': 'denim_jacket', 'pattern': r'(\d+)?\s*denim\s+jackets?',
-          'search_terms': ['Denim', 'Jacket', 'jacket'], 'priority': 8 },
-        { 'key': 'leather_belt', 'pattern': r'(\d+)?\s*leather\s+belts?',
-          'search_terms': ['Leather', 'Belt', 'belt'], 'priority': 9 },
-        { 'key': 'shirt', 'pattern': r'(\d+)?\s*(white|black|blue|red|grey|gray|navy|light\s*blue|dark\s*blue|green|yellow|orange|purple|pink)?\s*(shirts?|tshirts?|t-shirts?)',
-          'search_terms': ['shirt', 'Shirt'], 'priority': 10 },
-        { 'key': 'pant', 'pattern': r'(\d+)?\s*(black|blue|grey|gray|brown|khaki|white|navy|dark\s*blue|light\s*blue|beige)?\s*(pants?|trousers?|jeans?|chinos?)',
-          'search_terms': ['pant', 'Pant', 'jean', 'Jean', 'trouser', 'Trouser', 'chino', 'Chino'], 'priority': 11 },
-        { 'key': 'sneaker', 'pattern': r'(\d+)?\s*(?:pairs?\s+of\s+)?(\w+)?\s*(sneakers?)',
-          'search_terms': ['sneaker', 'Sneaker', 'Canvas'], 'priority': 12 },
-        { 'key': 'shoes', 'pattern': r'(\d+)?\s*(?:pairs?\s+of\s+)?(\w+)?\s*(shoes?)',
-          'search_terms': ['shoe', 'Shoe'], 'priority': 13 },
-        { 'key': 'jacket', 'pattern': r'(\d+)?\s*(black|blue|grey|gray|brown|red|green)?\s*(jackets?|blazers?)',
-          'search_terms': ['jacket', 'Jacket', 'blazer', 'Blazer'], 'priority': 14 },
-        { 'key': 'belt', 'pattern': r'(\d+)?\s*(black|brown|white|grey|gray)?\s*belts?',
-          'search_terms': ['belt', 'Belt'], 'priority': 15 },
-        { 'key': 'bag', 'pattern': r'(\d+)?\s*(black|brown|blue|grey|gray|leather|canvas|white)?\s*(bags?|backpacks?|handbags?)',
-          'search_terms': ['bag', 'Bag', 'backpack', 'Backpack'], 'priority': 16 },
-        { 'key': 'watch', 'pattern': r'(\d+)?\s*(silver|gold|black|brown|leather|metal)?\s*(watch|watches)',
-          'search_terms': ['watch', 'Watch'], 'priority': 17 },
-        { 'key': 'sunglasses', 'pattern': r'(\d+)?\s*(black|brown|blue|aviator|wayfarer)?\s*(sunglasses?|shades?)',
-          'search_terms': ['sunglasses', 'Sunglasses'], 'priority': 18 },
-        { 'key': 'wallet', 'pattern': r'(\d+)?\s*(black|brown|leather|grey|gray)?\s*wallets?',
-          'search_terms': ['wallet', 'Wallet'], 'priority': 19 },
-        { 'key': 'earbuds', 'pattern': r'(\d+)?\s*(black|white)?\s*(earbuds?|headphones?)',
-          'search_terms': ['Earbuds', 'earbuds', 'headphone'], 'priority': 20 },
-        { 'key': 'speaker', 'pattern': r'(\d+)?\s*(portable|black|blue)?\s*speakers?',
-          'search_terms': ['Speaker', 'speaker'], 'priority': 21 }
-    ]
-    
-    # Sort patterns by priority (most specific first)
-    patterns.sort(key=lambda x: x['priority'])
-    
-    # Track matched positions to prevent overlaps
-    matched_items = []
-    matched_positions = []
-    
-    # Parse the input text for each pattern (in priority order)
-    for pattern_config in patterns:
-        pattern = pattern_config['pattern']
-        matches = re.finditer(pattern, text_input, re.IGNORECASE)
-        
-        for match in matches:
-            start_pos = match.start()
-            end_pos = match.end()
-            
-            # Check if this position overlaps with any already matched position
-            overlaps = False
-            for matched_start, matched_end in matched_positions:
-                if not (end_pos <= matched_start or start_pos >= matched_end):
-                    overlaps = True
-                    break
-            
-            if overlaps:
-                continue
-            
-            # Record this match position
-            matched_positions.append((start_pos, end_pos))
-            
-            # Extract quantity and color
-            quantity_str = None
-            color = None
+    body = basket_payload_json(text_input, combo_count, max_budget)
+    return app.response_class(body, mimetype='application/json')
+
+@app.route('/api/virtual-basket/bulk', methods=['POST'])
+def bulk_parse_virtual_basket():
+    """Parse many baskets in one call. NDJSON in, NDJSON out.
+
+    Each input line is {"id": ..., "text": "...", "combos": 3, "max_budget": 5000}
+    (only "text" is required) or just a JSON string. One line per basket is
+    streamed back as soon as it is done, so output order can differ from
+    input order: match them up by "id" (the line number if not given).
+    """
+    # One catalog snapshot for the whole batch
+    fingerprint = get_catalog().fingerprint
+    
+    def parse_line(job):
+        number, raw = job
+        basket_id = number
+        try:
+            if raw is None:
+                raise ValueError(f"Line longer than {app.config['BULK_PARSE_MAX_LINE']} bytes")
             try:
-                quantity_str = match.group(1)
-                color = match.group(2) if len(match.groups()) >= 2 else None
-            except IndexError:
-                quantity_str = None
-                color = None
-            
-            # Clean up color
-            if color:
-                color = color.strip().lower().replace(' ', '')
-                if color in ['gray', 'grey']:
-                    color = 'grey'
-                elif 'lightblue' in color or color == 'light':
-                    color = 'blue'
-                elif 'darkblue' in color or color == 'navy':
-                    color = 'navy'
-                elif color == 'beige':
-                    color = 'brown'
-                elif color in ['laptop', 'computer', 'formal', 'usb', 'bluetooth', 'wireless', 
-                              'smart', 'leather', 'denim', 'portable']:
-                    color = None
-            
-            quantity = int(quantity_str) if quantity_str and quantity_str.isdigit() else 1
-            
-            matched_items.append({
-                'type': pattern_config['key'],
-                'quantity': quantity,
-                'color': color,
-                'search_terms': pattern_config['search_terms'],
-                'priority': pattern_config['priority']
-            })
-    
-    # Additional cleanup: Remove exact duplicates by (type, color)
-    unique_items = []
-    seen = set()
-    for item in matched_items:
-        key = (item['type'], item.get('color'))
-        if key not in seen:
-            seen.add(key)
-            unique_items.append(item)
-    
-    parsed_items = unique_items
+                data = json.loads(raw)
+            except ValueError:
+                raise ValueError('Invalid JSON')
+            if isinstance(data, str):
+                data = {'text': data}
+            if not isinstance(data, dict):
+                raise ValueError('Expected an object or a string')
+            basket_id = data.get('id', number)
+            text_input = str(data.get('text') or '').lower()
+            if not text_input:
+                raise ValueError('No input provided')
+            combo_count, max_budget = basket_options(data)
+            body = basket_payload_json(text_input, combo_count, max_budget, fingerprint=fingerprint)
+        except ValueError as e:
+            return app.json.dumps({'id': basket_id, 'line': number, 'error': str(e)}).encode() + b'\n'
+        except Exception:
+            app.logger.exception("bulk basket parse failed on line %s", number)
+            return app.json.dumps({'id': basket_id, 'line': number, 'error': 'Internal error'}).encode() + b'\n'
+        head = app.json.dumps({'id': basket_id, 'line': number}).encode()
+        return head[:-1] + b', "result": ' + body + b'}\n'
+    
+    jobs = read_ndjson(request.stream, app.config['BULK_PARSE_MAX_LINE'])
+    window = app.config['BULK_PARSE_WORKERS'] * 4
+    results = bulk_map(parse_line, jobs, bulk_executor, window)
+    return app.response_class(stream_with_context(results), mimetype='application/x-ndjson')
+
+BASKET_PARSE_HINT = 'Could not understand your input. Try: "1 white shirt, 1 black pant, 1 pair of sneakers, 1 backpack"'
+
+def basket_combos(parsed_items, suggestions, combo_count, max_budget):
+    """(combos, combo_message) once every item's suggestions are known."""
+    # Top-k cheapest distinct combos (quantity-weighted), only if every item matched
+    if len(suggestions) != len(parsed_items):
+        return [], None
+    combos = best_combos(suggestions, k=combo_count, max_budget=max_budget)
+    combo_message = None
+    if not combos and max_budget is not None:
+        combo_message = f'No combination fits within ₹{max_budget:,.0f}. Try a higher budget.'
+    return combos, combo_message
+
+def build_basket_payload(text_input, combo_count, max_budget, refresh=True):
+    # Parse the input text (patterns are compiled once in basket.py)
+    parsed_items = parse_basket_text(text_input)
     
     if not parsed_items:
-        cursor.close()
-        conn.close()
-        return jsonify({
+        return {
             'parsed_items': [],
             'suggestions': [],
             'combos': [],
-            'message': 'Could not understand your input. Try: "1 white shirt, 1 black pant, 1 pair of sneakers, 1 backpack"'
-        })
+            'message': BASKET_PARSE_HINT
+        }
     
-    # Fetch matching products from database for each parsed item
-    suggestions = []
-    all_matched_products = []
+    # Matching products for every parsed item in one pass over the in-memory index
+    # (in stock, cheapest first, top 8 each)
+    suggestions = [{'item': item, 'products': products}
+                   for item, products in find_suggestions(parsed_items, refresh=refresh)
+                   if products]
+    combos, combo_message = basket_combos(parsed_items, suggestions, combo_count, max_budget)
     
-    for item in parsed_items:
-        # Build query to find matching products
-        query = "SELECT * FROM products WHERE ("
-        params = []
-        
-        # Build OR conditions for search terms
-        search_conditions = []
-        for term in item['search_terms']:
-            search_conditions.append("name LIKE %s")
-            params.append(f"%{term}%")
-        
-        query += " OR ".join(search_conditions)
-        query += ")"
-        
-        # Match by color if specified
-        if item['color']:
-            query += " AND LOWER(REPLACE(color, ' ', '')) = %s"
-            params.append(item['color'])
-        
-        # Only in-stock items
-        query += " AND stock > 0"
-        
-        # Order by price (ascending)
-        query += " ORDER BY price ASC LIMIT 8"
-        
-        cursor.execute(query, params)
-        products = cursor.fetchall()
-        
-        if products:
-            suggestions.append({
-                'item': item,
-                'products': products
-            })
-            all_matched_products.append({
-                'item': item,
-                'product': products[0]
-            })
-    
-    # Generate combo suggestions if we have matches for all items
-    combos = []
-    
-    if len(all_matched_products) == len(parsed_items) and len(parsed_items) > 0:
-        # Count how many items have multiple product options
-        items_with_multiple_options = sum(1 for s in suggestions if len(s['products']) > 1)
-        items_with_3plus_options = sum(1 for s in suggestions if len(s['products']) >= 3)
-        items_with_4plus_options = sum(1 for s in suggestions if len(s['products']) >= 4)
-        
-        # COMBO 1: Budget Combo (cheapest options) - ALWAYS CREATE
-        combo_items = []
-        total_price = 0
-        combo_description = "Perfect match! "
-        
-        for matched in all_matched_products:
-            product = matched['product']
-            item = matched['item']
-            combo_items.append(product)
-            total_price += float(product['price']) * item['quantity']
-            
-            color_name = product.get('color', '') or ""
-            combo_description += f"{color_name.title()} {product['name']}, "
-        
-        combo_description = combo_description.rstrip(', ') + " - Great combination!"
-        
-        combos.append({
-            'name': f'💰 Budget Combo ({len(combo_items)} items)',
-            'items': combo_items,
-            'total_price': total_price,
-            'description': combo_description,
-            'item_count': len(combo_items),
-            'badge': 'Best Value'
-        })
-        
-        # COMBO 2: Alternative Combo - Create if AT LEAST ONE item has 2+ options
-        if items_with_multiple_options >= 1:
-            alt_combo_items = []
-            alt_total_price = 0
-            
-            for suggestion in suggestions:
-                if len(suggestion['products']) > 1:
-                    product = suggestion['products'][1]
-                else:
-                    product = suggestion['products'][0]
-                
-                alt_combo_items.append(product)
-                alt_total_price += float(product['price']) * suggestion['item']['quantity']
-            
-            if alt_total_price != total_price:
-                combos.append({
-                    'name': f'⭐ Alternative Combo ({len(alt_combo_items)} items)',
-                    'items': alt_combo_items,
-                    'total_price': alt_total_price,
-                    'description': 'Another great option with different items where available',
-                    'item_count': len(alt_combo_items),
-                    'badge': 'Popular Choice'
-                })
-        
-        # COMBO 3: Premium Combo - Create if AT LEAST ONE item has 3+ options
-        if items_with_3plus_options >= 1:
-            premium_combo_items = []
-            premium_total_price = 0
-            
-            for suggestion in suggestions:
-                if len(suggestion['products']) >= 3:
-                    product = suggestion['products'][2]
-                elif len(suggestion['products']) >= 2:
-                    product = suggestion['products'][1]
-                else:
-                    product = suggestion['products'][0]
-                
-                premium_combo_items.append(product)
-                premium_total_price += float(product['price']) * suggestion['item']['quantity']
-            
-            existing_prices = [c['total_price'] for c in combos]
-            if premium_total_price not in existing_prices:
-                combos.append({
-                    'name': f'👑 Premium Combo ({len(premium_combo_items)} items)',
-                    'items': premium_combo_items,
-                    'total_price': premium_total_price,
-                    'description': 'Higher-end options for a premium look',
-                    'item_count': len(premium_combo_items),
-                    'badge': 'Premium'
-                })
-        
-        # COMBO 4: Variety Combo - Create if AT LEAST ONE item has 4+ options
-        if items_with_4plus_options >= 1:
-            variety_combo_items = []
-            variety_total_price = 0
-            
-            for i, suggestion in enumerate(suggestions):
-                num_products = len(suggestion['products'])
-                if num_products >= 4:
-                    idx = (i % 4)
-                    product = suggestion['products'][idx]
-                elif num_products >= 3:
-                    idx = (i % 3)
-                    product = suggestion['products'][idx]
-                elif num_products >= 2:
-                    idx = (i % 2)
-                    product = suggestion['products'][idx]
-                else:
-                    product = suggestion['products'][0]
-                
-                variety_combo_items.append(product)
-                variety_total_price += float(product['price']) * suggestion['item']['quantity']
-            
-            existing_prices = [c['total_price'] for c in combos]
-            if variety_total_price not in existing_prices:
-                combos.append({
-                    'name': f'🎨 Variety Combo ({len(variety_combo_items)} items)',
-                    'items': variety_combo_items,
-                    'total_price': variety_total_price,
-                    'description': 'Balanced mix rotating through available options',
-                    'item_count': len(variety_combo_items),
-                    'badge': 'Balanced'
-                })
-        
-        # COMBO 5: Mid-Range Combo - Create if we have 2+ combos and items with options
-        if len(combos) >= 2 and items_with_multiple_options >= 1:
-            mid_combo_items = []
-            mid_total_price = 0
-            
-            for suggestion in suggestions:
-                num_products = len(suggestion['products'])
-                if num_products >= 5:
-                    product = suggestion['products'][2]
-                elif num_products >= 3:
-                    product = suggestion['products'][1]
-                elif num_products >= 2:
-                    product = suggestion['products'][1]
-                else:
-                    product = suggestion['products'][0]
-                
-                mid_combo_items.append(product)
-                mid_total_price += float(product['price']) * suggestion['item']['quantity']
-            
-            existing_prices = [c['total_price'] for c in combos]
-            if mid_total_price not in existing_prices:
-                combos.append({
-                    'name': f'💎 Mid-Range Combo ({len(mid_combo_items)} items)',
-                    'items': mid_combo_items,
-                    'total_price': mid_total_price,
-                    'description': 'Balanced combination of mid-priced options',
-                    'item_count': len(mid_combo_items),
-                    'badge': 'Balanced'
-                })
-    
-    # Sort combos by price (ascending)
-    combos.sort(key=lambda x: x['total_price'])
-    
-    cursor.close()
-    conn.close()
-    
-    return jsonify({
+    return {
         'parsed_items': parsed_items,
         'suggestions': suggestions,
         'combos': combos,
+        'combo_message': combo_message,
         'total_items_requested': len(parsed_items),
-        'total_items_found': len(all_matched_products)
+        'total_items_found': len(suggestions)
+    }
+
+@app.route('/api/virtual-basket/stream', methods=['POST'])
+def stream_virtual_basket():
+    """Same result as /api/virtual-basket/parse, sent as server-sent events as it is built.
+
+    Events: "parsed" (parsed_items), one "suggestion" per matched item
+    ({index, item, products}), "combos", then "done".
+    """
+    data = request.get_json() or {}
+    text_input = (data.get('text') or '').lower()
+    
+    if not text_input:
+        return jsonify({'error': 'No input provided'}), 400
+    
+    try:
+        combo_count, max_budget = basket_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    def event(name, payload):
+        return f"event: {name}\ndata: {app.json.dumps(payload)}\n\n"
+    
+    def replay(payload):
+        # A cached /parse payload, sent as the same events a fresh build would send
+        parsed_items = payload['parsed_items']
+        yield event('parsed', {'parsed_items': parsed_items, 'message': payload.get('message')})
+        if parsed_items:
+            suggestions = iter(payload['suggestions'])
+            suggestion = next(suggestions, None)
+            for index, item in enumerate(parsed_items):
+                if suggestion is not None and suggestion['item'] == item:
+                    yield event('suggestion', {'index': index, **suggestion})
+                    suggestion = next(suggestions, None)
+            yield event('combos', {k: payload[k] for k in ('combos', 'combo_message',
+                                                           'total_items_requested', 'total_items_found')})
+        yield event('done', {})
+    
+    def generate():
+        # Key first: it pins the catalog snapshot the whole basket is built from
+        cache_key = parse_cache_key(text_input, combo_count, max_budget)
+        body = parse_cache.get(cache_key)
+        if body is not None:
+            yield from replay(json.loads(body))
+            return
+        
+        parsed_items = parse_basket_text(text_input)
+        yield event('parsed', {'parsed_items': parsed_items,
+                               'message': None if parsed_items else BASKET_PARSE_HINT})
+        if not parsed_items:
+            yield event('done', {})
+            parse_cache.put(cache_key, app.json.dumps({'parsed_items': [], 'suggestions': [], 'combos': [],
+                                                       'message': BASKET_PARSE_HINT}).encode())
+            return
+        
+        suggestions = []
+        for index, item in enumerate(parsed_items):
+            (_, products), = find_suggestions([item], refresh=False)
+            if products:
+                suggestions.append({'item': item, 'products': products})
+                yield event('suggestion', {'index': index, 'item': item, 'products': products})
+        
+        combos, combo_message = basket_combos(parsed_items, suggestions, combo_count, max_budget)
+        yield event('combos', {'combos': combos,
+                               'combo_message': combo_message,
+                               'total_items_requested': len(parsed_items),
+                               'total_items_found': len(suggestions)})
+        yield event('done', {})
+        # Only a basket that was streamed to the end is cached, in the /parse payload shape
+        parse_cache.put(cache_key, app.json.dumps({
+            'parsed_items': parsed_items,
+            'suggestions': suggestions,
+            'combos': combos,
+            'combo_message': combo_message,
+            'total_items_requested': len(parsed_items),
+            'total_items_found': len(suggestions)
+        }).encode())
+    
+    response = app.response_class(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # don't let nginx hold events back
+    return response
+
+@app.route('/api/match-products', methods=['POST'])
+def match_products():
+    """Best product for each requested phrase, without reusing a product.
+
+    Body: {"items": ["1 white shirt", "1 black pant", ...]}
+    """
+    data = request.get_json() or {}
+    phrases = data.get('items')
+    if not isinstance(phrases, list) or not phrases:
+        return jsonify({'error': 'items must be a non-empty list of phrases'}), 400
+    if len(phrases) > app.config['MATCH_MAX_ITEMS']:
+        return jsonify({'error': f"At most {app.config['MATCH_MAX_ITEMS']} items per request"}), 400
+    phrases = [str(p) for p in phrases]
+    
+    results = find_best_products_for_requests(None, phrases)
+    return jsonify({
+        'results': results,
+        'total_items_requested': len(results),
+        'total_items_found': sum(1 for r in results if r['product'])
     })
 
 # ==================== CART PAGE ====================
 @app.route('/cart')
 def cart():
     if not is_logged_in():
-        flash('Please login to view your cart', 'warning')
-        return redirect(url_for('auth'))
+        cart_items = guest_cart_items()
+        return render_template('cart.html',
+                             cart_items=cart_items,
+                             total=sum(item['subtotal'] for item in cart_items),
+                             is_logged_in=False)
     
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
@@ -760,10 +586,6 @@ def cart():
 @app.route('/api/cart/add', methods=['POST'])
 @app.route('/api/cart/add', methods=['POST'])
 def add_to_cart():
-    # 1. Check Login
-    if not session.get('user_id'):  # Changed to check session directly for safety
-        return jsonify({'error': 'Please login first', 'redirect': url_for('login')}), 401
-    
     data = request.get_json() or {}
     product_id = data.get('product_id')
     quantity = int(data.get('quantity', 1))
@@ -771,53 +593,51 @@ def add_to_cart():
     if not product_id:
         return jsonify({'error': 'Product ID required'}), 400
     
+    # 1. Guests keep their cart in the session cookie
+    if not session.get('user_id'):
+        errors = add_to_guest_cart({int(product_id): quantity})
+        if errors:
+            status = 404 if errors[0]['error'] == 'Product not found' else 400
+            return jsonify({'error': errors[0]['error']}), status
+        return jsonify({
+            'success': True,
+            'message': 'Added to cart',
+            'cart_count': guest_cart_totals()[0]
+        })
+    
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
     
     try:
-        # 2. Get Product Details
-        cursor.execute("SELECT * FROM products WHERE id = %s", (product_id,))
-        product = cursor.fetchone()
+        # 2. Product details and what is ALREADY in the cart; the cart row
+        #    stays locked until commit
+        user_id = session['user_id']
+        product = lock_cart_rows(cursor, user_id, [int(product_id)]).get(int(product_id))
         
         if not product:
+            conn.rollback()
             return jsonify({'error': 'Product not found'}), 404
 
-        # 3. Check what is ALREADY in the cart for this user
-        cursor.execute("""
-            SELECT * FROM cart 
-            WHERE user_id = %s AND product_id = %s
-        """, (session['user_id'], product_id))
-        existing_item = cursor.fetchone()
-
         # Calculate total requested quantity (Existing + New)
-        current_cart_qty = existing_item['quantity'] if existing_item else 0
+        current_cart_qty = product['in_cart']
         total_quantity = current_cart_qty + quantity
 
-        # 4. Validate Stock (Total vs Stock)
+        # 3. Validate Stock (Total vs Stock)
         if total_quantity > product['stock']:
+            conn.rollback()
             return jsonify({
                 'error': f'Insufficient stock. You already have {current_cart_qty} in cart. Only {product["stock"]} available.'
             }), 400
         
-        # 5. Update or Insert
-        if existing_item:
-            cursor.execute("""
-                UPDATE cart 
-                SET quantity = %s 
-                WHERE user_id = %s AND product_id = %s
-            """, (total_quantity, session['user_id'], product_id))
-        else:
-            cursor.execute("""
-                INSERT INTO cart (user_id, product_id, quantity) 
-                VALUES (%s, %s, %s)
-            """, (session['user_id'], product_id, quantity))
+        # 4. Add the quantity to the row, so the cart and its summary move by the same delta
+        upsert_cart_items(cursor, user_id, {int(product_id): quantity})
+        adjust_cart_summary(cursor, user_id, quantity, quantity * product['price'])
         
         conn.commit()
+        bump_user_state()
         
-        # 6. Get updated total cart count for the navbar badge
-        cursor.execute("SELECT SUM(quantity) as count FROM cart WHERE user_id = %s", (session['user_id'],))
-        result = cursor.fetchone()
-        cart_count = result['count'] if result and result['count'] else 0
+        # 5. Get updated total cart count for the navbar badge
+        cart_count, _ = read_cart_summary(cursor, user_id)
         
         return jsonify({
             'success': True, 
@@ -826,6 +646,7 @@ def add_to_cart():
         })
 
     except Exception as e:
+        conn.rollback()
         print(f"Error: {e}")
         return jsonify({'error': 'An error occurred'}), 500
         
@@ -833,12 +654,109 @@ def add_to_cart():
         cursor.close()
         conn.close()
 
+@app.route('/api/cart/add-bulk', methods=['POST'])
+def add_to_cart_bulk():
+    """Add several products in one transaction.
+
+    Body: {"items": [{"product_id": 1, "quantity": 2}, ...]}. Stock is checked
+    for every item first; if any item fails nothing is added.
+    """
+    data = request.get_json() or {}
+    raw_items = data.get('items')
+    if not isinstance(raw_items, list) or not raw_items:
+        return jsonify({'error': 'items must be a non-empty list'}), 400
+    if len(raw_items) > app.config['CART_BULK_MAX_ITEMS']:
+        return jsonify({'error': f"At most {app.config['CART_BULK_MAX_ITEMS']} items per request"}), 400
+    
+    # The same product twice in one request counts once, with the quantities summed
+    wanted = {}
+    try:
+        for item in raw_items:
+            product_id = int(item['product_id'])
+            quantity = int(item.get('quantity', 1))
+            if quantity < 1:
+                raise ValueError
+            wanted[product_id] = wanted.get(product_id, 0) + quantity
+    except (TypeError, KeyError, ValueError):
+        return jsonify({'error': 'Each item needs a product_id and a positive quantity'}), 400
+    
+    if not is_logged_in():
+        errors = add_to_guest_cart(wanted)
+        if errors:
+            return jsonify({'error': errors[0]['error'], 'errors': errors}), 400
+        count, subtotal = guest_cart_totals()
+        return jsonify({
+            'success': True,
+            'message': f'Added {sum(wanted.values())} items to cart',
+            'added': len(wanted),
+            'cart_count': count,
+            'cart_subtotal': subtotal
+        })
+    
+    user_id = session['user_id']
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    
+    try:
+        # 1. Stock and what's already in the cart, for every product at once;
+        #    the user's cart rows stay locked until commit
+        rows = lock_cart_rows(cursor, user_id, list(wanted))
+        
+        errors = []
+        for product_id, quantity in wanted.items():
+            row = rows.get(product_id)
+            if not row:
+                errors.append({'product_id': product_id, 'error': 'Product not found'})
+            elif row['in_cart'] + quantity > row['stock']:
+                errors.append({'product_id': product_id,
+                               'error': f"Insufficient stock for {row['name']}. You already have "
+                                        f"{row['in_cart']} in cart. Only {row['stock']} available."})
+        if errors:
+            conn.rollback()
+            return jsonify({'error': errors[0]['error'], 'errors': errors}), 400
+        
+        # 2. One upsert for all items, and the summary in the same transaction
+        upsert_cart_items(cursor, user_id, wanted)
+        adjust_cart_summary(cursor, user_id, sum(wanted.values()),
+                            sum(q * rows[pid]['price'] for pid, q in wanted.items()))
+        conn.commit()
+        bump_user_state()
+        
+        # 3. New badge count and subtotal
+        count, subtotal = read_cart_summary(cursor, user_id)
+        
+        return jsonify({
+            'success': True,
+            'message': f'Added {sum(wanted.values())} items to cart',
+            'added': len(wanted),
+            'cart_count': count,
+            'cart_subtotal': subtotal
+        })
+    
+    except Exception as e:
+        conn.rollback()
+        print(f"Error: {e}")
+        return jsonify({'error': 'An error occurred'}), 500
+    
+    finally:
+        cursor.close()
+        conn.close()
+
+def guest_cart_response():
+    count, subtotal = guest_cart_totals()
+    return jsonify({
+        'success': True,
+        'totals': {
+            'subtotal': subtotal,
+            'shipping': 0,
+            'total': subtotal
+        },
+        'cart_count': count
+    })
+
 @app.route('/api/cart/update', methods=['POST'])
 @app.route('/api/cart/update', methods=['POST'])
 def update_cart():
-    if not is_logged_in():
-        return jsonify({'error': 'Please login first'}), 401
-
     data = request.get_json() or {}
     product_id = data.get('product_id')
     quantity = int(data.get('quantity', 1))
@@ -846,31 +764,39 @@ def update_cart():
     if not product_id or quantity < 1:
         return jsonify({'error': 'Invalid data'}), 400
 
+    if not is_logged_in():
+        error = set_guest_cart_quantity(int(product_id), quantity)
+        if error:
+            return jsonify({'error': error}), 400
+        return guest_cart_response()
+
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
 
-    # Update quantity
-    cursor.execute("""
-        UPDATE cart 
-        SET quantity = %s 
-        WHERE user_id = %s AND product_id = %s
-    """, (quantity, session['user_id'], product_id))
+    # Update quantity after the same stock check as a guest cart, moving the
+    # summary by the difference
+    product = lock_cart_rows(cursor, session['user_id'], [int(product_id)]).get(int(product_id))
+    if product and product['in_cart']:
+        error = quantity_error(product, quantity)
+        if error:
+            conn.rollback()
+            cursor.close()
+            conn.close()
+            return jsonify({'error': error}), 400
+        cursor.execute("""
+            UPDATE cart 
+            SET quantity = %s 
+            WHERE user_id = %s AND product_id = %s
+        """, (quantity, session['user_id'], product_id))
+        delta = quantity - product['in_cart']
+        adjust_cart_summary(cursor, session['user_id'], delta, delta * product['price'])
     conn.commit()
+    bump_user_state()
 
-    # Recalculate totals
-    cursor.execute("""
-        SELECT SUM(c.quantity * p.price) AS subtotal,
-               SUM(c.quantity) AS count
-        FROM cart c
-        JOIN products p ON c.product_id = p.id
-        WHERE c.user_id = %s
-    """, (session['user_id'],))
-    totals = cursor.fetchone() or {}
-
-    subtotal = float(totals.get('subtotal') or 0)
+    # Totals come from the summary row
+    count, subtotal = read_cart_summary(cursor, session['user_id'])
     shipping = 0
     total = subtotal + shipping
-    count = totals.get('count') or 0
 
     cursor.close()
     conn.close()
@@ -888,39 +814,37 @@ def update_cart():
 @app.route('/api/cart/remove', methods=['POST'])
 @app.route('/api/cart/remove', methods=['POST'])
 def remove_from_cart():
-    if not is_logged_in():
-        return jsonify({'error': 'Please login first'}), 401
-
     data = request.get_json() or {}
     product_id = data.get('product_id')
 
     if not product_id:
         return jsonify({'error': 'Product ID required'}), 400
 
+    if not is_logged_in():
+        guest_cart = get_guest_cart()
+        guest_cart.pop(int(product_id), None)
+        save_guest_cart(guest_cart)
+        return guest_cart_response()
+
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
 
     # Remove item
+    line = lock_cart_line(cursor, session['user_id'], product_id)
     cursor.execute("""
         DELETE FROM cart 
         WHERE user_id = %s AND product_id = %s
     """, (session['user_id'], product_id))
+    if line:
+        old_quantity, price = line
+        adjust_cart_summary(cursor, session['user_id'], -old_quantity, -old_quantity * price)
     conn.commit()
+    bump_user_state()
 
-    # Recalculate totals
-    cursor.execute("""
-        SELECT SUM(c.quantity * p.price) AS subtotal,
-               SUM(c.quantity) AS count
-        FROM cart c
-        JOIN products p ON c.product_id = p.id
-        WHERE c.user_id = %s
-    """, (session['user_id'],))
-    totals = cursor.fetchone() or {}
-
-    subtotal = float(totals.get('subtotal') or 0)
+    # Totals come from the summary row
+    count, subtotal = read_cart_summary(cursor, session['user_id'])
     shipping = 0
     total = subtotal + shipping
-    count = totals.get('count') or 0
 
     cursor.close()
     conn.close()
@@ -937,22 +861,57 @@ def remove_from_cart():
 
 
 @app.route('/api/cart/count')
+@conditional(catalog=False)
 def cart_count():
     if not is_logged_in():
-        return jsonify({'count': 0})
+        return jsonify({'count': guest_cart_totals()[0]})
     
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
     
-    cursor.execute("SELECT SUM(quantity) as count FROM cart WHERE user_id = %s", (session['user_id'],))
-    result = cursor.fetchone()
-    count = result['count'] if result and result['count'] else 0
+    count, _ = read_cart_summary(cursor, session['user_id'])
     
     cursor.close()
     conn.close()
     
     return jsonify({'count': count})
 
+@app.route('/api/nav-state')
+@conditional(catalog=False)
+def nav_state():
+    """Cart count/subtotal and wishlist count/ids for the navbar and hearts, in one round trip."""
+    if not is_logged_in():
+        count, subtotal = guest_cart_totals()
+        return jsonify({'cart_count': count, 'cart_subtotal': subtotal, 'wishlist_count': 0, 'wishlist_ids': []})
+    
+    user_id = session['user_id']
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    
+    # The cart summary row (if any) plus one row per wishlist product id
+    cursor.execute("""
+        SELECT 'cart' AS kind, NULL AS product_id, item_count AS count, subtotal
+        FROM cart_summary
+        WHERE user_id = %s
+        UNION ALL
+        SELECT 'wishlist', product_id, NULL, NULL
+        FROM wishlists
+        WHERE user_id = %s
+    """, (user_id, user_id))
+    rows = cursor.fetchall()
+    
+    cursor.close()
+    conn.close()
+    
+    cart = next((row for row in rows if row['kind'] == 'cart'), {'count': 0, 'subtotal': 0})
+    wishlist_ids = [row['product_id'] for row in rows if row['kind'] == 'wishlist']
+    return jsonify({
+        'cart_count': int(cart['count']),
+        'cart_subtotal': float(cart['subtotal']),
+        'wishlist_count': len(wishlist_ids),
+        'wishlist_ids': wishlist_ids
+    })
+
 # ==================== WISHLIST STATUS API (ADDED) ====================
 @app.route('/api/wishlist/status/<int:product_id>')
 def wishlist_status(product_id):
@@ -1013,12 +972,19 @@ def register():
     
     conn.commit()
     user_id = cursor.lastrowid
-    
     cursor.close()
-    conn.close()
+    
+    try:
+        merge_guest_cart(conn, user_id)
+    except Exception as e:
+        # Logging in matters more; the guest cart stays in the cookie
+        print(f"Error merging guest cart: {e}")
+    finally:
+        conn.close()
     
     session['user_id'] = user_id
     session['username'] = username
+    bump_user_state()
     
     return jsonify({'success': True, 'message': 'Registration successful'})
 
@@ -1038,13 +1004,23 @@ def login():
     user = cursor.fetchone()
     
     cursor.close()
-    conn.close()
     
     if not user or not check_password_hash(user['password'], password):
+        conn.close()
         return jsonify({'error': 'Invalid credentials'}), 401
     
+    # The guest cart joins the account's cart in one upsert
+    try:
+        merge_guest_cart(conn, user['id'])
+    except Exception as e:
+        # Logging in matters more; the guest cart stays in the cookie
+        print(f"Error merging guest cart: {e}")
+    finally:
+        conn.close()
+    
     session['user_id'] = user['id']
     session['username'] = user['username']
+    bump_user_state()
     
     return jsonify({'success': True, 'message': 'Login successful'})
 
@@ -1055,6 +1031,9 @@ def logout():
     return redirect(url_for('home'))
 
 # ==================== CHECKOUT & PAYMENTS (MOCK GATEWAY) ====================
+# payments.status values a gateway event may still move; the rest are settled
+OPEN_PAYMENT_STATUSES = ('created', 'processing', 'pending')
+
 def _fetch_cart_items(user_id, cursor):
     cursor.execute("""
         SELECT c.product_id, c.quantity, p.name, p.price, p.stock, p.image_url
@@ -1105,51 +1084,56 @@ def create_order():
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
 
-    cart_items = _fetch_cart_items(session['user_id'], cursor)
-    if not cart_items:
-        cursor.close()
-        conn.close()
-        flash('Your cart is empty', 'warning')
-        return redirect(url_for('cart'))
+    try:
+        # Short lock waits: under a rush, fail fast instead of piling up on hot rows
+        cursor.execute("SET SESSION innodb_lock_wait_timeout = %s",
+                       (app.config['CHECKOUT_LOCK_WAIT_TIMEOUT'],))
 
-    # Validate stock
-    for it in cart_items:
-        if it['stock'] < it['quantity']:
-            cursor.close()
-            conn.close()
-            flash(f"Insufficient stock for {it['name']}", 'error')
+        cart_items = _fetch_cart_items(session['user_id'], cursor)
+        if not cart_items:
+            flash('Your cart is empty', 'warning')
             return redirect(url_for('cart'))
 
-    total = _compute_cart_total(cart_items)
+        # Take the stock now, in one conditional UPDATE; any shortfall undoes it all
+        quantities = {it['product_id']: int(it['quantity']) for it in cart_items}
+        if not reserve_stock(cursor, quantities):
+            conn.rollback()
+            short = next((it for it in cart_items if it['stock'] < it['quantity']), None)
+            flash(f"Insufficient stock for {short['name']}" if short else
+                  'Some items just sold out. Please review your cart.', 'error')
+            return redirect(url_for('cart'))
 
-    # Create order
-    cursor.execute("""
-        INSERT INTO orders (user_id, total_amount, status, created_at, payment_status)
-        VALUES (%s, %s, %s, %s, %s)
-    """, (session['user_id'], total, 'created', datetime.now(), 'unpaid'))
-    order_id = cursor.lastrowid
+        total = _compute_cart_total(cart_items)
 
-    # Create order_items table if you don't have it, or skip this block in production
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS order_items (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            order_id INT NOT NULL,
-            product_id INT NOT NULL,
-            quantity INT NOT NULL,
-            price DECIMAL(10,2) NOT NULL,
-            FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE,
-            FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
-        )
-    """)
-    for it in cart_items:
+        # Create order, holding the stock until reserved_until
         cursor.execute("""
+            INSERT INTO orders (user_id, total_amount, status, created_at, payment_status,
+                                reservation_status, reserved_until)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, (session['user_id'], total, 'created', datetime.now(), 'unpaid',
+              reservations.HELD, reservation_deadline()))
+        order_id = cursor.lastrowid
+
+        # All order items in one statement
+        values = ', '.join(['(%s, %s, %s, %s)'] * len(cart_items))
+        params = [v for it in cart_items for v in (order_id, it['product_id'], it['quantity'], it['price'])]
+        cursor.execute(f"""
             INSERT INTO order_items (order_id, product_id, quantity, price)
-            VALUES (%s, %s, %s, %s)
-        """, (order_id, it['product_id'], it['quantity'], it['price']))
+            VALUES {values}
+        """, params)
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+        conn.commit()
+    except mysql_errors.DatabaseError as e:
+        # lock wait timeout or deadlock: nothing was taken
+        conn.rollback()
+        print(f"Error: {e}")
+        flash('Checkout is busy right now. Please try again.', 'error')
+        return redirect(url_for('cart'))
+    finally:
+        cursor.close()
+        conn.close()
+
+    invalidate_products(quantities)
 
     # Redirect to payment creation (start_payment accepts GET/POST)
     return redirect(url_for('start_payment', order_id=order_id))
@@ -1174,7 +1158,7 @@ def start_payment():
     cursor = conn.cursor(dictionary=True)
 
     # Fetch order and validate ownership
-    cursor.execute("SELECT * FROM orders WHERE id = %s", (order_id,))
+    cursor.execute("SELECT * FROM orders WHERE id = %s FOR UPDATE", (order_id,))
     order = cursor.fetchone()
 
     if not order or order['user_id'] != session['user_id']:
@@ -1189,6 +1173,25 @@ def start_payment():
         flash('Order already paid', 'info')
         return redirect(url_for('payment_return') + f"?payment_id={order.get('payment_id', 0)}")
 
+    # The hold ran out before payment: take the stock again, if it is still there
+    if order.get('reservation_status') == reservations.RELEASED:
+        quantities = order_quantities(cursor, order_id)
+        if not reserve_stock(cursor, quantities):
+            conn.rollback()
+            cursor.close()
+            conn.close()
+            flash('Some items in this order are no longer available', 'error')
+            return redirect(url_for('cart'))
+        cursor.execute("""
+            UPDATE orders SET reservation_status = %s, reserved_until = %s, status = 'created'
+            WHERE id = %s
+        """, (reservations.HELD, reservation_deadline(), order_id))
+        stock_changed = list(quantities)
+    else:
+        # The buyer is heading to the gateway: don't let the hold run out under them
+        extend_hold(cursor, order_id)
+        stock_changed = []
+
     amount = float(order['total_amount'])
 
     # Create payment
@@ -1201,18 +1204,14 @@ def start_payment():
     # Link order to latest payment
     cursor.execute("UPDATE orders SET payment_id=%s WHERE id=%s", (payment_id, order_id))
 
-    # Optional: log event
-    try:
-        cursor.execute("""
-            INSERT INTO payment_events (payment_id, event_type, payload_json)
-            VALUES (%s, %s, %s)
-        """, (payment_id, 'payment.created', json.dumps({'order_id': order_id, 'amount': amount})))
-    except Exception:
-        pass
-
     conn.commit()
     cursor.close()
     conn.close()
+    # Only once committed, or a refresh in between would cache the old stock
+    invalidate_products(stock_changed)
+
+    payment_events.write(payment_event_row(payment_id, 'payment.created',
+                                           {'order_id': order_id, 'amount': amount}))
 
     return redirect(url_for('mock_gateway', payment_id=payment_id))
 
@@ -1290,33 +1289,32 @@ def mock_gateway_process():
         flash('Payment not found', 'error')
         return redirect(url_for('checkout'))
 
-    # Move to processing
+    # Simulate webhook (server-to-server); queued, so the buyer doesn't wait
+    # for fulfilment. payment_return shows "processing" until it lands.
+    payload = {
+        'payment_id': payment_id,
+        'status': outcome,
+        'provider_txn_id': provider_txn_id,
+        'signature': 'demo-signature'
+    }
+    key = idempotency_key(payload)
+
+    # Move to processing; the hold lasts until the gateway's answer lands.
+    # The webhook goes into the outbox in the same transaction, so a
+    # restart before delivery cannot lose it.
     cursor.execute("""
         UPDATE payments SET status=%s, method=%s, provider_txn_id=%s WHERE id=%s
     """, ('processing', method, provider_txn_id, payment_id))
-
-    # Optional event
-    try:
-        cursor.execute("""
-            INSERT INTO payment_events (payment_id, event_type, payload_json)
-            VALUES (%s, %s, %s)
-        """, (payment_id, 'payment.processing', json.dumps({'outcome_selected': outcome})))
-    except Exception:
-        pass
+    extend_hold(cursor, payment['order_id'])
+    record_outbox(cursor, payload, key)
 
     conn.commit()
     cursor.close()
     conn.close()
 
-    # Simulate webhook (server-to-server)
-    payload = {
-        'payment_id': payment_id,
-        'status': outcome,
-        'provider_txn_id': provider_txn_id,
-        'signature': 'demo-signature'
-    }
-    with app.test_client() as c:
-        c.post('/mock-gateway/webhook', json=payload)
+    payment_events.write(payment_event_row(payment_id, 'payment.processing',
+                                           {'outcome_selected': outcome}))
+    webhook_dispatcher.submit(payload, key)
 
     return redirect(url_for('payment_return') + f"?payment_id={payment_id}")
 
@@ -1326,6 +1324,10 @@ def mock_gateway_webhook():
     payment_id = data.get('payment_id')
     status = data.get('status')
     provider_txn_id = data.get('provider_txn_id')
+    stock_changed = []
+    event_type = None
+    key = request.headers.get('Idempotency-Key') or \
+        (idempotency_key(data) if provider_txn_id and status else None)
 
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
@@ -1337,8 +1339,21 @@ def mock_gateway_webhook():
         conn.close()
         return jsonify({'ok': False, 'error': 'payment not found'}), 404
 
-    # Fetch order
-    cursor.execute("SELECT * FROM orders WHERE id=%s", (payment['order_id'],))
+    # A redelivered event is acknowledged without being applied twice; the
+    # key is recorded in the same transaction as its effects
+    if key:
+        cursor.execute("""
+            INSERT IGNORE INTO webhook_events (idempotency_key, payment_id, status)
+            VALUES (%s, %s, %s)
+        """, (key, payment_id, status))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            cursor.close()
+            conn.close()
+            return jsonify({'ok': True, 'duplicate': True})
+
+    # Fetch order; the lock keeps the reservation sweep off it while it settles
+    cursor.execute("SELECT * FROM orders WHERE id=%s FOR UPDATE", (payment['order_id'],))
     order = cursor.fetchone()
     if not order:
         cursor.close()
@@ -1346,54 +1361,80 @@ def mock_gateway_webhook():
         return jsonify({'ok': False, 'error': 'order not found'}), 404
 
     if status == 'success':
+        # Fulfil once per gateway transaction and once per order
+        txn_id = provider_txn_id or payment.get('provider_txn_id') or f'payment-{payment_id}'
+        cursor.execute("""
+            INSERT IGNORE INTO order_fulfilments (provider_txn_id, order_id, payment_id)
+            VALUES (%s, %s, %s)
+        """, (txn_id, order['id'], payment_id))
+        if cursor.rowcount == 0:
+            cursor.execute("SELECT 1 FROM order_fulfilments WHERE provider_txn_id = %s", (txn_id,))
+            if cursor.fetchone():
+                # The same transaction again: already applied
+                cursor.execute("UPDATE payments SET status=%s WHERE id=%s", ('success', payment_id))
+                conn.commit()
+                cursor.close()
+                conn.close()
+                return jsonify({'ok': True, 'duplicate': True})
+
+            # A second, different charge for an order another payment already
+            # fulfilled: the buyer paid twice, so this one has to be refunded
+            cursor.execute("UPDATE payments SET status=%s WHERE id=%s", ('needs_refund', payment_id))
+            conn.commit()
+            cursor.close()
+            conn.close()
+            app.logger.error("payment %s (txn %s) charged order %s, which was already fulfilled; "
+                             "marked needs_refund", payment_id, txn_id, order['id'])
+            payment_events.write(payment_event_row(payment_id, 'payment.needs_refund', data))
+            return jsonify({'ok': True, 'needs_refund': True})
+
         cursor.execute("UPDATE payments SET status=%s WHERE id=%s", ('success', payment_id))
-        cursor.execute("UPDATE orders SET payment_status='paid', status='confirmed' WHERE id=%s", (order['id'],))
 
-        # Reduce stock now if order_items exist
+        # Stock was taken at checkout while the hold is live; otherwise
+        # (older orders, or a hold that expired) take it now, if it is still there
+        order_status, reservation_status = 'confirmed', reservations.COMMITTED
+        if order.get('reservation_status') not in (reservations.HELD, reservations.COMMITTED):
+            stock_changed = take_order_stock(cursor, order['id'])
+            if stock_changed is None:
+                # Paid, but the stock went to other buyers meanwhile: refund or backorder by hand
+                app.logger.error("order %s paid by payment %s but stock is short; flagged for review",
+                                 order['id'], payment_id)
+                stock_changed = []
+                order_status, reservation_status = 'needs_review', order.get('reservation_status')
         cursor.execute("""
-            SELECT product_id, quantity FROM order_items WHERE order_id=%s
-        """, (order['id'],))
-        items = cursor.fetchall() or []
-        for it in items:
-            cursor.execute("""
-                UPDATE products SET stock = GREATEST(stock - %s, 0) WHERE id=%s
-            """, (it['quantity'], it['product_id']))
+            UPDATE orders SET payment_status='paid', status=%s,
+                              reservation_status=%s, reserved_until=NULL
+            WHERE id=%s
+        """, (order_status, reservation_status, order['id']))
         # Clear cart
         cursor.execute("DELETE FROM cart WHERE user_id=%s", (order['user_id'],))
-
-        try:
-            cursor.execute("""
-                INSERT INTO payment_events (payment_id, event_type, payload_json)
-                VALUES (%s, %s, %s)
-            """, (payment_id, 'payment.succeeded', json.dumps(data)))
-        except Exception:
-            pass
-
-    elif status == 'failed':
-        cursor.execute("UPDATE payments SET status=%s WHERE id=%s", ('failed', payment_id))
-        cursor.execute("UPDATE orders SET payment_status='failed' WHERE id=%s", (order['id'],))
-        try:
-            cursor.execute("""
-                INSERT INTO payment_events (payment_id, event_type, payload_json)
-                VALUES (%s, %s, %s)
-            """, (payment_id, 'payment.failed', json.dumps(data)))
-        except Exception:
-            pass
-
-    elif status == 'pending':
-        cursor.execute("UPDATE payments SET status=%s WHERE id=%s", ('pending', payment_id))
-        cursor.execute("UPDATE orders SET payment_status='pending' WHERE id=%s", (order['id'],))
-        try:
-            cursor.execute("""
-                INSERT INTO payment_events (payment_id, event_type, payload_json)
-                VALUES (%s, %s, %s)
-            """, (payment_id, 'payment.pending', json.dumps(data)))
-        except Exception:
-            pass
+        clear_cart_summary(cursor, order['user_id'])
+        event_type = 'payment.succeeded'
+
+    elif status in ('failed', 'pending'):
+        # Only an open payment can still fail or go pending; a late event for a
+        # settled one (success, failed, needs_refund) must not overwrite it
+        cursor.execute(f"""
+            UPDATE payments SET status=%s
+            WHERE id=%s AND status IN ({', '.join(['%s'] * len(OPEN_PAYMENT_STATUSES))})
+        """, (status, payment_id, *OPEN_PAYMENT_STATUSES))
+        if cursor.rowcount:
+            cursor.execute("UPDATE orders SET payment_status=%s WHERE id=%s AND payment_status <> 'paid'",
+                           (status, order['id']))
+            event_type = f'payment.{status}'
+        else:
+            app.logger.warning("ignored late %s event for payment %s in status %s",
+                               status, payment_id, payment['status'])
 
     conn.commit()
     cursor.close()
     conn.close()
+
+    if event_type:
+        payment_events.write(payment_event_row(payment_id, event_type, data))
+
+    # Stock moved: drop the cached copies of those products
+    invalidate_products(stock_changed)
     return jsonify({'ok': True})
 
 @app.route('/payment/return', methods=['GET'])
@@ -1418,6 +1459,11 @@ def payment_return():
     cursor.close()
     conn.close()
 
+    # Fulfilment emptied the cart; let the navbar revalidate, once per payment
+    if payment['status'] == 'success' and session.get('state_bumped_payment') != payment_id:
+        session['state_bumped_payment'] = payment_id
+        bump_user_state()
+
     return render_template('payment_result.html',
                            payment=payment,
                            order=order,
@@ -1444,6 +1490,76 @@ def buy_now(product_id):
 
     return render_template("buy_now.html", product=product, is_logged_in=True)
 
+# ==================== MAINTENANCE ====================
+@app.cli.command('reconcile-carts')
+def reconcile_carts_command():
+    """Recompute every cart summary from the cart table at current prices.
+
+    Price changes are reconciled as the catalog picks them up; run this
+    from cron as a backstop and once after creating cart_summary.
+    """
+    with db.pooled_connection(app) as conn:
+        cursor = conn.cursor()
+        try:
+            reconcile_cart_summaries(cursor)
+            conn.commit()
+        finally:
+            cursor.close()
+    print("Cart summaries reconciled")
+
+@app.cli.command('release-reservations')
+def release_reservations_command():
+    """Return the stock held by orders whose payment window has passed."""
+    print(f"Released {sweep_expired(app)} expired orders")
+
+@app.cli.command('replay-webhooks')
+def replay_webhooks_command():
+    """Redeliver dead-lettered webhooks, and outbox events that were never
+    delivered, once each; delivered ones are removed."""
+    deliver = in_process_delivery(app, '/mock-gateway/webhook')
+    replayed = failed = 0
+    with db.pooled_connection(app) as conn:
+        cursor = conn.cursor()
+        try:
+            for key, payload in stale_outbox(cursor, app.config['WEBHOOK_OUTBOX_STALE']):
+                try:
+                    deliver(payload, key)
+                except Exception as e:
+                    failed += 1
+                    print(f"{key}: {e}")
+                    continue
+                clear_outbox(cursor, key)
+                conn.commit()
+                replayed += 1
+        finally:
+            cursor.close()
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("SELECT id, idempotency_key, payload_json FROM webhook_dead_letters ORDER BY id")
+            for row in cursor.fetchall():
+                try:
+                    deliver(json.loads(row['payload_json']), row['idempotency_key'])
+                except Exception as e:
+                    failed += 1
+                    print(f"{row['idempotency_key']}: {e}")
+                    continue
+                cursor.execute("DELETE FROM webhook_dead_letters WHERE id = %s", (row['id'],))
+                conn.commit()
+                replayed += 1
+        finally:
+            cursor.close()
+    print(f"Replayed {replayed} webhooks, {failed} still failing")
+
+@app.cli.command('apply-retention')
+def apply_retention_command():
+    """Move old orders and payment events to the archive tables, in batches.
+
+    Run daily from cron; every batch is its own short transaction, so it
+    is safe to interrupt and to run alongside live traffic.
+    """
+    for what, rows in apply_retention(app).items():
+        print(f"{what}: {rows}")
+
 # ==================== RUN APPLICATION ====================
 if __name__ == '__main__':
     # In development use debug=True. In production, use a proper WSGI server and env config.
@@ -0,0 +1,38 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger('snapcart.background')
+
+
+def periodic_background(app, name, interval, fn):
+    """Run fn(app) on a daemon thread, started from a request at most once per interval.
+
+    There is no scheduler process: the first request after `interval`
+    seconds starts the job and carries on without waiting for it. A run
+    never overlaps the previous one; a failure is logged and the job runs
+    again after the next interval.
+    """
+    state = {'checked': 0.0, 'running': False}
+    lock = threading.Lock()
+
+    def run():
+        try:
+            fn(app)
+        except Exception:
+            logger.exception("%s failed", name)
+        finally:
+            state['running'] = False
+
+    def maybe_start():
+        now = time.monotonic()
+        if state['running'] or now - state['checked'] < interval:
+            return
+        with lock:
+            if state['running'] or now - state['checked'] < interval:
+                return
+            state['checked'] = now
+            state['running'] = True
+        threading.Thread(target=run, name=name, daemon=True).start()
+
+    app.before_request(maybe_start)
@@ -0,0 +1,517 @@
+import re
+import heapq
+import bisect
+import threading
+from collections import OrderedDict
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import metrics
+from catalog import get_catalog, on_catalog_refresh
+
+# --------------------------
+# Virtual basket pattern table
+# --------------------------
+# Patterns are tried in priority order (most specific first); a later
+# pattern may not claim text an earlier one already matched. `triggers`
+# are substrings every match of the pattern must contain, used to skip
+# patterns that cannot match before running them.
+BASKET_PATTERNS = [
+    {'key': 'laptop_bag', 'pattern': r'(\d+)?\s*(laptop|computer)\s+(bags?|backpacks?)',
+     'search_terms': ['Laptop', 'laptop'], 'priority': 1, 'triggers': ('laptop', 'computer')},
+    {'key': 'formal_shoes', 'pattern': r'(\d+)?\s*(?:pairs?\s+of\s+)?(\w+)?\s*(formal\s*shoes?|loafers?)',
+     'search_terms': ['Formal', 'formal', 'Loafer', 'loafer'], 'priority': 2, 'triggers': ('formal', 'loafer')},
+    {'key': 'usb_hub', 'pattern': r'(\d+)?\s*(usb|usb-c|type-c)?\s*(hub|adapter)',
+     'search_terms': ['USB', 'Hub', 'hub'], 'priority': 3, 'triggers': ('hub', 'adapter')},
+    {'key': 'bluetooth_speaker', 'pattern': r'(\d+)?\s*(bluetooth|wireless)\s+speakers?',
+     'search_terms': ['Bluetooth', 'Speaker', 'speaker'], 'priority': 4, 'triggers': ('speaker',)},
+    {'key': 'wireless_earbuds', 'pattern': r'(\d+)?\s*(wireless|bluetooth)\s+(earbuds?|headphones?)',
+     'search_terms': ['Wireless', 'Earbuds', 'earbuds', 'Bluetooth'], 'priority': 5, 'triggers': ('earbud', 'headphone')},
+    {'key': 'smart_watch', 'pattern': r'(\d+)?\s*smart\s*watches?',
+     'search_terms': ['Smart', 'Watch', 'watch'], 'priority': 6, 'triggers': ('smart',)},
+    {'key': 'leather_jacket', 'pattern': r'(\d+)?\s*leather\s+jackets?',
+     'search_terms': ['Leather', 'Jacket', 'jacket'], 'priority': 7, 'triggers': ('jacket',)},
+    {'key': 'denim_jacket', 'pattern': r'(\d+)?\s*denim\s+jackets?',
+     'search_terms': ['Denim', 'Jacket', 'jacket'], 'priority': 8, 'triggers': ('jacket',)},
+    {'key': 'leather_belt', 'pattern': r'(\d+)?\s*leather\s+belts?',
+     'search_terms': ['Leather', 'Belt', 'belt'], 'priority': 9, 'triggers': ('belt',)},
+    {'key': 'shirt', 'pattern': r'(\d+)?\s*(white|black|blue|red|grey|gray|navy|light\s*blue|dark\s*blue|green|yellow|orange|purple|pink)?\s*(shirts?|tshirts?|t-shirts?)',
+     'search_terms': ['shirt', 'Shirt'], 'priority': 10, 'triggers': ('shirt',)},
+    {'key': 'pant', 'pattern': r'(\d+)?\s*(black|blue|grey|gray|brown|khaki|white|navy|dark\s*blue|light\s*blue|beige)?\s*(pants?|trousers?|jeans?|chinos?)',
+     'search_terms': ['pant', 'Pant', 'jean', 'Jean', 'trouser', 'Trouser', 'chino', 'Chino'], 'priority': 11,
+     'triggers': ('pant', 'trouser', 'jean', 'chino')},
+    {'key': 'sneaker', 'pattern': r'(\d+)?\s*(?:pairs?\s+of\s+)?(\w+)?\s*(sneakers?)',
+     'search_terms': ['sneaker', 'Sneaker', 'Canvas'], 'priority': 12, 'triggers': ('sneaker',)},
+    {'key': 'shoes', 'pattern': r'(\d+)?\s*(?:pairs?\s+of\s+)?(\w+)?\s*(shoes?)',
+     'search_terms': ['shoe', 'Shoe'], 'priority': 13, 'triggers': ('shoe',)},
+    {'key': 'jacket', 'pattern': r'(\d+)?\s*(black|blue|grey|gray|brown|red|green)?\s*(jackets?|blazers?)',
+     'search_terms': ['jacket', 'Jacket', 'blazer', 'Blazer'], 'priority': 14, 'triggers': ('jacket', 'blazer')},
+    {'key': 'belt', 'pattern': r'(\d+)?\s*(black|brown|white|grey|gray)?\s*belts?',
+     'search_terms': ['belt', 'Belt'], 'priority': 15, 'triggers': ('belt',)},
+    {'key': 'bag', 'pattern': r'(\d+)?\s*(black|brown|blue|grey|gray|leather|canvas|white)?\s*(bags?|backpacks?|handbags?)',
+     'search_terms': ['bag', 'Bag', 'backpack', 'Backpack'], 'priority': 16, 'triggers': ('bag', 'backpack')},
+    {'key': 'watch', 'pattern': r'(\d+)?\s*(silver|gold|black|brown|leather|metal)?\s*(watch|watches)',
+     'search_terms': ['watch', 'Watch'], 'priority': 17, 'triggers': ('watch',)},
+    {'key': 'sunglasses', 'pattern': r'(\d+)?\s*(black|brown|blue|aviator|wayfarer)?\s*(sunglasses?|shades?)',
+     'search_terms': ['sunglasses', 'Sunglasses'], 'priority': 18, 'triggers': ('sunglass', 'shade')},
+    {'key': 'wallet', 'pattern': r'(\d+)?\s*(black|brown|leather|grey|gray)?\s*wallets?',
+     'search_terms': ['wallet', 'Wallet'], 'priority': 19, 'triggers': ('wallet',)},
+    {'key': 'earbuds', 'pattern': r'(\d+)?\s*(black|white)?\s*(earbuds?|headphones?)',
+     'search_terms': ['Earbuds', 'earbuds', 'headphone'], 'priority': 20, 'triggers': ('earbud', 'headphone')},
+    {'key': 'speaker', 'pattern': r'(\d+)?\s*(portable|black|blue)?\s*speakers?',
+     'search_terms': ['Speaker', 'speaker'], 'priority': 21, 'triggers': ('speaker',)},
+]
+
+# Compiled once at import, in priority order
+_COMPILED = [(cfg, re.compile(cfg['pattern'], re.IGNORECASE))
+             for cfg in sorted(BASKET_PATTERNS, key=lambda x: x['priority'])]
+
+# One lookahead scan finds every trigger occurrence, overlapping ones included
+_TRIGGER_RE = re.compile(
+    r'(?=(' + '|'.join(sorted({t for cfg in BASKET_PATTERNS for t in cfg['triggers']},
+                              key=len, reverse=True)) + '))',
+    re.IGNORECASE)
+
+# Every pattern is built from \w, \s and '-' only, so no match can cross any
+# other character: the text splits into independent segments at commas etc.
+_SEGMENT_RE = re.compile(r'[\w\s-]+')
+
+NON_COLOR_WORDS = {'laptop', 'computer', 'formal', 'usb', 'bluetooth', 'wireless',
+                   'smart', 'leather', 'denim', 'portable'}
+
+
+class IntervalSet:
+    """Non-overlapping [start, end) intervals kept sorted for O(log n) overlap checks."""
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def overlaps(self, start, end):
+        i = bisect.bisect_right(self._starts, start)
+        # the interval starting at or before `start`, and the next one after it,
+        # are the only candidates since stored intervals never overlap each other
+        if i > 0 and self._ends[i - 1] > start:
+            return True
+        if i < len(self._starts) and self._starts[i] < end:
+            return True
+        return False
+
+    def add(self, start, end):
+        i = bisect.bisect_right(self._starts, start)
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+
+
+def clean_color(color):
+    if not color:
+        return color
+    color = color.strip().lower().replace(' ', '')
+    if color in ['gray', 'grey']:
+        color = 'grey'
+    elif 'lightblue' in color or color == 'light':
+        color = 'blue'
+    elif 'darkblue' in color or color == 'navy':
+        color = 'navy'
+    elif color == 'beige':
+        color = 'brown'
+    elif color in NON_COLOR_WORDS:
+        color = None
+    return color
+
+
+def parse_basket_text(text_input):
+    """Turn free text into [{'type', 'quantity', 'color', 'search_terms', 'priority'}].
+
+    Same output as the original per-request loop: patterns run in priority
+    order, a match is dropped if it overlaps text already claimed, and
+    duplicates by (type, color) are removed.
+    """
+    # Single pass: split into segments and note which segments hold which triggers
+    segments = [m.span() for m in _SEGMENT_RE.finditer(text_input)]
+    seg_starts = [start for start, _ in segments]
+    trigger_segments = {}
+    for m in _TRIGGER_RE.finditer(text_input):
+        seg = bisect.bisect_right(seg_starts, m.start()) - 1
+        trigger_segments.setdefault(m.group(1).lower(), set()).add(seg)
+
+    claimed = IntervalSet()
+    matched_items = []
+
+    for cfg, regex in _COMPILED:
+        seg_ids = set()
+        for trigger in cfg['triggers']:
+            seg_ids |= trigger_segments.get(trigger, set())
+        if not seg_ids:
+            continue
+        # Only the segments that can match, in text order, so matches come out
+        # in the same order a whole-text finditer would produce them
+        for seg in sorted(seg_ids):
+            seg_start, seg_end = segments[seg]
+            for match in regex.finditer(text_input, seg_start, seg_end):
+                start_pos, end_pos = match.span()
+                if claimed.overlaps(start_pos, end_pos):
+                    continue
+                claimed.add(start_pos, end_pos)
+
+                quantity_str = match.group(1)
+                color = clean_color(match.group(2) if regex.groups >= 2 else None)
+                quantity = int(quantity_str) if quantity_str and quantity_str.isdigit() else 1
+
+                matched_items.append({
+                    'type': cfg['key'],
+                    'quantity': quantity,
+                    'color': color,
+                    'search_terms': cfg['search_terms'],
+                    'priority': cfg['priority'],
+                })
+
+    # Remove exact duplicates by (type, color)
+    unique_items = []
+    seen = set()
+    for item in matched_items:
+        key = (item['type'], item.get('color'))
+        if key not in seen:
+            seen.add(key)
+            unique_items.append(item)
+    return unique_items
+
+
+# --------------------------
+# Suggestion lookup
+# --------------------------
+def normalize_color(color):
+    # Same normalization the suggestion query did with LOWER(REPLACE(color, ' ', ''))
+    return (color or '').replace(' ', '').lower() or None
+
+
+class BasketIndex:
+    """In-stock products per basket item type (and per type + color), cheapest first.
+
+    Answers what used to be one `name LIKE ... AND color = ... AND stock > 0
+    ORDER BY price LIMIT 8` query per parsed item, so a long basket no
+    longer means one round trip per line.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._terms = [(cfg['key'], tuple({t.lower() for t in cfg['search_terms']}))
+                       for cfg in BASKET_PATTERNS]
+        self._clear()
+
+    def _clear(self):
+        self._rows = {}        # (type, color or None) -> [(price, id)] sorted
+        self._products = {}    # product_id -> product row
+        self._keys = {}        # product_id -> [(type, color)] it was filed under
+
+    def rebuild(self, products):
+        with self._lock:
+            self._clear()
+            for product in products:
+                self._upsert(product, sort=False)
+            for rows in self._rows.values():
+                rows.sort()
+
+    def upsert(self, product):
+        with self._lock:
+            self._upsert(product)
+
+    def remove(self, product_id):
+        with self._lock:
+            self._remove(product_id)
+
+    def _upsert(self, product, sort=True):
+        pid = product['id']
+        self._remove(pid)
+        if int(product.get('stock') or 0) <= 0:
+            return
+        # name LIKE '%term%' under a case-insensitive collation
+        name = (product.get('name') or '').lower()
+        types = [key for key, terms in self._terms if any(t in name for t in terms)]
+        if not types:
+            return
+        color = normalize_color(product.get('color'))
+        entry = (float(product['price'] or 0), pid)
+        keys = []
+        for item_type in types:
+            keys.append((item_type, None))
+            if color:
+                keys.append((item_type, color))
+        for key in keys:
+            rows = self._rows.setdefault(key, [])
+            if sort:
+                bisect.insort(rows, entry)
+            else:
+                rows.append(entry)
+        self._products[pid] = product
+        self._keys[pid] = keys
+
+    def _remove(self, pid):
+        product = self._products.pop(pid, None)
+        if product is None:
+            return
+        entry = (float(product['price'] or 0), pid)
+        for key in self._keys.pop(pid):
+            rows = self._rows[key]
+            i = bisect.bisect_left(rows, entry)
+            if i < len(rows) and rows[i] == entry:
+                del rows[i]
+            if not rows:
+                del self._rows[key]
+
+    def lookup(self, item_type, color=None, limit=8):
+        with self._lock:
+            rows = self._rows.get((item_type, color or None), ())
+            return [self._products[pid] for _, pid in rows[:limit]]
+
+
+_index = BasketIndex()
+
+
+@on_catalog_refresh
+def _sync_index(snapshot, changed_ids):
+    if changed_ids is None:
+        _index.rebuild(snapshot.products.values())
+        return
+    for pid in changed_ids:
+        product = snapshot.get(pid)
+        if product is None:
+            _index.remove(pid)
+        else:
+            _index.upsert(product)
+
+
+def find_suggestions(parsed_items, limit=8, refresh=True):
+    """Cheapest in-stock products for each parsed item: [(item, [product, ...])].
+
+    refresh=False skips the catalog freshness check, for batch callers that
+    already did it once and may run outside an app context.
+    """
+    if refresh:
+        get_catalog()  # make sure the index reflects the current catalog
+    return [(item, _index.lookup(item['type'], item['color'], limit)) for item in parsed_items]
+
+
+# --------------------------
+# Combo search
+# --------------------------
+def _cents(price):
+    return int(round(float(price or 0) * 100))
+
+
+def k_cheapest_combos(costs, k, max_cost=None):
+    """The k cheapest ways to pick one option from every list, cheapest first.
+
+    costs: one ascending list of option costs per item (ints).
+    Returns [(total, picks)] where picks[i] indexes into costs[i].
+
+    Lazy best-first enumeration: every combination except the cheapest has
+    exactly one parent, found by undoing the pick on its last changed item,
+    so each one is pushed at most once and no visited set is needed. Items
+    are walked in order of their cheapest upgrade, which makes each
+    successor cost at least as much as its parent. The cost is
+    O(k log k) however many raw combinations there are.
+    """
+    if k <= 0 or not costs or any(not c for c in costs):
+        return []
+    base = sum(c[0] for c in costs)
+    if max_cost is not None and base > max_cost:
+        return []
+    # Items with a single option never change; the rest sorted by first upgrade
+    order = sorted((i for i, c in enumerate(costs) if len(c) > 1),
+                   key=lambda i: costs[i][1] - costs[i][0])
+    root = tuple(0 for _ in costs)
+    results = [(base, root)]
+    if not order:
+        return results
+
+    def step(picks, pos, new_index):
+        item = order[pos]
+        delta = costs[item][new_index] - costs[item][picks[item]]
+        changed = list(picks)
+        changed[item] = new_index
+        return delta, tuple(changed)
+
+    first = step(root, 0, 1)
+    heap = [(base + first[0], first[1], 0)]
+    while heap and len(results) < k:
+        total, picks, pos = heapq.heappop(heap)
+        if max_cost is not None and total > max_cost:
+            break
+        results.append((total, picks))
+        item = order[pos]
+        successors = []
+        # next option on the same item
+        if picks[item] + 1 < len(costs[item]):
+            successors.append((step(picks, pos, picks[item] + 1), pos))
+        if pos + 1 < len(order):
+            # first upgrade on the next item ...
+            successors.append((step(picks, pos + 1, 1), pos + 1))
+            # ... or move this item's first upgrade over to the next item
+            if picks[item] == 1:
+                delta, moved = step(picks, pos + 1, 1)
+                reverted = list(moved)
+                reverted[item] = 0
+                delta -= costs[item][1] - costs[item][0]
+                successors.append(((delta, tuple(reverted)), pos + 1))
+        for (delta, child), child_pos in successors:
+            heapq.heappush(heap, (total + delta, child, child_pos))
+    return results
+
+
+def best_combos(suggestions, k=5, max_budget=None):
+    """Top-k distinct outfits from per-item suggestions, cheapest first.
+
+    suggestions: [{'item': parsed item, 'products': [product, ...]}], with
+    products sorted by price. Each item's price is weighted by its quantity.
+    """
+    costs = [[_cents(p['price']) * s['item']['quantity'] for p in s['products']]
+             for s in suggestions]
+    max_cost = None if max_budget is None else _cents(max_budget)
+
+    combos = []
+    for rank, (total, picks) in enumerate(k_cheapest_combos(costs, k, max_cost)):
+        items = [s['products'][i] for s, i in zip(suggestions, picks)]
+        names = ', '.join(f"{(p.get('color') or '').title()} {p['name']}".strip() for p in items)
+        if rank == 0:
+            name, badge = 'Budget Combo', 'Best Value'
+        else:
+            name, badge = f'Combo #{rank + 1}', 'Alternative'
+        combos.append({
+            'name': f'{name} ({len(items)} items)',
+            'items': items,
+            'total_price': total / 100,
+            'description': names,
+            'item_count': len(items),
+            'badge': badge,
+        })
+    return combos
+
+
+# --------------------------
+# Parse result cache
+# --------------------------
+def normalize_basket_text(text):
+    # Every pattern treats a run of whitespace like a single space
+    return ' '.join(text.lower().split())
+
+
+class ResultCache:
+    """Thread-safe LRU bounded by entry count and total value size in bytes."""
+
+    def __init__(self, max_entries=2048, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.stats['misses'] += 1
+                return None
+            self._data.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        # value is bytes; anything bigger than the whole budget isn't kept
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._data[key] = value
+            self._bytes += len(value)
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+
+parse_cache = ResultCache()
+
+
+def parse_cache_key(text, *options, fingerprint=None):
+    """Normalized text + request options + catalog content fingerprint.
+
+    The fingerprint changes with any product row, stock included, so a
+    cached payload can never outlive the data it was built from.
+    """
+    if fingerprint is None:
+        fingerprint = get_catalog().fingerprint
+    return (normalize_basket_text(text), options, fingerprint)
+
+
+@metrics.register_collector
+def _parse_cache_metrics():
+    lines = ['# HELP snapcart_basket_parse_cache_total Virtual-basket parse cache lookups by outcome.',
+             '# TYPE snapcart_basket_parse_cache_total counter']
+    for outcome, n in sorted(parse_cache.stats.items()):
+        lines.append(f'snapcart_basket_parse_cache_total{{outcome="{outcome}"}} {n}')
+    lines.append('# TYPE snapcart_basket_parse_cache_entries gauge')
+    lines.append(f'snapcart_basket_parse_cache_entries {len(parse_cache)}')
+    lines.append('# TYPE snapcart_basket_parse_cache_bytes gauge')
+    lines.append(f'snapcart_basket_parse_cache_bytes {parse_cache.size_bytes}')
+    return lines
+
+
+# --------------------------
+# Bulk parsing
+# --------------------------
+def read_ndjson(stream, max_line):
+    """Yield (line_number, raw line) from a byte stream, one line in memory at a time.
+
+    Lines longer than max_line are skipped to the next newline and yielded
+    as None so the caller can report them.
+    """
+    number = 0
+    while True:
+        line = stream.readline(max_line + 1)
+        if not line:
+            return
+        number += 1
+        if len(line) > max_line and not line.endswith(b'\n'):
+            while True:
+                rest = stream.readline(max_line)
+                if not rest or rest.endswith(b'\n'):
+                    break
+            yield number, None
+            continue
+        line = line.strip()
+        if line:
+            yield number, line
+
+
+def bulk_map(fn, jobs, executor, window):
+    """Run fn over jobs on executor, yielding results as they finish.
+
+    At most `window` jobs are in flight, so memory stays flat however long
+    `jobs` is; it is only read as fast as results are consumed.
+    """
+    pending = set()
+    try:
+        for job in jobs:
+            pending.add(executor.submit(fn, job))
+            if len(pending) >= window:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # client went away: don't keep working on its baskets
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,182 @@
+"""Per-request cost of parsing pasted shopping lists in the virtual basket.
+
+    python benchmarks/bench_basket_parse.py
+    python benchmarks/bench_basket_parse.py --items 500 --repeat 20
+
+`legacy_parse` is the loop parse_virtual_basket() used to run inline:
+rebuild and sort the pattern table, finditer every pattern, and check each
+match against all earlier matches. The benchmark also asserts that both
+parsers return identical items.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from basket import parse_basket_text  # noqa: E402
+
+PHRASES = ['white shirt', 'black pant', 'pair of sneakers', 'backpack', 'navy chinos',
+           'leather jacket', 'brown belt', 'smart watch', 'sunglasses', 'laptop bag',
+           'wireless earbuds', 'usb-c hub', 'formal shoes', 'grey blazer', 'leather wallet',
+           'bluetooth speaker', 'light blue jeans', 'black t-shirt', 'silver watch', 'denim jacket']
+
+
+def legacy_parse(text_input):
+    # Define comprehensive patterns for ALL items in database
+    patterns = [
+        { 'key': 'laptop_bag', 'pattern': r'(\d+)?\s*(laptop|computer)\s+(bags?|backpacks?)',
+          'search_terms': ['Laptop', 'laptop'], 'priority': 1 },
+        { 'key': 'formal_shoes', 'pattern': r'(\d+)?\s*(?:pairs?\s+of\s+)?(\w+)?\s*(formal\s*shoes?|loafers?)',
+          'search_terms': ['Formal', 'formal', 'Loafer', 'loafer'], 'priority': 2 },
+        { 'key': 'usb_hub', 'pattern': r'(\d+)?\s*(usb|usb-c|type-c)?\s*(hub|adapter)',
+          'search_terms': ['USB', 'Hub', 'hub'], 'priority': 3 },
+        { 'key': 'bluetooth_speaker', 'pattern': r'(\d+)?\s*(bluetooth|wireless)\s+speakers?',
+          'search_terms': ['Bluetooth', 'Speaker', 'speaker'], 'priority': 4 },
+        { 'key': 'wireless_earbuds', 'pattern': r'(\d+)?\s*(wireless|bluetooth)\s+(earbuds?|headphones?)',
+          'search_terms': ['Wireless', 'Earbuds', 'earbuds', 'Bluetooth'], 'priority': 5 },
+        { 'key': 'smart_watch', 'pattern': r'(\d+)?\s*smart\s*watches?',
+          'search_terms': ['Smart', 'Watch', 'watch'], 'priority': 6 },
+        { 'key': 'leather_jacket', 'pattern': r'(\d+)?\s*leather\s+jackets?',
+          'search_terms': ['Leather', 'Jacket', 'jacket'], 'priority': 7 },
+        { 'key': 'denim_jacket', 'pattern': r'(\d+)?\s*denim\s+jackets?',
+          'search_terms': ['Denim', 'Jacket', 'jacket'], 'priority': 8 },
+        { 'key': 'leather_belt', 'pattern': r'(\d+)?\s*leather\s+belts?',
+          'search_terms': ['Leather', 'Belt', 'belt'], 'priority': 9 },
+        { 'key': 'shirt', 'pattern': r'(\d+)?\s*(white|black|blue|red|grey|gray|navy|light\s*blue|dark\s*blue|green|yellow|orange|purple|pink)?\s*(shirts?|tshirts?|t-shirts?)',
+          'search_terms': ['shirt', 'Shirt'], 'priority': 10 },
+        { 'key': 'pant', 'pattern': r'(\d+)?\s*(black|blue|grey|gray|brown|khaki|white|navy|dark\s*blue|light\s*blue|beige)?\s*(pants?|trousers?|jeans?|chinos?)',
+          'search_terms': ['pant', 'Pant', 'jean', 'Jean', 'trouser', 'Trouser', 'chino', 'Chino'], 'priority': 11 },
+        { 'key': 'sneaker', 'pattern': r'(\d+)?\s*(?:pairs?\s+of\s+)?(\w+)?\s*(sneakers?)',
+          'search_terms': ['sneaker', 'Sneaker', 'Canvas'], 'priority': 12 },
+        { 'key': 'shoes', 'pattern': r'(\d+)?\s*(?:pairs?\s+of\s+)?(\w+)?\s*(shoes?)',
+          'search_terms': ['shoe', 'Shoe'], 'priority': 13 },
+        { 'key': 'jacket', 'pattern': r'(\d+)?\s*(black|blue|grey|gray|brown|red|green)?\s*(jackets?|blazers?)',
+          'search_terms': ['jacket', 'Jacket', 'blazer', 'Blazer'], 'priority': 14 },
+        { 'key': 'belt', 'pattern': r'(\d+)?\s*(black|brown|white|grey|gray)?\s*belts?',
+          'search_terms': ['belt', 'Belt'], 'priority': 15 },
+        { 'key': 'bag', 'pattern': r'(\d+)?\s*(black|brown|blue|grey|gray|leather|canvas|white)?\s*(bags?|backpacks?|handbags?)',
+          'search_terms': ['bag', 'Bag', 'backpack', 'Backpack'], 'priority': 16 },
+        { 'key': 'watch', 'pattern': r'(\d+)?\s*(silver|gold|black|brown|leather|metal)?\s*(watch|watches)',
+          'search_terms': ['watch', 'Watch'], 'priority': 17 },
+        { 'key': 'sunglasses', 'pattern': r'(\d+)?\s*(black|brown|blue|aviator|wayfarer)?\s*(sunglasses?|shades?)',
+          'search_terms': ['sunglasses', 'Sunglasses'], 'priority': 18 },
+        { 'key': 'wallet', 'pattern': r'(\d+)?\s*(black|brown|leather|grey|gray)?\s*wallets?',
+          'search_terms': ['wallet', 'Wallet'], 'priority': 19 },
+        { 'key': 'earbuds', 'pattern': r'(\d+)?\s*(black|white)?\s*(earbuds?|headphones?)',
+          'search_terms': ['Earbuds', 'earbuds', 'headphone'], 'priority': 20 },
+        { 'key': 'speaker', 'pattern': r'(\d+)?\s*(portable|black|blue)?\s*speakers?',
+          'search_terms': ['Speaker', 'speaker'], 'priority': 21 }
+    ]
+
+    # Sort patterns by priority (most specific first)
+    patterns.sort(key=lambda x: x['priority'])
+
+    # Track matched positions to prevent overlaps
+    matched_items = []
+    matched_positions = []
+
+    # Parse the input text for each pattern (in priority order)
+    for pattern_config in patterns:
+        pattern = pattern_config['pattern']
+        matches = re.finditer(pattern, text_input, re.IGNORECASE)
+
+        for match in matches:
+            start_pos = match.start()
+            end_pos = match.end()
+
+            # Check if this position overlaps with any already matched position
+            overlaps = False
+            for matched_start, matched_end in matched_positions:
+                if not (end_pos <= matched_start or start_pos >= matched_end):
+                    overlaps = True
+                    break
+
+            if overlaps:
+                continue
+
+            # Record this match position
+            matched_positions.append((start_pos, end_pos))
+
+            # Extract quantity and color
+            quantity_str = None
+            color = None
+            try:
+                quantity_str = match.group(1)
+                color = match.group(2) if len(match.groups()) >= 2 else None
+            except IndexError:
+                quantity_str = None
+                color = None
+
+            # Clean up color
+            if color:
+                color = color.strip().lower().replace(' ', '')
+                if color in ['gray', 'grey']:
+                    color = 'grey'
+                elif 'lightblue' in color or color == 'light':
+                    color = 'blue'
+                elif 'darkblue' in color or color == 'navy':
+                    color = 'navy'
+                elif color == 'beige':
+                    color = 'brown'
+                elif color in ['laptop', 'computer', 'formal', 'usb', 'bluetooth', 'wireless', 
+                              'smart', 'leather', 'denim', 'portable']:
+                    color = None
+
+            quantity = int(quantity_str) if quantity_str and quantity_str.isdigit() else 1
+
+            matched_items.append({
+                'type': pattern_config['key'],
+                'quantity': quantity,
+                'color': color,
+                'search_terms': pattern_config['search_terms'],
+                'priority': pattern_config['priority']
+            })
+
+    # Additional cleanup: Remove exact duplicates by (type, color)
+    unique_items = []
+    seen = set()
+    for item in matched_items:
+        key = (item['type'], item.get('color'))
+        if key not in seen:
+            seen.add(key)
+            unique_items.append(item)
+
+    parsed_items = unique_items
+    return parsed_items
+
+
+def make_list(n, seed=3):
+    rnd = random.Random(seed)
+    return ', '.join(f'{rnd.randint(1, 3)} {rnd.choice(PHRASES)}' for _ in range(n)).lower()
+
+
+def timed(fn, arg, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, nargs='*', default=[4, 25, 100, 400])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'list items':>10}{'chars':>8}{'legacy':>12}{'compiled':>12}{'speedup':>10}")
+    for n in args.items:
+        text = make_list(n)
+        assert legacy_parse(text) == parse_basket_text(text), f'outputs differ for {n} items'
+        t_old = timed(legacy_parse, text, args.repeat)
+        t_new = timed(parse_basket_text, text, args.repeat)
+        print(f'{n:>10}{len(text):>8}{t_old * 1000:>10.2f}ms{t_new * 1000:>10.2f}ms{t_old / t_new:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Compare the in-memory BM25 index with the old LIKE '%q%' scan.
+
+    python benchmarks/bench_search.py               # 100k products, sqlite LIKE baseline
+    python benchmarks/bench_search.py -n 250000
+    python benchmarks/bench_search.py --mysql       # LIKE against a TEMPORARY table in MYSQL_DB
+
+The LIKE baseline runs the same query products() used to run. With a leading
+wildcard neither sqlite nor MySQL can use an index, so both scan every row.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from search import ProductSearchIndex  # noqa: E402
+
+COLORS = ['white', 'black', 'blue', 'navy', 'grey', 'brown', 'red', 'green', 'silver', 'olive']
+ADJECTIVES = ['Classic', 'Casual', 'Premium', 'Formal', 'Slim', 'Light', 'Vintage', 'Sport', 'Linen', 'Leather']
+TYPES = ['Shirt', 'Tee', 'Jeans', 'Chinos', 'Trousers', 'Jacket', 'Blazer', 'Sneakers', 'Loafers',
+         'Belt', 'Wallet', 'Watch', 'Sunglasses', 'Backpack', 'Earbuds', 'Speaker']
+CATEGORIES = ['Clothing', 'Footwear', 'Electronics', 'Accessories']
+# a long tail of brand names, like a real marketplace catalog
+BRANDS = [f'Brand{chr(65 + i % 26)}{i}' for i in range(400)]
+QUERIES = ['white shirt', 'black jeans', 'leather jacket', 'navy chinos', 'sneakers',
+           'smart watch', 'brown belt', 'premium linen', 'trousers', 'brandq16 sneakers',
+           'branda0', 'xyzzy']
+
+LIKE_SQL = ("SELECT p.*, c.name as category_name FROM products p "
+            "JOIN categories c ON p.category_id = c.id "
+            "WHERE (p.name LIKE {ph} OR p.description LIKE {ph}) ORDER BY p.created_at DESC")
+
+
+def make_products(n, seed=7):
+    rnd = random.Random(seed)
+    for i in range(1, n + 1):
+        color = rnd.choice(COLORS)
+        kind = rnd.choice(TYPES)
+        adj = rnd.choice(ADJECTIVES)
+        brand = rnd.choice(BRANDS)
+        yield {
+            'id': i,
+            'name': f'{brand} {color.title()} {adj} {kind}',
+            'description': f'{adj} {color} {kind.lower()} made with care, style #{i}',
+            'category_id': rnd.randint(1, 4),
+            'category_name': rnd.choice(CATEGORIES),
+            'color': color,
+            'created_at': i,
+        }
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def sqlite_backend(products):
+    db = sqlite3.connect(':memory:')
+    db.execute("CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT)")
+    db.execute("CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT, description TEXT, "
+               "category_id INT, color TEXT, created_at INT)")
+    db.executemany("INSERT INTO categories VALUES (?, ?)", enumerate(CATEGORIES, 1))
+    db.executemany("INSERT INTO products VALUES (?, ?, ?, ?, ?, ?)",
+                   [(p['id'], p['name'], p['description'], p['category_id'], p['color'], p['created_at'])
+                    for p in products])
+    db.execute("CREATE INDEX idx_name ON products (name)")
+    sql = LIKE_SQL.format(ph='?')
+
+    def run(q):
+        return db.execute(sql, (f'%{q}%', f'%{q}%')).fetchall()
+    return run
+
+
+def mysql_backend(products):
+    import mysql.connector
+    from config import Config
+    conn = mysql.connector.connect(host=Config.MYSQL_HOST, user=Config.MYSQL_USER,
+                                   password=Config.MYSQL_PASSWORD, database=Config.MYSQL_DB)
+    cur = conn.cursor()
+    cur.execute("CREATE TEMPORARY TABLE bench_products (id INT PRIMARY KEY, name VARCHAR(100), "
+                "description TEXT, category_id INT, color VARCHAR(50), created_at INT, INDEX idx_name (name))")
+    rows = [(p['id'], p['name'], p['description'], p['category_id'], p['color'], p['created_at'])
+            for p in products]
+    for i in range(0, len(rows), 5000):
+        cur.executemany("INSERT INTO bench_products VALUES (%s, %s, %s, %s, %s, %s)", rows[i:i + 5000])
+    sql = LIKE_SQL.format(ph='%s').replace('FROM products p', 'FROM bench_products p')
+
+    def run(q):
+        cur.execute(sql, (f'%{q}%', f'%{q}%'))
+        return cur.fetchall()
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=100_000, help='catalog size')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--limit', type=int, default=None, help='top-k for the index (default: all)')
+    parser.add_argument('--mysql', action='store_true', help='run the LIKE baseline on MySQL')
+    args = parser.parse_args()
+
+    products = list(make_products(args.n))
+
+    index = ProductSearchIndex()
+    start = time.perf_counter()
+    index.rebuild(products)
+    build = time.perf_counter() - start
+    print(f'catalog: {args.n:,} products; index build {build:.2f}s')
+
+    start = time.perf_counter()
+    index.upsert(dict(products[0], name='Ivory Linen Shirt'))
+    print(f'incremental upsert of one product: {(time.perf_counter() - start) * 1e6:.0f}us')
+
+    like = mysql_backend(products) if args.mysql else sqlite_backend(products)
+    backend = 'mysql' if args.mysql else 'sqlite'
+
+    print(f"\n{'query':<16}{'LIKE (' + backend + ')':>16}{'hits':>8}{'BM25 index':>14}{'hits':>8}{'speedup':>10}")
+    for q in QUERIES:
+        t_like, rows = timed(lambda: like(q), args.repeat)
+        t_idx, ranked = timed(lambda: index.search(q, args.limit), args.repeat)
+        print(f'{q:<16}{t_like * 1000:>14.2f}ms{len(rows):>8}{t_idx * 1000:>12.2f}ms{len(ranked):>8}'
+              f'{t_like / t_idx if t_idx else float("inf"):>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+import hashlib
+import logging
+import threading
+
+from flask import session, current_app
+
+from db import pooled_connection
+from catalog import get_catalog, on_catalog_refresh
+
+logger = logging.getLogger('snapcart.carts')
+
+GUEST_CART_KEY = 'guest_cart'
+
+
+# --------------------------
+# Cart table helpers
+# --------------------------
+def lock_cart_rows(cursor, user_id, product_ids):
+    """Stock and current cart quantity per product; the user's cart rows are locked until commit.
+
+    Only cart rows are locked (FOR UPDATE OF c): the product rows stay free
+    for other shoppers and for checkout, which is what finally enforces
+    stock. Returns {product_id: {'id', 'name', 'stock', 'price', 'in_cart'}};
+    ids that are not in the catalog are missing from the result.
+    """
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    cursor.execute(f"""
+        SELECT p.id, p.name, p.stock, p.price, COALESCE(c.quantity, 0) AS in_cart
+        FROM products p
+        LEFT JOIN cart c ON c.product_id = p.id AND c.user_id = %s
+        WHERE p.id IN ({placeholders})
+        FOR UPDATE OF c
+    """, (user_id, *product_ids))
+    return {row['id']: row for row in cursor.fetchall()}
+
+
+def lock_cart_line(cursor, user_id, product_id):
+    """(quantity, price) of one cart row, locked until commit; None if absent.
+
+    The product row is read but not locked.
+    """
+    cursor.execute("""
+        SELECT c.quantity, p.price
+        FROM cart c
+        JOIN products p ON p.id = c.product_id
+        WHERE c.user_id = %s AND c.product_id = %s
+        FOR UPDATE OF c
+    """, (user_id, product_id))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    if isinstance(row, dict):
+        row = (row['quantity'], row['price'])
+    return row
+
+
+def upsert_cart_items(cursor, user_id, quantities):
+    # One statement for all rows; unique_user_product makes existing rows add up
+    values = ', '.join(['(%s, %s, %s)'] * len(quantities))
+    params = [v for product_id, quantity in quantities.items() for v in (user_id, product_id, quantity)]
+    cursor.execute(f"""
+        INSERT INTO cart (user_id, product_id, quantity) VALUES {values}
+        ON DUPLICATE KEY UPDATE quantity = quantity + VALUES(quantity)
+    """, params)
+
+
+# --------------------------
+# Cart summary
+# --------------------------
+# cart_summary holds each user's item count and subtotal. Every cart write
+# adjusts it in the same transaction, so badge and totals reads are one
+# primary-key lookup. The subtotal uses the price at the time of the
+# change; reconcile_cart_summaries() brings it back in line after price
+# edits.
+def adjust_cart_summary(cursor, user_id, count_delta, amount_delta):
+    cursor.execute("""
+        INSERT INTO cart_summary (user_id, item_count, subtotal) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE item_count = item_count + VALUES(item_count),
+                                subtotal = subtotal + VALUES(subtotal)
+    """, (user_id, count_delta, amount_delta))
+
+
+def clear_cart_summary(cursor, user_id):
+    cursor.execute("UPDATE cart_summary SET item_count = 0, subtotal = 0 WHERE user_id = %s", (user_id,))
+
+
+def read_cart_summary(cursor, user_id):
+    """(item count, subtotal) for the badge and cart totals."""
+    cursor.execute("SELECT item_count, subtotal FROM cart_summary WHERE user_id = %s", (user_id,))
+    row = cursor.fetchone()
+    if not row:
+        return 0, 0.0
+    if isinstance(row, dict):
+        row = (row['item_count'], row['subtotal'])
+    return int(row[0]), float(row[1])
+
+
+def reconcile_cart_summaries(cursor, product_ids=None):
+    """Recompute summaries from the cart table at current prices.
+
+    With product_ids only users with those products in their cart are
+    touched (used after price changes); otherwise every summary is rebuilt.
+    """
+    if product_ids:
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        scope = f"WHERE c.user_id IN (SELECT user_id FROM cart WHERE product_id IN ({placeholders}))"
+        params = list(product_ids)
+    else:
+        scope, params = '', []
+    cursor.execute(f"""
+        INSERT INTO cart_summary (user_id, item_count, subtotal)
+        SELECT c.user_id, SUM(c.quantity), SUM(c.quantity * p.price)
+        FROM cart c
+        JOIN products p ON p.id = c.product_id
+        {scope}
+        GROUP BY c.user_id
+        ON DUPLICATE KEY UPDATE item_count = VALUES(item_count), subtotal = VALUES(subtotal)
+    """, params)
+    if not product_ids:
+        # Summaries left over from carts that no longer have any rows
+        cursor.execute("""
+            UPDATE cart_summary s
+            LEFT JOIN cart c ON c.user_id = s.user_id
+            SET s.item_count = 0, s.subtotal = 0
+            WHERE c.user_id IS NULL AND (s.item_count <> 0 OR s.subtotal <> 0)
+        """)
+
+
+_prices = {}         # product_id -> price the summaries were last reconciled with
+
+
+def _reconcile_in_background(app, product_ids):
+    try:
+        with pooled_connection(app) as conn:
+            cursor = conn.cursor()
+            try:
+                reconcile_cart_summaries(cursor, product_ids)
+                conn.commit()
+            finally:
+                cursor.close()
+    except Exception:
+        logger.exception("cart summary: reconcile after price change failed")
+
+
+@on_catalog_refresh
+def _reconcile_price_changes(snapshot, changed_ids):
+    ids = snapshot.products if changed_ids is None else changed_ids
+    changed = []
+    for pid in ids:
+        product = snapshot.get(pid)
+        price = product['price'] if product else None
+        if pid in _prices and _prices[pid] != price:
+            changed.append(pid)
+        _prices[pid] = price
+    if changed:
+        threading.Thread(target=_reconcile_in_background, name='cart-summary-reconcile',
+                         args=(current_app._get_current_object(), changed), daemon=True).start()
+
+
+# --------------------------
+# Guest cart (session cookie)
+# --------------------------
+# Anonymous carts live in the signed session cookie as {"product_id": qty},
+# so browsing and adding to cart never write to MySQL. The cart is merged
+# into the cart table on login or registration.
+def get_guest_cart():
+    return {int(pid): int(qty) for pid, qty in session.get(GUEST_CART_KEY, {}).items()}
+
+
+def save_guest_cart(cart):
+    if cart:
+        session[GUEST_CART_KEY] = {str(pid): qty for pid, qty in cart.items()}
+    else:
+        session.pop(GUEST_CART_KEY, None)
+
+
+def guest_cart_tag():
+    # The whole state is in the cookie, so its content hash is an exact validator
+    cart = session.get(GUEST_CART_KEY)
+    if not cart:
+        return None
+    digest = hashlib.blake2b(repr(sorted(cart.items())).encode(), digest_size=6).hexdigest()
+    return f'g{digest}'
+
+
+def add_to_guest_cart(quantities):
+    """Add {product_id: qty} to the guest cart, all or nothing.
+
+    Stock comes from the catalog snapshot; it is checked again against the
+    database when the cart is merged. Returns a list of per-item errors.
+    """
+    snapshot = get_catalog()
+    cart = get_guest_cart()
+    errors = []
+    for product_id, quantity in quantities.items():
+        product = snapshot.get(product_id)
+        in_cart = cart.get(product_id, 0)
+        if not product:
+            errors.append({'product_id': product_id, 'error': 'Product not found'})
+        elif in_cart + quantity > product['stock']:
+            errors.append({'product_id': product_id,
+                           'error': f"Insufficient stock for {product['name']}. You already have "
+                                    f"{in_cart} in cart. Only {product['stock']} available."})
+    new_products = set(quantities) - set(cart)
+    if not errors and len(cart) + len(new_products) > current_app.config['GUEST_CART_MAX_ITEMS']:
+        errors.append({'product_id': None,
+                       'error': 'Your cart is full. Please login to add more products.'})
+    if errors:
+        return errors
+    for product_id, quantity in quantities.items():
+        cart[product_id] = cart.get(product_id, 0) + quantity
+    save_guest_cart(cart)
+    return []
+
+
+def quantity_error(product, quantity):
+    # Shared by the guest and logged-in quantity updates
+    if quantity > product['stock']:
+        return f"Insufficient stock for {product['name']}. Only {product['stock']} available."
+    return None
+
+
+def set_guest_cart_quantity(product_id, quantity):
+    """Set one guest cart line to quantity, checked against stock like add_to_guest_cart.
+
+    Products not in the cart are left alone. Returns an error message or None.
+    """
+    cart = get_guest_cart()
+    if product_id not in cart:
+        return None
+    product = get_catalog().get(product_id)
+    if not product:
+        return 'Product not found'
+    error = quantity_error(product, quantity)
+    if error:
+        return error
+    cart[product_id] = quantity
+    save_guest_cart(cart)
+    return None
+
+
+def guest_cart_items():
+    """Cart page rows for the guest cart, shaped like the cart table join."""
+    snapshot = get_catalog()
+    items = []
+    for product_id, quantity in get_guest_cart().items():
+        product = snapshot.get(product_id)
+        if not product:
+            continue
+        items.append({
+            'product_id': product_id,
+            'quantity': quantity,
+            'name': product['name'],
+            'price': product['price'],
+            'image_url': product['image_url'],
+            'stock': product['stock'],
+            'subtotal': float(product['price']) * quantity,
+        })
+    return items
+
+
+def guest_cart_totals():
+    items = guest_cart_items()
+    return sum(it['quantity'] for it in items), sum(it['subtotal'] for it in items)
+
+
+def merge_guest_cart(conn, user_id):
+    """Move the guest cart into the cart table with one locked read and one upsert.
+
+    Quantities are trimmed to the stock left after what the user already
+    has in their cart; products that are gone are dropped.
+    """
+    cart = get_guest_cart()
+    if not cart:
+        return 0
+    cursor = conn.cursor(dictionary=True)
+    try:
+        rows = lock_cart_rows(cursor, user_id, list(cart))
+        quantities = {}
+        for product_id, quantity in cart.items():
+            row = rows.get(product_id)
+            if row:
+                quantity = min(quantity, row['stock'] - row['in_cart'])
+                if quantity > 0:
+                    quantities[product_id] = quantity
+        if quantities:
+            upsert_cart_items(cursor, user_id, quantities)
+            adjust_cart_summary(cursor, user_id, sum(quantities.values()),
+                                sum(q * rows[pid]['price'] for pid, q in quantities.items()))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    save_guest_cart({})
+    return sum(quantities.values())
@@ -0,0 +1,237 @@
+import time
+import bisect
+import hashlib
+import threading
+
+from flask import current_app
+
+import metrics
+from db import get_db_connection
+
+PRODUCT_QUERY = """
+    SELECT p.*, c.name as category_name
+    FROM products p
+    JOIN categories c ON p.category_id = c.id
+"""
+
+
+def _age(product):
+    return product['created_at'], product['id']
+
+
+def row_hash(row):
+    # 64-bit content hash of one row; XOR-ed together into the catalog fingerprint
+    digest = hashlib.blake2b(repr(sorted(row.items())).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class CatalogSnapshot:
+    """Immutable view of categories and products at one catalog version."""
+
+    def __init__(self, version, categories, products, fingerprint=0, last_modified=None, by_age=None):
+        self.version = version
+        # content hash, identical across processes holding the same data
+        self.fingerprint = fingerprint
+        self.last_modified = last_modified or time.time()
+        self.categories = categories
+        # id -> product row, in id order
+        self.products = products
+        # oldest first by (created_at, id); partial refreshes pass it in already updated
+        self.by_age = sorted(products.values(), key=_age) if by_age is None else by_age
+
+    def get(self, product_id):
+        return self.products.get(product_id)
+
+    def newest(self, limit):
+        # same order as ORDER BY p.created_at DESC
+        return self.by_age[:-limit - 1:-1] if limit > 0 else []
+
+    def related(self, product, limit=4):
+        out = []
+        for p in self.products.values():
+            if p['category_id'] == product['category_id'] and p['id'] != product['id']:
+                out.append(p)
+                if len(out) >= limit:
+                    break
+        return out
+
+
+class CatalogCache:
+    """TTL cache for the catalog with single-flight refresh.
+
+    Only one caller refreshes at a time. While a refresh runs, other callers
+    get the previous snapshot if there is one, otherwise they wait for it.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._snapshot = None
+        self._loaded_at = 0.0
+        self._dirty_ids = set()
+        self._full_reload = True
+        self._version = 0
+        self._state_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._listeners = []
+        self.stats = {'hits': 0, 'stale': 0, 'full_refreshes': 0, 'partial_refreshes': 0}
+
+    @property
+    def version(self):
+        return self._version
+
+    def on_refresh(self, fn):
+        # fn(snapshot, changed_ids) is called after every refresh;
+        # changed_ids is None for a full reload
+        self._listeners.append(fn)
+        return fn
+
+    def _needs_refresh(self):
+        if self._snapshot is None or self._full_reload or self._dirty_ids:
+            return True
+        return time.monotonic() - self._loaded_at > self.ttl
+
+    def get(self):
+        if not self._needs_refresh():
+            self.stats['hits'] += 1
+            return self._snapshot
+
+        if self._refresh_lock.acquire(blocking=False):
+            try:
+                if self._needs_refresh():
+                    self._refresh()
+            finally:
+                self._refresh_lock.release()
+            return self._snapshot
+
+        # Someone else is refreshing: serve stale data rather than piling onto MySQL
+        if self._snapshot is not None:
+            self.stats['stale'] += 1
+            return self._snapshot
+        with self._refresh_lock:
+            if self._snapshot is None:
+                self._refresh()
+        return self._snapshot
+
+    def invalidate(self):
+        with self._state_lock:
+            self._full_reload = True
+            self._version += 1
+
+    def invalidate_products(self, product_ids):
+        ids = {int(pid) for pid in product_ids if pid is not None}
+        if not ids:
+            return
+        with self._state_lock:
+            self._dirty_ids |= ids
+            self._version += 1
+
+    def _refresh(self):
+        with self._state_lock:
+            full = self._full_reload or self._snapshot is None or \
+                time.monotonic() - self._loaded_at > self.ttl
+            dirty = set(self._dirty_ids)
+            self._dirty_ids.clear()
+            self._full_reload = False
+            version = self._version
+
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        try:
+            if full:
+                cursor.execute("SELECT * FROM categories")
+                categories = cursor.fetchall()
+                cursor.execute(PRODUCT_QUERY + " ORDER BY p.id")
+                products = {p['id']: p for p in cursor.fetchall()}
+                fingerprint = 0
+                for row in categories:
+                    fingerprint ^= row_hash(row)
+                for row in products.values():
+                    fingerprint ^= row_hash(row)
+                by_age = None
+            else:
+                categories = self._snapshot.categories
+                # Copies, since readers may still hold the previous snapshot;
+                # only the changed rows are then moved, no re-sort of the catalog
+                products = dict(self._snapshot.products)
+                by_age = list(self._snapshot.by_age)
+                fingerprint = self._snapshot.fingerprint
+                placeholders = ', '.join(['%s'] * len(dirty))
+                cursor.execute(PRODUCT_QUERY + f" WHERE p.id IN ({placeholders})", tuple(dirty))
+                fresh = {p['id']: p for p in cursor.fetchall()}
+                in_id_order = True
+                for pid in dirty:
+                    old = products.get(pid)
+                    if old is not None:
+                        fingerprint ^= row_hash(old)
+                        i = bisect.bisect_left(by_age, _age(old), key=_age)
+                        del by_age[i]
+                    if pid in fresh:
+                        if old is None and products and pid < next(reversed(products)):
+                            in_id_order = False
+                        products[pid] = fresh[pid]
+                        bisect.insort(by_age, fresh[pid], key=_age)
+                        fingerprint ^= row_hash(fresh[pid])
+                    else:
+                        products.pop(pid, None)
+                if not in_id_order:
+                    # a new product below the highest id (rare with AUTO_INCREMENT)
+                    products = dict(sorted(products.items()))
+        except Exception:
+            # Let the next caller retry what we failed to load
+            with self._state_lock:
+                self._dirty_ids |= dirty
+                self._full_reload = self._full_reload or full
+            raise
+        finally:
+            cursor.close()
+
+        previous = self._snapshot
+        if previous is not None and previous.fingerprint == fingerprint:
+            last_modified = previous.last_modified
+        else:
+            last_modified = time.time()
+        snapshot = CatalogSnapshot(version, categories, products, fingerprint, last_modified, by_age)
+        self._snapshot = snapshot
+        if full:
+            self._loaded_at = time.monotonic()
+            self.stats['full_refreshes'] += 1
+        else:
+            self.stats['partial_refreshes'] += 1
+
+        for fn in self._listeners:
+            fn(snapshot, None if full else dirty)
+
+
+_cache = CatalogCache()
+
+
+def get_catalog():
+    _cache.ttl = current_app.config.get('CATALOG_CACHE_TTL', _cache.ttl)
+    return _cache.get()
+
+
+def catalog_version():
+    return _cache.version
+
+
+def on_catalog_refresh(fn):
+    return _cache.on_refresh(fn)
+
+
+def invalidate_catalog():
+    _cache.invalidate()
+
+
+def invalidate_products(product_ids):
+    _cache.invalidate_products(product_ids)
+
+
+@metrics.register_collector
+def _catalog_metrics():
+    lines = ['# HELP snapcart_catalog_cache_total Catalog cache lookups by outcome.',
+             '# TYPE snapcart_catalog_cache_total counter']
+    for outcome, n in sorted(_cache.stats.items()):
+        lines.append(f'snapcart_catalog_cache_total{{outcome="{outcome}"}} {n}')
+    lines.append('# TYPE snapcart_catalog_version gauge')
+    lines.append(f'snapcart_catalog_version {_cache.version}')
+    return lines
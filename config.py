@@ -9,6 +9,71 @@ class Config:
     MYSQL_PASSWORD = 'love4761'  # Change this
     MYSQL_DB = 'ecommerce_db'
     MYSQL_CURSORCLASS = 'DictCursor'
+
+    # Connection pool (see db.py)
+    MYSQL_POOL_NAME = 'snapcart'
+    MYSQL_POOL_SIZE = int(os.environ.get('MYSQL_POOL_SIZE', 10))
+    MYSQL_POOL_TIMEOUT = 10          # seconds to wait for a free connection
+    MYSQL_CONNECT_TIMEOUT = 5        # seconds for the TCP/auth handshake
+    MYSQL_POOL_RECYCLE = 1800        # reconnect connections idle longer than this
+    MYSQL_POOL_PRE_PING = True       # ping on checkout to catch dropped connections
+    MYSQL_POOL_RESET_SESSION = True
+
+    # Query instrumentation (see metrics.py)
+    SLOW_QUERY_THRESHOLD_MS = int(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 200))
+    METRICS_SLOWEST_KEEP = 3
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # scrapers send "Authorization: Bearer <token>"
+    METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')   # used only without a token; behind a proxy set the token
+
+    # Catalog cache (see catalog.py)
+    CATALOG_CACHE_TTL = int(os.environ.get('CATALOG_CACHE_TTL', 300))  # seconds
+
+    # Product listing pagination
+    PRODUCTS_PAGE_SIZE = 24
+    PRODUCTS_MAX_PAGE_SIZE = 96
+
+    # Typeahead (see typeahead.py)
+    TYPEAHEAD_MAX_AGE = 300          # seconds browsers/proxies may reuse a completion list
+
+    # Extra synonyms for phrase parsing, reloaded when the file changes (see lexicon.py)
+    LEXICON_FILE = os.environ.get('LEXICON_FILE')  # JSON, optional
+    LEXICON_RELOAD_INTERVAL = 30     # seconds between mtime checks
+
+    # HTTP caching (see http_cache.py)
+    HTTP_CACHE_MAX_AGE = 60          # seconds, anonymous catalog pages
+    USER_STATE_ETAG_TTL = 60         # max staleness for changes made outside this session
+
+    # Virtual basket combo search (see basket.py)
+    VIRTUAL_BASKET_COMBOS = 5        # combos returned when the request doesn't say
+    VIRTUAL_BASKET_MAX_COMBOS = 20
+    VIRTUAL_BASKET_CACHE_ENTRIES = 2048
+    VIRTUAL_BASKET_CACHE_BYTES = 32 * 1024 * 1024
+    BULK_PARSE_WORKERS = int(os.environ.get('BULK_PARSE_WORKERS', 4))
+    BULK_PARSE_MAX_LINE = 64 * 1024  # bytes per NDJSON basket
+    MATCH_MAX_ITEMS = 1000           # phrases per /api/match-products call
+    CART_BULK_MAX_ITEMS = 50         # products per /api/cart/add-bulk call
+    GUEST_CART_MAX_ITEMS = 30        # distinct products in a cookie cart (keeps it well under 4KB)
+    ORDER_RESERVATION_MINUTES = 15   # stock is held this long for an unpaid order
+    RESERVATION_SWEEP_INTERVAL = 60  # seconds between releases of expired holds
+    CHECKOUT_LOCK_WAIT_TIMEOUT = 5   # seconds a checkout waits on a locked stock row
+    WEBHOOK_WORKERS = 2              # background webhook delivery threads
+    WEBHOOK_MAX_ATTEMPTS = 6         # then the event goes to webhook_dead_letters
+    WEBHOOK_RETRY_BASE = 0.5         # seconds; doubles per attempt
+    WEBHOOK_RETRY_MAX = 60.0
+    WEBHOOK_OUTBOX_STALE = 300       # seconds before an undelivered outbox event is queued again
+    WEBHOOK_OUTBOX_SWEEP_INTERVAL = 60  # seconds between outbox sweeps
+    WEBHOOK_DRAIN_TIMEOUT = 10       # seconds shutdown waits for queued webhooks
+    PAYMENT_EVENTS_BATCH = 200               # rows per payment_events INSERT
+    PAYMENT_EVENTS_FLUSH_INTERVAL = 1.0      # seconds an event may wait in the buffer
+    PAYMENT_EVENTS_SYNC = os.environ.get('PAYMENT_EVENTS_SYNC') == '1'  # write through (tests)
+    PAYMENT_EVENTS_MAX_FAILURES = 3   # failed flushes before a batch is written row by row
+
+    # Retention (flask apply-retention, see retention.py)
+    ORDERS_RETENTION_DAYS = int(os.environ.get('ORDERS_RETENTION_DAYS', 365))
+    PAYMENT_EVENTS_RETENTION_DAYS = int(os.environ.get('PAYMENT_EVENTS_RETENTION_DAYS', 90))
+    ARCHIVE_RETENTION_DAYS = None    # days archived rows are kept; None keeps them forever
+    ARCHIVE_BATCH_SIZE = 500         # rows moved per transaction
+    ARCHIVE_BATCH_PAUSE = 0.1        # seconds between batches, to stay out of checkout's way
     
     # Session configuration
     SESSION_COOKIE_HTTPONLY = True
@@ -3,6 +3,7 @@ CREATE DATABASE IF NOT EXISTS ecommerce_db;
 USE ecommerce_db;
 
 -- Drop tables if they exist (for clean setup)
+DROP TABLE IF EXISTS cart_summary;
 DROP TABLE IF EXISTS order_items;
 DROP TABLE IF EXISTS orders;
 DROP TABLE IF EXISTS cart;
@@ -57,6 +58,16 @@ CREATE TABLE cart (
     UNIQUE KEY unique_user_product (user_id, product_id)
 );
 
+-- Per-user cart totals, adjusted by the app in the same transaction as
+-- every cart change (backfill/repair: flask reconcile-carts)
+CREATE TABLE cart_summary (
+    user_id INT PRIMARY KEY,
+    item_count INT NOT NULL DEFAULT 0,
+    subtotal DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
 -- Orders table
 CREATE TABLE orders (
     id INT AUTO_INCREMENT PRIMARY KEY,
@@ -81,13 +92,27 @@ CREATE TABLE order_items (
 ALTER TABLE orders
   ADD COLUMN payment_id INT NULL,
   ADD COLUMN payment_status VARCHAR(20) DEFAULT 'unpaid';
+-- Checkout stock holds: taken when the order is created, released when
+-- reserved_until passes without payment (flask release-reservations)
+ALTER TABLE orders
+  ADD COLUMN reservation_status VARCHAR(20) NOT NULL DEFAULT 'none',  -- none|held|committed|released
+  ADD COLUMN reserved_until DATETIME NULL,
+  ADD INDEX idx_orders_reservation (reservation_status, reserved_until);
+-- Retention scan (flask apply-retention): in the query's ORDER BY created_at, id
+-- and covering its reservation_status filter
+ALTER TABLE orders
+  ADD INDEX idx_orders_created (created_at, id, reservation_status);
+-- Listing pagination: keyset on (created_at, id), optionally within a category
+ALTER TABLE products
+  ADD INDEX idx_products_created (created_at, id),
+  ADD INDEX idx_products_category_created (category_id, created_at, id);
 -- Payments table
 CREATE TABLE IF NOT EXISTS payments (
   id INT AUTO_INCREMENT PRIMARY KEY,
   order_id INT NOT NULL,
   amount DECIMAL(10,2) NOT NULL,
   currency VARCHAR(10) DEFAULT 'INR',
-  status VARCHAR(20) NOT NULL DEFAULT 'created',   -- created|processing|success|failed|pending|refunded
+  status VARCHAR(20) NOT NULL DEFAULT 'created',   -- created|processing|success|failed|pending|needs_refund|refunded
   method VARCHAR(30) DEFAULT NULL,                 -- card|upi|netbanking
   provider_txn_id VARCHAR(64) DEFAULT NULL,        -- mock txn reference
   meta_json JSON DEFAULT NULL,
@@ -106,7 +131,98 @@ CREATE TABLE IF NOT EXISTS payment_events (
   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   FOREIGN KEY (payment_id) REFERENCES payments(id) ON DELETE CASCADE
 );
+-- Per-payment timeline, and the retention scan (flask apply-retention):
+-- (created_at) plus the implicit id is the query's ORDER BY created_at, id
+ALTER TABLE payment_events
+  ADD INDEX idx_payment_events_payment (payment_id, created_at, event_type),
+  ADD INDEX idx_payment_events_created (created_at);
 
+-- Gateway webhook idempotency: one row per applied event
+CREATE TABLE IF NOT EXISTS webhook_events (
+  idempotency_key VARCHAR(100) PRIMARY KEY,
+  payment_id INT NOT NULL,
+  status VARCHAR(20) NOT NULL,
+  received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  INDEX idx_webhook_events_payment (payment_id)
+);
+-- One fulfilment (stock, cart, order confirmation) per gateway transaction and per order
+CREATE TABLE IF NOT EXISTS order_fulfilments (
+  provider_txn_id VARCHAR(64) PRIMARY KEY,
+  order_id INT NOT NULL,
+  payment_id INT NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE KEY uniq_fulfilment_order (order_id)
+);
+-- Gateway-side outbox: written with the payment change, removed once delivered
+-- or dead-lettered; rows left behind by a restart are queued again
+CREATE TABLE IF NOT EXISTS webhook_outbox (
+  idempotency_key VARCHAR(100) PRIMARY KEY,
+  payment_id INT NOT NULL,
+  payload_json JSON NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  INDEX idx_webhook_outbox_created (created_at)
+);
+-- Webhooks that failed every delivery attempt (replay: flask replay-webhooks)
+CREATE TABLE IF NOT EXISTS webhook_dead_letters (
+  id INT AUTO_INCREMENT PRIMARY KEY,
+  idempotency_key VARCHAR(100) NOT NULL,
+  payload_json JSON NOT NULL,
+  attempts INT NOT NULL,
+  last_error VARCHAR(500),
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Archive tables (flask apply-retention). Same columns as the hot tables,
+-- with no foreign keys, so rows keep their ids and can be purged on their own.
+CREATE TABLE IF NOT EXISTS orders_archive (
+  id INT PRIMARY KEY,
+  user_id INT NOT NULL,
+  total_amount DECIMAL(10, 2) NOT NULL,
+  status VARCHAR(50),
+  created_at TIMESTAMP NULL,
+  payment_id INT NULL,
+  payment_status VARCHAR(20),
+  reservation_status VARCHAR(20),
+  reserved_until DATETIME NULL,
+  archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  INDEX idx_orders_archive_user (user_id, created_at),
+  INDEX idx_orders_archive_archived (archived_at)
+);
+CREATE TABLE IF NOT EXISTS order_items_archive (
+  id INT PRIMARY KEY,
+  order_id INT NOT NULL,
+  product_id INT NOT NULL,
+  quantity INT NOT NULL,
+  price DECIMAL(10, 2) NOT NULL,
+  archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  INDEX idx_order_items_archive_order (order_id),
+  INDEX idx_order_items_archive_archived (archived_at)
+);
+CREATE TABLE IF NOT EXISTS payments_archive (
+  id INT PRIMARY KEY,
+  order_id INT NOT NULL,
+  amount DECIMAL(10,2) NOT NULL,
+  currency VARCHAR(10),
+  status VARCHAR(20) NOT NULL,
+  method VARCHAR(30),
+  provider_txn_id VARCHAR(64),
+  meta_json JSON,
+  created_at TIMESTAMP NULL,
+  updated_at TIMESTAMP NULL,
+  archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  INDEX idx_payments_archive_order (order_id),
+  INDEX idx_payments_archive_archived (archived_at)
+);
+CREATE TABLE IF NOT EXISTS payment_events_archive (
+  id INT PRIMARY KEY,
+  payment_id INT NOT NULL,
+  event_type VARCHAR(40) NOT NULL,
+  payload_json JSON,
+  created_at TIMESTAMP NULL,
+  archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  INDEX idx_payment_events_archive_payment (payment_id, created_at),
+  INDEX idx_payment_events_archive_archived (archived_at)
+);
 
 
 -- Insert Categories
@@ -0,0 +1,135 @@
+import time
+import threading
+from contextlib import contextmanager
+
+from flask import g, current_app, has_app_context
+from mysql.connector import pooling, errors
+
+from metrics import InstrumentedCursor
+
+_pool_lock = threading.Lock()
+
+
+# --------------------------
+# Pool setup
+# --------------------------
+def _create_pool(app):
+    cfg = app.config
+    return pooling.MySQLConnectionPool(
+        pool_name=cfg.get('MYSQL_POOL_NAME', 'snapcart'),
+        pool_size=cfg.get('MYSQL_POOL_SIZE', 10),
+        pool_reset_session=cfg.get('MYSQL_POOL_RESET_SESSION', True),
+        host=cfg.get('MYSQL_HOST'),
+        user=cfg.get('MYSQL_USER'),
+        password=cfg.get('MYSQL_PASSWORD'),
+        database=cfg.get('MYSQL_DB'),
+        connection_timeout=cfg.get('MYSQL_CONNECT_TIMEOUT', 5),
+        autocommit=False,
+    )
+
+
+def get_pool(app=None):
+    # Created lazily so importing the app never needs a live database
+    app = app or current_app._get_current_object()
+    pool = app.extensions.get('mysql_pool')
+    if pool is None:
+        with _pool_lock:
+            pool = app.extensions.get('mysql_pool')
+            if pool is None:
+                pool = _create_pool(app)
+                app.extensions['mysql_pool'] = pool
+    return pool
+
+
+def _checkout(app):
+    pool = get_pool(app)
+    wait = app.config.get('MYSQL_POOL_TIMEOUT', 10)
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            conn = pool.get_connection()
+            break
+        except errors.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.01)
+
+    # Health check: recycle connections that sat idle too long or went away
+    raw = conn._cnx
+    recycle = app.config.get('MYSQL_POOL_RECYCLE', 1800)
+    last_used = getattr(raw, '_snapcart_last_used', None)
+    try:
+        if last_used is not None and time.monotonic() - last_used > recycle:
+            raw.reconnect(attempts=2, delay=0)
+        elif app.config.get('MYSQL_POOL_PRE_PING', True):
+            raw.ping(reconnect=True, attempts=2, delay=0)
+    except errors.Error:
+        conn.close()
+        raise
+    return conn
+
+
+def _checkin(conn):
+    raw = conn._cnx
+    if raw is None:
+        return
+    try:
+        # Never hand an open transaction to the next borrower
+        if raw.in_transaction:
+            raw.rollback()
+        raw._snapcart_last_used = time.monotonic()
+    except errors.Error:
+        pass
+    conn.close()
+
+
+class RequestConnection:
+    """Proxy around the pooled connection held on flask.g.
+
+    Handlers keep calling conn.close() as before; the real connection is
+    only returned to the pool when the app context tears down.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def close(self):
+        pass
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+# --------------------------
+# Public helpers
+# --------------------------
+def get_db_connection():
+    # One checked-out connection per request, reused by every caller
+    if 'db_conn' not in g:
+        g.db_conn = RequestConnection(_checkout(current_app._get_current_object()))
+    return g.db_conn
+
+
+@contextmanager
+def pooled_connection(app=None):
+    # For code running outside a request (workers, maintenance jobs)
+    if app is None and has_app_context():
+        app = current_app._get_current_object()
+    conn = _checkout(app)
+    try:
+        yield conn
+    finally:
+        _checkin(conn)
+
+
+def close_db_connection(exc=None):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        _checkin(conn._conn)
+
+
+def init_app(app):
+    app.teardown_appcontext(close_db_connection)
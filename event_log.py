@@ -0,0 +1,225 @@
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+
+from mysql.connector import errors as mysql_errors
+
+import metrics
+from db import pooled_connection
+
+logger = logging.getLogger('snapcart.events')
+
+FLUSH_LATENCY = metrics.Histogram('snapcart_event_flush_seconds',
+                                  'Time to write one batch of buffered events.', metrics.LATENCY_BUCKETS,
+                                  label='log')
+
+
+class BufferedEventWriter:
+    """Append-only event log that writes in batches off the request path.
+
+    write() only appends to an in-memory buffer. A background thread hands
+    the buffer to flush_rows(rows) once it holds max_batch rows or its
+    oldest row is max_delay seconds old, and close() flushes whatever is
+    left. A failed flush keeps its rows for the next attempt; beyond
+    max_buffer rows the oldest are dropped (and counted) rather than
+    letting memory grow without bound.
+
+    A batch that has failed max_failures times in a row with an error
+    is_permanent(error) accepts (bad data rather than a database outage)
+    is written one row at a time, and the rows that still fail that way
+    are logged and dropped (counted as dead_lettered), so one bad event
+    cannot hold up everything behind it.
+
+    With synchronous=True every write() is flushed before it returns.
+    """
+
+    def __init__(self, name, flush_rows, max_batch=200, max_delay=1.0, max_buffer=20000,
+                 synchronous=False, max_failures=3, is_permanent=lambda error: True):
+        self.name = name
+        self.flush_rows = flush_rows
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_buffer = max_buffer
+        self.synchronous = synchronous
+        self.max_failures = max_failures
+        self.is_permanent = is_permanent
+        self._buffer = deque()
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._failures = 0             # consecutive failed flushes of the batch at the head
+        self.stats = {'written': 0, 'flushed': 0, 'dropped': 0, 'failed_flushes': 0, 'dead_lettered': 0}
+
+    def write(self, row):
+        with self._cond:
+            closed = self._closed
+            self._buffer.append(row)
+            self.stats['written'] += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            overflow = len(self._buffer) - self.max_buffer
+            for _ in range(max(overflow, 0)):
+                self._buffer.popleft()
+                self.stats['dropped'] += 1
+            if len(self._buffer) >= self.max_batch:
+                self._cond.notify()
+        if self.synchronous or closed:
+            # after close() there is no background thread left to do it
+            self.flush()
+        else:
+            self._ensure_thread()
+
+    @property
+    def depth(self):
+        return len(self._buffer)
+
+    def flush(self):
+        """Write out everything buffered so far, in batches of max_batch."""
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    if not self._buffer:
+                        self._oldest = None
+                        return True
+                    batch = [self._buffer.popleft()
+                             for _ in range(min(self.max_batch, len(self._buffer)))]
+                    self._oldest = time.monotonic() if self._buffer else None
+                start = time.perf_counter()
+                try:
+                    self.flush_rows(batch)
+                except Exception as e:
+                    self.stats['failed_flushes'] += 1
+                    self._failures += 1
+                    logger.exception("%s: flush of %d events failed, will retry", self.name, len(batch))
+                    if self._failures >= self.max_failures and self.is_permanent(e):
+                        batch = self._isolate(batch)
+                    if batch:
+                        with self._cond:
+                            self._buffer.extendleft(reversed(batch))
+                            if self._oldest is None:
+                                self._oldest = time.monotonic()
+                        return False
+                    self._failures = 0
+                    continue
+                self._failures = 0
+                FLUSH_LATENCY.observe(self.name, time.perf_counter() - start)
+                self.stats['flushed'] += len(batch)
+
+    def _isolate(self, batch):
+        """Write a repeatedly failing batch row by row, dropping the rows that are
+        rejected for good. Returns the rows still to write if a transient error
+        stops it."""
+        for i, row in enumerate(batch):
+            try:
+                self.flush_rows([row])
+            except Exception as e:
+                if not self.is_permanent(e):
+                    return batch[i:]
+                self.stats['dead_lettered'] += 1
+                logger.error("%s: dropping event that cannot be written (%s): %r", self.name, e, row)
+            else:
+                self.stats['flushed'] += 1
+        return []
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self.flush()
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._cond:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=f'{self.name}-writer',
+                                                    daemon=True)
+                    self._thread.start()
+
+    def _due(self):
+        return bool(self._buffer) and (len(self._buffer) >= self.max_batch or
+                                       time.monotonic() - self._oldest >= self.max_delay)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._due():
+                    if self._buffer:
+                        self._cond.wait(max(self.max_delay - (time.monotonic() - self._oldest), 0.01))
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+            if not self.flush():
+                # back off a little after a failed flush instead of spinning
+                time.sleep(self.max_delay)
+
+
+# --------------------------
+# payment_events
+# --------------------------
+def payment_event_row(payment_id, event_type, payload):
+    # created_at is the time of the event, not of the flush
+    return (payment_id, event_type, json.dumps(payload, default=str), datetime.now())
+
+
+def is_bad_row_error(error):
+    # A row the database rejects (constraint, bad value) fails the same way every
+    # time; connection and lock errors are worth waiting out
+    return isinstance(error, (mysql_errors.IntegrityError, mysql_errors.DataError,
+                              mysql_errors.ProgrammingError))
+
+
+def insert_payment_events(app):
+    def flush_rows(rows):
+        values = ', '.join(['(%s, %s, %s, %s)'] * len(rows))
+        params = [v for row in rows for v in row]
+        with pooled_connection(app) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"""
+                    INSERT INTO payment_events (payment_id, event_type, payload_json, created_at)
+                    VALUES {values}
+                """, params)
+                conn.commit()
+            finally:
+                cursor.close()
+    return flush_rows
+
+
+_writers = []
+
+
+def create_payment_event_writer(app):
+    cfg = app.config
+    writer = BufferedEventWriter('payment_events', insert_payment_events(app),
+                                 max_batch=cfg.get('PAYMENT_EVENTS_BATCH', 200),
+                                 max_delay=cfg.get('PAYMENT_EVENTS_FLUSH_INTERVAL', 1.0),
+                                 synchronous=cfg.get('PAYMENT_EVENTS_SYNC', False),
+                                 max_failures=cfg.get('PAYMENT_EVENTS_MAX_FAILURES', 3),
+                                 is_permanent=is_bad_row_error)
+    _writers.append(writer)
+    # clean shutdown: nothing buffered is lost
+    atexit.register(writer.close)
+    return writer
+
+
+@metrics.register_collector
+def _event_log_metrics():
+    lines = ['# HELP snapcart_events_total Buffered event log counters.',
+             '# TYPE snapcart_events_total counter']
+    for writer in _writers:
+        for outcome, n in sorted(writer.stats.items()):
+            lines.append(f'snapcart_events_total{{log="{writer.name}",outcome="{outcome}"}} {n}')
+    lines.append('# TYPE snapcart_events_queue_depth gauge')
+    for writer in _writers:
+        lines.append(f'snapcart_events_queue_depth{{log="{writer.name}"}} {writer.depth}')
+    lines.extend(FLUSH_LATENCY.render())
+    return lines
@@ -0,0 +1,272 @@
+import threading
+
+from catalog import on_catalog_refresh
+
+# (key, label, low inclusive, high exclusive)
+PRICE_BANDS = [
+    ('under-1000', 'Under ₹1,000', None, 1000),
+    ('1000-2000', '₹1,000 – ₹2,000', 1000, 2000),
+    ('2000-5000', '₹2,000 – ₹5,000', 2000, 5000),
+    ('5000-plus', '₹5,000 & above', 5000, None),
+]
+FACETS = ('category', 'color', 'size', 'price', 'in_stock')
+
+
+def price_band(price):
+    price = float(price or 0)
+    for key, _, lo, hi in PRICE_BANDS:
+        if (lo is None or price >= lo) and (hi is None or price < hi):
+            return key
+    return None
+
+
+def in_stock(product):
+    # Python side of IN_STOCK_SQL; keep the two in step
+    return int(product.get('stock') or 0) > 0
+
+
+IN_STOCK_SQL = "p.stock > 0"
+
+
+def normalize_value(facet, value):
+    # One spelling per value, matching what the case-insensitive SQL filter treats as equal
+    if facet == 'color':
+        return (value or '').strip().lower() or None
+    if facet == 'size':
+        return (value or '').strip().upper() or None
+    return value
+
+
+def facet_values(product):
+    # facet -> value for one product; None means "not faceted on this"
+    return {
+        'category': product.get('category_id'),
+        'color': normalize_value('color', product.get('color')),
+        'size': normalize_value('size', product.get('size')),
+        'price': price_band(product.get('price')),
+        'in_stock': '1' if in_stock(product) else None,
+    }
+
+
+def parse_selection(args):
+    """Read facet filters from request args (?color=black&color=blue&price=...)."""
+    selected = {}
+    for facet in ('color', 'size', 'price'):
+        values = {normalize_value(facet, v) for v in args.getlist(facet)} - {None}
+        if values:
+            selected[facet] = values
+    if args.get('in_stock') in ('1', 'true', 'on'):
+        selected['in_stock'] = {'1'}
+    return selected
+
+
+def matches(product, selected):
+    values = facet_values(product)
+    return all(str(values[f]) in {str(v) for v in wanted} for f, wanted in selected.items())
+
+
+def sql_filters(selected):
+    """Same filters as SQL for the paginated listing query."""
+    clauses, params = [], []
+    if 'color' in selected:
+        # default collation is case-insensitive, so this can use idx_color
+        clauses.append(f"p.color IN ({', '.join(['%s'] * len(selected['color']))})")
+        params.extend(sorted(selected['color']))
+    if 'size' in selected:
+        clauses.append(f"p.size IN ({', '.join(['%s'] * len(selected['size']))})")
+        params.extend(sorted(selected['size']))
+    if 'price' in selected:
+        bands = []
+        for key, _, lo, hi in PRICE_BANDS:
+            if key not in selected['price']:
+                continue
+            parts = []
+            if lo is not None:
+                parts.append("p.price >= %s")
+                params.append(lo)
+            if hi is not None:
+                parts.append("p.price < %s")
+                params.append(hi)
+            bands.append('(' + ' AND '.join(parts) + ')')
+        clauses.append('(' + (' OR '.join(bands) or '1=0') + ')')
+    if 'in_stock' in selected:
+        clauses.append(IN_STOCK_SQL)
+    return clauses, params
+
+
+class FacetIndex:
+    """Bitmap index over facet values.
+
+    Each product gets a bit position; each facet value keeps a Python int
+    with the bits of the products that have it. Counting is AND + popcount.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._bit = {}          # product_id -> bit position
+        self._values = {}       # product_id -> facet values at index time
+        self._free = []         # bit positions of removed products
+        self._next_bit = 0
+        self._all = 0
+        self._bitmaps = {f: {} for f in FACETS}
+        self._labels = {'category': {}}
+        self._popcounts = {}    # (facet, value) -> count over the whole catalog
+
+    def rebuild(self, products):
+        with self._lock:
+            self._clear()
+            for product in products:
+                self._upsert(product)
+
+    def upsert(self, product):
+        with self._lock:
+            self._upsert(product)
+
+    def remove(self, product_id):
+        with self._lock:
+            self._remove(product_id)
+
+    def _upsert(self, product):
+        pid = product['id']
+        values = facet_values(product)
+        if self._values.get(pid) == values:
+            return
+        self._remove(pid)
+        self._popcounts.clear()
+        if self._free:
+            bit = self._free.pop()
+        else:
+            bit = self._next_bit
+            self._next_bit += 1
+        mask = 1 << bit
+        self._bit[pid] = bit
+        self._values[pid] = values
+        self._all |= mask
+        for facet, value in values.items():
+            if value is None:
+                continue
+            bitmaps = self._bitmaps[facet]
+            bitmaps[value] = bitmaps.get(value, 0) | mask
+        if product.get('category_name'):
+            self._labels['category'][product['category_id']] = product['category_name']
+
+    def _remove(self, pid):
+        bit = self._bit.pop(pid, None)
+        if bit is None:
+            return
+        self._popcounts.clear()
+        mask = ~(1 << bit)
+        self._all &= mask
+        for facet, value in self._values.pop(pid).items():
+            if value is None:
+                continue
+            bitmaps = self._bitmaps[facet]
+            bitmaps[value] &= mask
+            if not bitmaps[value]:
+                del bitmaps[value]
+        self._free.append(bit)
+
+    def bitmap_for(self, product_ids):
+        # Bitmap for an arbitrary result set, e.g. the search hits
+        with self._lock:
+            buf = bytearray((self._next_bit + 7) // 8)
+            for pid in product_ids:
+                bit = self._bit.get(pid)
+                if bit is not None:
+                    buf[bit >> 3] |= 1 << (bit & 7)
+        return int.from_bytes(buf, 'little')
+
+    def counts(self, selected, base=None, fixed=None):
+        """Per-value counts for every facet.
+
+        A facet's own selection is left out when counting that facet
+        (standard disjunctive faceting), so picking "black" still shows how
+        many blue items there are. `base` narrows everything to a result
+        set; `fixed` holds filters that always apply, like the category.
+        """
+        with self._lock:
+            universe = self._all if base is None else self._all & base
+            selections = dict(fixed or {})
+            selections.update(selected)
+            masks = {}
+            for facet, wanted in selections.items():
+                bm = 0
+                for value in wanted:
+                    bm |= self._bitmaps[facet].get(self._key(facet, value), 0)
+                masks[facet] = bm
+
+            out = {}
+            for facet in FACETS:
+                scope = universe
+                for other, bm in masks.items():
+                    if other != facet:
+                        scope &= bm
+                rows = []
+                for value, bm in self._bitmaps[facet].items():
+                    if scope is self._all:
+                        # nothing narrows this facet: reuse the cached catalog-wide count
+                        count = self._popcounts.get((facet, value))
+                        if count is None:
+                            count = self._popcounts[(facet, value)] = bm.bit_count()
+                    else:
+                        count = (scope & bm).bit_count()
+                    rows.append({
+                        'value': value,
+                        'label': self._label(facet, value),
+                        'count': count,
+                        'selected': str(value) in {str(v) for v in selections.get(facet, ())},
+                    })
+                out[facet] = self._sorted(facet, rows)
+            return out
+
+    @staticmethod
+    def _key(facet, value):
+        if facet == 'category':
+            return int(value)
+        return value
+
+    def _label(self, facet, value):
+        if facet == 'category':
+            return self._labels['category'].get(value, str(value))
+        if facet == 'price':
+            return next(label for key, label, _, _ in PRICE_BANDS if key == value)
+        if facet == 'in_stock':
+            return 'In stock only'
+        return str(value).title()
+
+    @staticmethod
+    def _sorted(facet, rows):
+        if facet == 'price':
+            order = [key for key, _, _, _ in PRICE_BANDS]
+            return sorted(rows, key=lambda r: order.index(r['value']))
+        if facet == 'size':
+            # numeric sizes (32, 34, 9, 10) in number order, letter sizes after
+            return sorted(rows, key=lambda r: (not r['value'].isdigit(),
+                                               int(r['value']) if r['value'].isdigit() else 0,
+                                               r['value']))
+        return sorted(rows, key=lambda r: str(r['label']))
+
+
+_index = FacetIndex()
+
+
+@on_catalog_refresh
+def _sync_index(snapshot, changed_ids):
+    if changed_ids is None:
+        _index.rebuild(snapshot.products.values())
+        return
+    for pid in changed_ids:
+        product = snapshot.get(pid)
+        if product is None:
+            _index.remove(pid)
+        else:
+            _index.upsert(product)
+
+
+def facet_counts(selected, category_id=None, product_ids=None):
+    base = None if product_ids is None else _index.bitmap_for(product_ids)
+    fixed = {'category': {category_id}} if category_id else None
+    return _index.counts(selected, base=base, fixed=fixed)
@@ -0,0 +1,94 @@
+import time
+import hashlib
+from functools import wraps
+from datetime import datetime, timezone
+
+from flask import request, session, current_app, make_response
+
+from catalog import get_catalog
+from carts import guest_cart_tag
+
+
+# --------------------------
+# User-state version
+# --------------------------
+def bump_user_state():
+    # Call on every cart/wishlist change so cached counts/ids revalidate
+    session['state_v'] = session.get('state_v', 0) + 1
+
+
+def user_state_tag():
+    """Validator part for the logged-in user's cart/wishlist state.
+
+    The version lives in the session cookie, so it works across workers
+    without a lookup. Changes made from another device or by the payment
+    webhook are picked up when the time bucket rolls over. A guest's cart
+    is entirely in the cookie, so its tag is a hash of the cart itself.
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        return guest_cart_tag() or 'anon'
+    bucket = int(time.time() // current_app.config.get('USER_STATE_ETAG_TTL', 60))
+    return f"u{user_id}.{session.get('state_v', 0)}.{bucket}"
+
+
+# --------------------------
+# Conditional responses
+# --------------------------
+def _http_date(ts):
+    return datetime.fromtimestamp(int(ts), tz=timezone.utc)
+
+
+def conditional(catalog=True, user=True):
+    """Answer If-None-Match / If-Modified-Since with 304 before the view runs.
+
+    catalog: the response depends on catalog data (validator = snapshot fingerprint)
+    user:    the response depends on who is logged in and their cart/wishlist
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Pending flash messages are rendered once, so never short-circuit them
+            if '_flashes' in session:
+                return view(*args, **kwargs)
+
+            parts = [request.path]
+            last_modified = None
+            if catalog:
+                snapshot = get_catalog()
+                parts.append(f'{snapshot.fingerprint:x}')
+                last_modified = _http_date(snapshot.last_modified)
+            personalized = user and ('user_id' in session or guest_cart_tag() is not None)
+            if user:
+                parts.append(user_state_tag())
+            etag = hashlib.blake2b('|'.join(parts).encode(), digest_size=12).hexdigest()
+
+            # Last-Modified says nothing about user state, so only offer it anonymously
+            if personalized:
+                last_modified = None
+                cache_control = 'private, no-cache'
+            else:
+                max_age = current_app.config.get('HTTP_CACHE_MAX_AGE', 60)
+                cache_control = f'public, max-age={max_age}'
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = bool(last_modified and request.if_modified_since
+                                    and request.if_modified_since >= last_modified)
+
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            response.headers['Cache-Control'] = cache_control
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,195 @@
+import os
+import re
+import json
+import logging
+
+from background import periodic_background
+
+logger = logging.getLogger('snapcart.lexicon')
+
+# --- Normalization helpers ---
+def normalize_text(s):
+    if not s:
+        return ""
+    s = s.lower()
+    # remove punctuation except spaces
+    s = re.sub(r'[^\w\s]', ' ', s)
+    s = re.sub(r'\s+', ' ', s).strip()
+    return s
+
+# synonyms for product types -> normalized type key
+TYPE_SYNONYMS = {
+    'jacket': ['jacket', 'leather jacket', 'denim jacket', 'blazer'],
+    'shirt': ['shirt', 'tshirt', 'tee', 'white shirt', 'formal shirt', 'casual shirt'],
+    'pant': ['pant','pants','jeans','trouser','trousers','chinos'],
+    'shoe': ['shoe','shoes','sneakers','formal shoes','canvas shoes','loafers','running shoes'],
+    'belt': ['belt'],
+    'accessory': ['wallet','watch','sunglasses','backpack','bag','belt'],
+    'electronics': ['earbuds','smart watch','speaker','laptop bag','usb','headphones'],
+}
+
+# invert synonyms for quick lookup (word -> canonical type)
+TYPE_MAP = {}
+for canon, words in TYPE_SYNONYMS.items():
+    for w in words:
+        TYPE_MAP[normalize_text(w)] = canon
+
+# colors mapping / fuzzy groups
+COLOR_MAP = {
+    'black': ['black', 'jet black', 'charcoal', 'ebony'],
+    'white': ['white', 'off white', 'ivory', 'cream'],
+    'blue': ['blue', 'navy', 'royal blue', 'azure', 'sky'],
+    'brown': ['brown','tan','camel'],
+    'grey': ['grey','gray','slate'],
+    'silver': ['silver','steel'],
+    'red': ['red','maroon','burgundy'],
+    'green': ['green','olive'],
+}
+
+# invert color map
+COLOR_KEY = {}
+for k,v in COLOR_MAP.items():
+    for w in v:
+        COLOR_KEY[normalize_text(w)] = k
+
+# --------------------------
+# Phrase matchers
+# --------------------------
+class LexiconMatcher:
+    """Aho-Corasick automaton over a synonym table (normalized key -> canonical).
+
+    find() returns the canonical value for the longest key occurring anywhere
+    in the text, ties going to the key that came first in the table. That is
+    what sorting keys by length and testing each one as a substring gave,
+    but done in one pass over the text whatever the table size.
+    """
+
+    def __init__(self, mapping):
+        self.size = len(mapping)
+        goto = [{}]
+        best = [None]           # (-len, order, canonical) of the best key ending here
+        for order, (key, canon) in enumerate(mapping.items()):
+            if not key:
+                continue
+            node = 0
+            for ch in key:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    best.append(None)
+                node = nxt
+            candidate = (-len(key), order, canon)
+            if best[node] is None or candidate < best[node]:
+                best[node] = candidate
+
+        # Breadth-first failure links; each node also inherits the best key
+        # that ends at its longest proper suffix
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        while queue:
+            next_queue = []
+            for node in queue:
+                for ch, child in goto[node].items():
+                    f = fail[node]
+                    while f and ch not in goto[f]:
+                        f = fail[f]
+                    fail[child] = goto[f].get(ch, 0)
+                    inherited = best[fail[child]]
+                    if inherited is not None and (best[child] is None or inherited < best[child]):
+                        best[child] = inherited
+                    next_queue.append(child)
+            queue = next_queue
+        self._goto = goto
+        self._fail = fail
+        self._best = best
+
+    def find(self, text):
+        goto, fail, best = self._goto, self._fail, self._best
+        node = 0
+        found = None
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            hit = best[node]
+            if hit is not None and (found is None or hit < found):
+                found = hit
+        return found[2] if found else None
+
+
+_type_matcher = LexiconMatcher(TYPE_MAP)
+_color_matcher = LexiconMatcher(COLOR_KEY)
+
+
+def canonical_type_from_phrase(phrase):
+    # longest synonym found anywhere in the phrase
+    return _type_matcher.find(normalize_text(phrase))
+
+def canonical_color_from_phrase(phrase):
+    return _color_matcher.find(normalize_text(phrase))
+
+
+# --------------------------
+# Extended synonym file (hot reload)
+# --------------------------
+# JSON: {"types": {"shirt": ["kurta", ...]}, "colors": {"blue": ["teal", ...]}}
+# Entries extend the built-in tables for phrase matching. Only existing
+# canonical types/colors are accepted, since product scoring and search
+# are built around that fixed set.
+_loaded = {'mtime': None}
+
+
+def build_matchers(extra):
+    type_map = dict(TYPE_MAP)
+    color_key = dict(COLOR_KEY)
+    for section, table, known in (('types', type_map, TYPE_SYNONYMS), ('colors', color_key, COLOR_MAP)):
+        for canon, words in (extra.get(section) or {}).items():
+            if canon not in known:
+                logger.warning("lexicon: ignoring unknown %s %r", section[:-1], canon)
+                continue
+            for w in words:
+                key = normalize_text(w)
+                # built-in entries keep their meaning
+                if key and key not in table:
+                    table[key] = canon
+    return LexiconMatcher(type_map), LexiconMatcher(color_key)
+
+
+def load_lexicon_file(path):
+    """Build matchers from `path` and swap them in; requests keep using the old ones meanwhile."""
+    global _type_matcher, _color_matcher
+    with open(path, encoding='utf-8') as f:
+        extra = json.load(f)
+    type_matcher, color_matcher = build_matchers(extra)
+    _type_matcher, _color_matcher = type_matcher, color_matcher
+    logger.info("lexicon: loaded %s (%d type keys, %d color keys)",
+                path, type_matcher.size, color_matcher.size)
+
+
+def reload_if_changed(path):
+    """Reload the synonym file if its mtime changed since the last load."""
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return
+    if mtime == _loaded['mtime']:
+        return
+    # don't retry a broken file until it changes again
+    _loaded['mtime'] = mtime
+    try:
+        load_lexicon_file(path)
+    except Exception:
+        logger.exception("lexicon: failed to load %s, keeping the current tables", path)
+
+
+def init_app(app):
+    path = app.config.get('LEXICON_FILE')
+    if not path:
+        return
+    if os.path.exists(path):
+        _loaded['mtime'] = os.stat(path).st_mtime
+        load_lexicon_file(path)
+    periodic_background(app, 'lexicon-reload', app.config.get('LEXICON_RELOAD_INTERVAL', 30),
+                        lambda app: reload_if_changed(path))
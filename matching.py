@@ -0,0 +1,217 @@
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+from catalog import get_catalog, on_catalog_refresh
+from lexicon import (normalize_text, TYPE_SYNONYMS, TYPE_MAP, COLOR_MAP, COLOR_KEY,
+                     canonical_type_from_phrase, canonical_color_from_phrase)
+
+# Column order of the feature arrays; index len(...) stands for "none"
+TYPES = list(TYPE_SYNONYMS)
+COLORS = list(COLOR_MAP)
+NO_TYPE = len(TYPES)
+NO_COLOR = len(COLORS)
+
+
+# --------------------------
+# Precomputed product features
+# --------------------------
+@lru_cache(maxsize=65536)
+def _name_features(name):
+    # (type from name, canonical types mentioned, color words per canonical color)
+    name = normalize_text(name)
+    name_type = next((TYPE_MAP[key] for key in TYPE_MAP if key in name), None)
+    mentions = tuple(t in name for t in TYPES)
+    color_hits = [0] * len(COLORS)
+    for cword, canon in COLOR_KEY.items():
+        if cword in name:
+            color_hits[COLORS.index(canon)] += 1
+    return name_type, mentions, tuple(color_hits)
+
+
+@lru_cache(maxsize=4096)
+def _category_type(category):
+    category = normalize_text(category)
+    return next((TYPE_MAP[key] for key in TYPE_MAP if key in category), None)
+
+
+def product_features(product):
+    """One row of the feature table, precomputing what the scorer derives per call."""
+    name_type, mentions, color_hits = _name_features(product.get('name') or '')
+    category_type = _category_type(product.get('category_name') or str(product.get('category_id') or ''))
+    # a type found in the category name wins over one found in the product name
+    prod_type = category_type or name_type
+    color = COLOR_KEY.get(normalize_text(product.get('color') or ''))
+    try:
+        in_stock = int(product.get('stock', 0)) > 0
+    except (TypeError, ValueError):
+        in_stock = False
+    return (TYPES.index(prod_type) if prod_type else NO_TYPE,
+            COLORS.index(color) if color else NO_COLOR,
+            in_stock, mentions, color_hits)
+
+
+class ProductMatrix:
+    """Per-product canonical type, color and stock as NumPy arrays.
+
+    Scoring a batch of requests is then array arithmetic over every product
+    at once instead of one Python scoring call per pair.
+    """
+
+    def __init__(self, products=()):
+        self._lock = threading.Lock()
+        self.rebuild(products)
+
+    def rebuild(self, products):
+        products = list(products)
+        features = [product_features(p) for p in products]
+        n = len(products)
+        with self._lock:
+            self.products = products
+            self.row = {p['id']: i for i, p in enumerate(products)}
+            self.live = np.ones(n, dtype=bool)
+            self.type = np.fromiter((f[0] for f in features), dtype=np.int8, count=n)
+            self.color = np.fromiter((f[1] for f in features), dtype=np.int8, count=n)
+            self.in_stock = np.fromiter((f[2] for f in features), dtype=bool, count=n)
+            # feature-major so picking one type/color is a contiguous row; the
+            # extra row keeps the "no type"/"no color" index in range
+            self.mentions = np.zeros((len(TYPES) + 1, n), dtype=bool)
+            self.color_hits = np.zeros((len(COLORS) + 1, n), dtype=np.int8)
+            if n:
+                self.mentions[:len(TYPES)] = np.array([f[3] for f in features], dtype=bool).T
+                self.color_hits[:len(COLORS)] = np.array([f[4] for f in features], dtype=np.int8).T
+
+    def update(self, snapshot, changed_ids):
+        appended = []
+        with self._lock:
+            for pid in changed_ids:
+                product = snapshot.get(pid)
+                i = self.row.get(pid)
+                if product is None:
+                    if i is not None:
+                        self.live[i] = False
+                    continue
+                if i is None:
+                    appended.append(product)
+                    continue
+                self._set_row(i, product)
+            if appended:
+                self._append(appended)
+
+    def _set_row(self, i, product):
+        type_idx, color_idx, in_stock, mentions, color_hits = product_features(product)
+        self.products[i] = product
+        self.live[i] = True
+        self.type[i] = type_idx
+        self.color[i] = color_idx
+        self.in_stock[i] = in_stock
+        self.mentions[:len(TYPES), i] = mentions
+        self.color_hits[:len(COLORS), i] = color_hits
+
+    def _append(self, products):
+        start, k = len(self.products), len(products)
+        self.products.extend(products)
+        self.live = np.concatenate([self.live, np.ones(k, dtype=bool)])
+        self.type = np.concatenate([self.type, np.zeros(k, dtype=np.int8)])
+        self.color = np.concatenate([self.color, np.zeros(k, dtype=np.int8)])
+        self.in_stock = np.concatenate([self.in_stock, np.zeros(k, dtype=bool)])
+        self.mentions = np.hstack([self.mentions, np.zeros((self.mentions.shape[0], k), dtype=bool)])
+        self.color_hits = np.hstack([self.color_hits, np.zeros((self.color_hits.shape[0], k), dtype=np.int8)])
+        for offset, product in enumerate(products):
+            self.row[product['id']] = start + offset
+            self._set_row(start + offset, product)
+
+    def scores(self, req_types, req_colors):
+        """(requests x products) int16 score matrix.
+
+        Type: 3 when the product's type is the requested one, else 2 when
+        the type word is in the name. Color: 2 for the product's own color,
+        else 1 per color word in the name. Plus 1 when in stock. Built in
+        place in small dtypes, so a call allocates a few bytes per cell.
+        """
+        rt = np.asarray(req_types, dtype=np.int8)
+        rc = np.asarray(req_colors, dtype=np.int8)
+        # a request without a type points at the always-false extra row
+        score = self.mentions[rt].astype(np.int16)
+        score *= 2
+        np.copyto(score, 3, where=self.type[None, :] == rt[:, None])
+        color = self.color_hits[rc]          # int8 copy, zero in the "no color" row
+        np.copyto(color, 2, where=self.color[None, :] == rc[:, None])
+        color[rc == NO_COLOR] = 0
+        np.add(score, color, out=score)
+        np.add(score, self.in_stock, out=score)
+        return score
+
+    def assign(self, req_types, req_colors, chunk=64):
+        """Best product per request, in request order, never reusing a product.
+
+        Returns [(product or None, score)]. The product rows are read under
+        the same lock as the scores, so a concurrent rebuild cannot swap
+        them in between. Requests are scored `chunk` at a time to bound
+        memory on large catalogs.
+        """
+        with self._lock:
+            available = self.live.copy()
+            out = []
+            for lo in range(0, len(req_types), chunk):
+                score = self.scores(req_types[lo:lo + chunk], req_colors[lo:lo + chunk])
+                score[:, ~available] = -1
+                for r in range(score.shape[0]):
+                    best = int(np.argmax(score[r])) if score.shape[1] else None
+                    # strict pass wants >= 3, the permissive fallback >= 1,
+                    # and both pick the same product, so one pass is enough
+                    if best is None or score[r, best] < 1:
+                        out.append((None, 0))
+                        continue
+                    out.append((self.products[best], int(score[r, best])))
+                    available[best] = False
+                    score[r + 1:, best] = -1
+            return out
+
+
+_matrix = ProductMatrix()
+
+
+@on_catalog_refresh
+def _sync_matrix(snapshot, changed_ids):
+    if changed_ids is None:
+        _matrix.rebuild(snapshot.products.values())
+    else:
+        _matrix.update(snapshot, changed_ids)
+
+
+def parse_request_phrase(phrase):
+    norm = normalize_text(phrase)
+    color = canonical_color_from_phrase(norm)
+    rtype = canonical_type_from_phrase(norm)
+    # if no explicit type but phrase contains 'shirt' in plural etc, try tokens
+    if not rtype:
+        for token in norm.split():
+            if token in TYPE_MAP:
+                rtype = TYPE_MAP[token]
+                break
+    return {'phrase': phrase, 'type': rtype, 'color': color}
+
+
+def find_best_products_for_requests(db_conn, requested_phrases, products_cache=None):
+    """
+    requested_phrases: list of strings like "1 white shirt", "1 black pant"
+    returns: list of matched product dicts (best per request)
+    """
+    requests = [parse_request_phrase(phrase) for phrase in requested_phrases]
+
+    # Score against the catalog-synced matrix unless a product list is given
+    if products_cache:
+        matrix = ProductMatrix(products_cache)
+    else:
+        get_catalog()
+        matrix = _matrix
+
+    req_types = [TYPES.index(r['type']) if r['type'] else NO_TYPE for r in requests]
+    req_colors = [COLORS.index(r['color']) if r['color'] else NO_COLOR for r in requests]
+    results = []
+    for req, (product, score) in zip(requests, matrix.assign(req_types, req_colors)):
+        # no match found: product None so UI can show missing item
+        results.append({'request': req, 'product': product, 'score': score})
+    return results
@@ -0,0 +1,174 @@
+import hmac
+import time
+import bisect
+import logging
+import threading
+
+from flask import g, request, current_app, has_request_context, Response, abort
+
+logger = logging.getLogger('snapcart.db')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, label='route'):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label = label          # name of the one label the series are keyed by
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # one slot per bucket plus +Inf, then sum and count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {r: (list(s[0]), s[1], s[2]) for r, s in self._series.items()}
+        for key in sorted(snapshot):
+            counts, total, n = snapshot[key]
+            label = f'{self.label}="{key}"'
+            running = 0
+            for le, c in zip(self.buckets, counts):
+                running += c
+                lines.append(f'{self.name}_bucket{{{label},le="{le:g}"}} {running}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {n}')
+            lines.append(f'{self.name}_sum{{{label}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{label}}} {n}')
+        return lines
+
+
+REQUEST_LATENCY = Histogram('snapcart_request_duration_seconds',
+                            'Request latency by route.', LATENCY_BUCKETS)
+REQUEST_DB_TIME = Histogram('snapcart_request_db_seconds',
+                            'Total time spent in SQL statements per request.', LATENCY_BUCKETS)
+REQUEST_QUERIES = Histogram('snapcart_request_queries',
+                            'Number of SQL statements executed per request.', QUERY_COUNT_BUCKETS)
+
+_extra_collectors = []
+
+
+def register_collector(fn):
+    # fn() returns a list of Prometheus text lines appended to /internal/metrics
+    _extra_collectors.append(fn)
+    return fn
+
+
+# --------------------------
+# Per-request query stats
+# --------------------------
+def _route_name():
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    return 'background'
+
+
+def record_query(statement, duration):
+    threshold = current_app.config.get('SLOW_QUERY_THRESHOLD_MS', 200) / 1000.0
+    if duration >= threshold:
+        logger.warning("slow query route=%s time=%.1fms sql=%s",
+                       _route_name(), duration * 1000, ' '.join(str(statement).split())[:500])
+
+    if not has_request_context():
+        return
+    stats = g.setdefault('query_stats', {'count': 0, 'time': 0.0, 'slowest': []})
+    stats['count'] += 1
+    stats['time'] += duration
+    keep = current_app.config.get('METRICS_SLOWEST_KEEP', 3)
+    slowest = stats['slowest']
+    slowest.append((duration, str(statement)))
+    slowest.sort(key=lambda x: -x[0])
+    del slowest[keep:]
+
+
+def get_query_stats():
+    return g.get('query_stats', {'count': 0, 'time': 0.0, 'slowest': []})
+
+
+class InstrumentedCursor:
+    """Cursor proxy that times every execute/executemany call."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, operation, params=None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, params, *args, **kwargs)
+        finally:
+            record_query(operation, time.perf_counter() - start)
+
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, seq_params, *args, **kwargs)
+        finally:
+            record_query(operation, time.perf_counter() - start)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+# --------------------------
+# Request hooks + endpoint
+# --------------------------
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+
+def _observe_request(exc=None):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    route = _route_name()
+    stats = get_query_stats()
+    REQUEST_LATENCY.observe(route, time.perf_counter() - started)
+    REQUEST_DB_TIME.observe(route, stats['time'])
+    REQUEST_QUERIES.observe(route, stats['count'])
+    threshold = current_app.config.get('SLOW_QUERY_THRESHOLD_MS', 200)
+    if stats['slowest'] and stats['time'] * 1000 >= threshold:
+        logger.info("route=%s queries=%d db_time=%.1fms slowest=%s", route, stats['count'],
+                    stats['time'] * 1000,
+                    [(round(d * 1000, 1), ' '.join(s.split())[:120]) for d, s in stats['slowest']])
+
+
+def _metrics_allowed():
+    # Behind a reverse proxy every request comes from the proxy's address, so
+    # when a token is configured it is the only thing that grants access
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        auth = request.headers.get('Authorization', '')
+        return hmac.compare_digest(auth.encode(), f'Bearer {token}'.encode())
+    allowed = current_app.config.get('METRICS_ALLOWED_IPS', ('127.0.0.1', '::1'))
+    return not allowed or request.remote_addr in allowed
+
+
+def metrics_endpoint():
+    if not _metrics_allowed():
+        abort(404)
+    lines = []
+    for hist in (REQUEST_LATENCY, REQUEST_DB_TIME, REQUEST_QUERIES):
+        lines.extend(hist.render())
+    for collector in _extra_collectors:
+        lines.extend(collector())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    app.before_request(_start_timer)
+    app.teardown_request(_observe_request)
+    app.add_url_rule('/internal/metrics', 'internal_metrics', metrics_endpoint)
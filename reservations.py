@@ -0,0 +1,149 @@
+import logging
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from db import pooled_connection
+from background import periodic_background
+from catalog import invalidate_products
+
+logger = logging.getLogger('snapcart.reservations')
+
+# orders.reservation_status
+NONE = 'none'            # orders from before reservations; stock moves on payment
+HELD = 'held'            # stock taken at checkout, waiting for payment until reserved_until
+COMMITTED = 'committed'  # paid; the held stock is sold
+RELEASED = 'released'    # hold expired, stock returned
+
+
+# --------------------------
+# Holding and releasing stock
+# --------------------------
+def reserve_stock(cursor, quantities):
+    """Take {product_id: qty} out of stock with one conditional UPDATE.
+
+    Rows are locked in primary-key order by a single statement, so
+    concurrent checkouts queue on the hot rows instead of deadlocking.
+    Returns False if any product did not have enough stock; the caller
+    must roll back in that case.
+    """
+    ids = sorted(quantities)
+    cases = ' '.join(['WHEN %s THEN %s'] * len(ids))
+    case_params = [v for pid in ids for v in (pid, quantities[pid])]
+    placeholders = ', '.join(['%s'] * len(ids))
+    cursor.execute(f"""
+        UPDATE products
+        SET stock = stock - CASE id {cases} END
+        WHERE id IN ({placeholders}) AND stock >= CASE id {cases} END
+    """, case_params + ids + case_params)
+    return cursor.rowcount == len(ids)
+
+
+def reservation_deadline():
+    return datetime.now() + timedelta(minutes=current_app.config.get('ORDER_RESERVATION_MINUTES', 15))
+
+
+def extend_hold(cursor, order_id):
+    """Give a held order a fresh payment window, e.g. once the buyer reaches the gateway."""
+    cursor.execute("UPDATE orders SET reserved_until = %s WHERE id = %s AND reservation_status = %s",
+                   (reservation_deadline(), order_id, HELD))
+
+
+def order_quantities(cursor, order_id):
+    cursor.execute("SELECT product_id, quantity FROM order_items WHERE order_id = %s", (order_id,))
+    quantities = {}
+    for row in cursor.fetchall():
+        quantities[row['product_id']] = quantities.get(row['product_id'], 0) + row['quantity']
+    return quantities
+
+
+def release_orders(cursor, order_ids):
+    """Return the held stock of orders the caller has locked. Returns the product ids touched."""
+    placeholders = ', '.join(['%s'] * len(order_ids))
+    cursor.execute(f"SELECT DISTINCT product_id FROM order_items WHERE order_id IN ({placeholders})",
+                   order_ids)
+    product_ids = [row['product_id'] for row in cursor.fetchall()]
+    cursor.execute(f"""
+        UPDATE products p
+        JOIN (SELECT product_id, SUM(quantity) AS quantity
+              FROM order_items
+              WHERE order_id IN ({placeholders})
+              GROUP BY product_id) r ON r.product_id = p.id
+        SET p.stock = p.stock + r.quantity
+    """, order_ids)
+    cursor.execute(f"""
+        UPDATE orders
+        SET reservation_status = %s, reserved_until = NULL, status = 'expired'
+        WHERE id IN ({placeholders})
+    """, [RELEASED, *order_ids])
+    return product_ids
+
+
+def take_order_stock(cursor, order_id):
+    """Take an order's stock at payment time, for orders without a live hold.
+
+    Same all-or-nothing UPDATE as checkout, inside a savepoint so a short
+    product leaves stock untouched without undoing the caller's other
+    work. Returns the product ids touched, or None if the stock is no
+    longer there (the order must then be refunded or reviewed; stock is
+    never clamped to zero).
+    """
+    quantities = order_quantities(cursor, order_id)
+    if not quantities:
+        return []
+    cursor.execute("SAVEPOINT take_order_stock")
+    if not reserve_stock(cursor, quantities):
+        cursor.execute("ROLLBACK TO SAVEPOINT take_order_stock")
+        return None
+    cursor.execute("RELEASE SAVEPOINT take_order_stock")
+    return list(quantities)
+
+
+def release_expired(cursor, limit=200):
+    """Release holds whose payment never completed, at most `limit` orders.
+
+    SKIP LOCKED leaves orders a webhook is settling right now to the next
+    sweep, and lets several workers sweep at once without waiting.
+    """
+    cursor.execute("""
+        SELECT id FROM orders
+        WHERE reservation_status = %s AND reserved_until < %s
+        ORDER BY reserved_until
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    """, (HELD, datetime.now(), limit))
+    order_ids = [row['id'] for row in cursor.fetchall()]
+    if not order_ids:
+        return [], []
+    return order_ids, release_orders(cursor, order_ids)
+
+
+# --------------------------
+# Background sweep
+# --------------------------
+def sweep_expired(app):
+    """Release every expired hold, in batches. Returns the number of orders released."""
+    released = 0
+    with pooled_connection(app) as conn:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            while True:
+                order_ids, product_ids = release_expired(cursor)
+                conn.commit()
+                if not order_ids:
+                    break
+                released += len(order_ids)
+                invalidate_products(product_ids)
+        finally:
+            cursor.close()
+    return released
+
+
+def _sweep(app):
+    released = sweep_expired(app)
+    if released:
+        logger.info("reservations: released %d expired orders", released)
+
+
+def init_app(app):
+    periodic_background(app, 'reservation-sweep', app.config.get('RESERVATION_SWEEP_INTERVAL', 60), _sweep)
@@ -0,0 +1,214 @@
+import time
+import logging
+from datetime import datetime, timedelta
+
+from db import pooled_connection
+import reservations
+
+logger = logging.getLogger('snapcart.retention')
+
+# Hot table -> archive table columns. Archive tables have no foreign keys
+# and no AUTO_INCREMENT, so rows keep their original ids.
+ORDER_COLUMNS = ('id, user_id, total_amount, status, created_at, payment_id, payment_status, '
+                 'reservation_status, reserved_until')
+ORDER_ITEM_COLUMNS = 'id, order_id, product_id, quantity, price'
+PAYMENT_COLUMNS = ('id, order_id, amount, currency, status, method, provider_txn_id, meta_json, '
+                   'created_at, updated_at')
+PAYMENT_EVENT_COLUMNS = 'id, payment_id, event_type, payload_json, created_at'
+
+ARCHIVE_TABLES = ('orders_archive', 'order_items_archive', 'payments_archive', 'payment_events_archive')
+
+
+def _ids(cursor):
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _in(ids):
+    return ', '.join(['%s'] * len(ids))
+
+
+# --------------------------
+# One batch each
+# --------------------------
+def _move_events(cursor, event_ids):
+    events_in = _in(event_ids)
+    cursor.execute(f"""
+        INSERT INTO payment_events_archive ({PAYMENT_EVENT_COLUMNS})
+        SELECT {PAYMENT_EVENT_COLUMNS} FROM payment_events WHERE id IN ({events_in})
+    """, event_ids)
+    cursor.execute(f"DELETE FROM payment_events WHERE id IN ({events_in})", event_ids)
+    return len(event_ids)
+
+
+def archive_order_events(cursor, cutoff, limit):
+    """Move up to `limit` payment events of orders created before cutoff.
+
+    Run before archive_orders, so an order with a long event history is
+    moved over several transactions rather than in one. Returns the
+    number moved.
+    """
+    cursor.execute("""
+        SELECT e.id FROM payment_events e
+        JOIN payments p ON p.id = e.payment_id
+        JOIN orders o ON o.id = p.order_id
+        WHERE o.created_at < %s AND o.reservation_status <> %s
+        ORDER BY e.id
+        LIMIT %s
+        FOR UPDATE OF e SKIP LOCKED
+    """, (cutoff, reservations.HELD, limit))
+    event_ids = _ids(cursor)
+    return _move_events(cursor, event_ids) if event_ids else 0
+
+
+def archive_orders(cursor, cutoff, limit):
+    """Move up to `limit` orders created before cutoff, with their items,
+    payments and payment events, into the archive tables.
+
+    Orders still holding stock are left alone. The batch is trimmed so it
+    moves at most `limit` payment events too (archive_order_events has
+    normally moved them already). Returns the number of orders moved.
+    """
+    # created_at, id is the order of idx_orders_created, so LIMIT stops on the index
+    cursor.execute("""
+        SELECT id FROM orders
+        WHERE created_at < %s AND reservation_status <> %s
+        ORDER BY created_at, id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    """, (cutoff, reservations.HELD, limit))
+    order_ids = _ids(cursor)
+    if not order_ids:
+        return 0
+
+    # Events still attached (written since the event pass): keep the batch under the cap
+    cursor.execute(f"""
+        SELECT p.order_id, COUNT(*) FROM payment_events e
+        JOIN payments p ON p.id = e.payment_id
+        WHERE p.order_id IN ({_in(order_ids)})
+        GROUP BY p.order_id
+    """, order_ids)
+    event_counts = dict(cursor.fetchall())
+    kept, events = [], 0
+    for order_id in order_ids:
+        events += event_counts.get(order_id, 0)
+        if kept and events > limit:
+            break
+        kept.append(order_id)
+    order_ids = kept
+
+    orders_in = _in(order_ids)
+    cursor.execute(f"SELECT id FROM payments WHERE order_id IN ({orders_in}) FOR UPDATE", order_ids)
+    payment_ids = _ids(cursor)
+
+    if payment_ids:
+        payments_in = _in(payment_ids)
+        cursor.execute(f"""
+            INSERT INTO payment_events_archive ({PAYMENT_EVENT_COLUMNS})
+            SELECT {PAYMENT_EVENT_COLUMNS} FROM payment_events WHERE payment_id IN ({payments_in})
+        """, payment_ids)
+        cursor.execute(f"DELETE FROM payment_events WHERE payment_id IN ({payments_in})", payment_ids)
+        # Idempotency guards of settled payments: a redelivery now finds no payment at all
+        cursor.execute(f"DELETE FROM webhook_events WHERE payment_id IN ({payments_in})", payment_ids)
+    cursor.execute(f"""
+        INSERT INTO payments_archive ({PAYMENT_COLUMNS})
+        SELECT {PAYMENT_COLUMNS} FROM payments WHERE order_id IN ({orders_in})
+    """, order_ids)
+    cursor.execute(f"""
+        INSERT INTO order_items_archive ({ORDER_ITEM_COLUMNS})
+        SELECT {ORDER_ITEM_COLUMNS} FROM order_items WHERE order_id IN ({orders_in})
+    """, order_ids)
+    cursor.execute(f"""
+        INSERT INTO orders_archive ({ORDER_COLUMNS})
+        SELECT {ORDER_COLUMNS} FROM orders WHERE id IN ({orders_in})
+    """, order_ids)
+    # Children first, so nothing depends on ON DELETE CASCADE
+    for table, column in (('order_fulfilments', 'order_id'), ('payments', 'order_id'),
+                          ('order_items', 'order_id'), ('orders', 'id')):
+        cursor.execute(f"DELETE FROM {table} WHERE {column} IN ({orders_in})", order_ids)
+    return len(order_ids)
+
+
+def archive_payment_events(cursor, cutoff, limit):
+    """Move up to `limit` payment events created before cutoff. Returns the number moved."""
+    # (created_at, id) is the order of idx_payment_events_created
+    cursor.execute("""
+        SELECT id FROM payment_events
+        WHERE created_at < %s
+        ORDER BY created_at, id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    """, (cutoff, limit))
+    event_ids = _ids(cursor)
+    return _move_events(cursor, event_ids) if event_ids else 0
+
+
+def purge_archive(cursor, table, cutoff, limit):
+    """Delete up to `limit` rows archived before cutoff. Returns the number deleted."""
+    cursor.execute(f"""
+        SELECT id FROM {table}
+        WHERE archived_at < %s
+        ORDER BY archived_at, id
+        LIMIT %s
+    """, (cutoff, limit))
+    ids = _ids(cursor)
+    if ids:
+        cursor.execute(f"DELETE FROM {table} WHERE id IN ({_in(ids)})", ids)
+    return len(ids)
+
+
+# --------------------------
+# Retention run
+# --------------------------
+def _cutoff(days):
+    return datetime.now() - timedelta(days=days)
+
+
+def _in_batches(conn, cursor, step, pause):
+    # One short transaction per batch so row locks and undo stay small
+    total = 0
+    while True:
+        try:
+            moved = step(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if not moved:
+            return total
+        total += moved
+        if pause:
+            time.sleep(pause)
+
+
+def apply_retention(app):
+    """Archive orders and payment events past their retention period,
+    then purge archive rows past theirs (if configured).
+
+    Returns {what: rows} for each step that ran.
+    """
+    cfg = app.config
+    batch = cfg.get('ARCHIVE_BATCH_SIZE', 500)
+    pause = cfg.get('ARCHIVE_BATCH_PAUSE', 0.1)
+    orders_cutoff = _cutoff(cfg.get('ORDERS_RETENTION_DAYS', 365))
+    events_cutoff = _cutoff(cfg.get('PAYMENT_EVENTS_RETENTION_DAYS', 90))
+    archive_days = cfg.get('ARCHIVE_RETENTION_DAYS')
+
+    result = {}
+    with pooled_connection(app) as conn:
+        cursor = conn.cursor()
+        try:
+            result['payment_events'] = _in_batches(
+                conn, cursor, lambda c: archive_payment_events(c, events_cutoff, batch), pause)
+            result['order_payment_events'] = _in_batches(
+                conn, cursor, lambda c: archive_order_events(c, orders_cutoff, batch), pause)
+            result['orders'] = _in_batches(
+                conn, cursor, lambda c: archive_orders(c, orders_cutoff, batch), pause)
+            if archive_days is not None:
+                archive_cutoff = _cutoff(archive_days)
+                for table in ARCHIVE_TABLES:
+                    result[f'{table}_purged'] = _in_batches(
+                        conn, cursor, lambda c: purge_archive(c, table, archive_cutoff, batch), pause)
+        finally:
+            cursor.close()
+    logger.info("retention: %s", result)
+    return result
@@ -0,0 +1,237 @@
+import math
+import heapq
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+from lexicon import normalize_text, TYPE_MAP, COLOR_KEY
+from catalog import get_catalog, on_catalog_refresh
+
+# Field weights: a hit in the name counts more than one in the description
+FIELD_WEIGHTS = {
+    'name': 3.0,
+    'category_name': 1.5,
+    'color': 2.0,
+    'description': 1.0,
+}
+MAX_PHRASE_WORDS = 3
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+@lru_cache(maxsize=65536)
+def stem(token):
+    # Light plural folding so "shirts"/"shirt" and "watches"/"watch" meet
+    if len(token) > 4 and token.endswith(('ches', 'shes', 'sses', 'xes')):
+        return token[:-2]
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+        return token[:-1]
+    return token
+
+
+# first words of multi-word synonyms ("jet" for "jet black"), so most
+# tokens skip the n-gram lookups entirely
+_PHRASE_STARTS = {k.split()[0] for k in list(TYPE_MAP) + list(COLOR_KEY) if ' ' in k}
+_PHRASE_STARTS |= {stem(w) for w in _PHRASE_STARTS}
+
+
+@lru_cache(maxsize=65536)
+def _concepts(words):
+    # canonical type/color terms for a run of words (uses the shared synonym tables)
+    phrase = ' '.join(words)
+    out = []
+    for key in (phrase, ' '.join(stem(w) for w in words)):
+        if key in TYPE_MAP:
+            out.append('type:' + TYPE_MAP[key])
+        if key in COLOR_KEY:
+            out.append('color:' + COLOR_KEY[key])
+    return out
+
+
+def analyze(text):
+    """Split text into one entry per word plus phrase-level bonus terms.
+
+    Each word is (stem, expansions, in_phrase): its stemmed literal term,
+    the canonical type/color terms it maps to, and whether it is part of
+    a multi-word synonym such as "leather jacket" or "jet black". Those
+    phrases add their canonical term as a bonus that raises the score
+    without being required.
+    """
+    tokens = normalize_text(text).split()
+    bonus = set()
+    phrase_words = set()
+    for i, token in enumerate(tokens):
+        if token in _PHRASE_STARTS:
+            for n in range(2, min(MAX_PHRASE_WORDS, len(tokens) - i) + 1):
+                concepts = _concepts(tuple(tokens[i:i + n]))
+                if concepts:
+                    bonus.update(concepts)
+                    phrase_words.update(range(i, i + n))
+    words = [(stem(token), set(_concepts((token,))), i in phrase_words)
+             for i, token in enumerate(tokens)]
+    return words, bonus
+
+
+class ProductSearchIndex:
+    """In-memory inverted index over the product catalog, ranked with BM25."""
+
+    def __init__(self, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._postings = defaultdict(dict)   # term -> {product_id: weighted tf}
+        self._doc_terms = {}                 # product_id -> {term: weighted tf}
+        self._doc_len = {}
+        self._signatures = {}
+        self._total_len = 0.0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._doc_terms)
+
+    @staticmethod
+    def _signature(product):
+        return tuple(product.get(f) for f in FIELD_WEIGHTS)
+
+    @staticmethod
+    def _doc_vector(product):
+        terms = defaultdict(float)
+        for field, weight in FIELD_WEIGHTS.items():
+            words, bonus = analyze(product.get(field) or '')
+            for term in bonus.union(*({literal} | expansions for literal, expansions, _ in words)):
+                terms[term] += weight
+        return terms
+
+    def rebuild(self, products):
+        with self._lock:
+            self._postings = defaultdict(dict)
+            self._doc_terms = {}
+            self._doc_len = {}
+            self._signatures = {}
+            self._total_len = 0.0
+            for product in products:
+                self.upsert(product)
+
+    def upsert(self, product):
+        pid = product['id']
+        sig = self._signature(product)
+        with self._lock:
+            if self._signatures.get(pid) == sig:
+                return
+            self.remove(pid)
+            terms = self._doc_vector(product)
+            for term, tf in terms.items():
+                self._postings[term][pid] = tf
+            self._doc_terms[pid] = terms
+            self._doc_len[pid] = sum(terms.values())
+            self._total_len += self._doc_len[pid]
+            self._signatures[pid] = sig
+
+    def remove(self, product_id):
+        with self._lock:
+            terms = self._doc_terms.pop(product_id, None)
+            if terms is None:
+                return
+            for term in terms:
+                posting = self._postings.get(term)
+                if posting is not None:
+                    posting.pop(product_id, None)
+                    if not posting:
+                        del self._postings[term]
+            self._total_len -= self._doc_len.pop(product_id)
+            self._signatures.pop(product_id, None)
+
+    def search(self, query, limit=None):
+        """Return [(product_id, score)] best first.
+
+        Documents must satisfy every query word. A word matches by its own
+        stem; only a word that occurs nowhere in the catalog falls back to
+        the canonical type/color it maps to ("tee" -> shirts), so "wallet"
+        finds wallets rather than every accessory. A query that matches
+        only through such fallbacks, or that has a word matching nothing
+        at all, is not a hit. Words that only make sense inside a
+        multi-word synonym ("jet" in "jet black") are skipped. If the words
+        never occur together we fall back to documents matching any of them.
+        """
+        words, bonus = analyze(query)
+        if not words:
+            return []
+
+        with self._lock:
+            n_docs = len(self._doc_terms)
+            if not n_docs:
+                return []
+            avg_len = self._total_len / n_docs
+
+            group_docs = []
+            query_terms = set(bonus)
+            literal_hit = False
+            for literal, expansions, in_phrase in words:
+                if literal in self._postings:
+                    group = {literal}
+                    literal_hit = True
+                else:
+                    group = expansions
+                docs = set()
+                for term in group:
+                    docs.update(self._postings.get(term, ()))
+                if docs:
+                    group_docs.append(docs)
+                    query_terms |= group
+                elif not in_phrase:
+                    return []
+            if not literal_hit:
+                return []
+            group_docs.sort(key=len)
+            matched = group_docs[0].intersection(*group_docs[1:])
+            if not matched:
+                matched = set().union(*group_docs)
+
+            scores = defaultdict(float)
+            k1, b = self.k1, self.b
+            doc_len = self._doc_len
+            for term in query_terms:
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+                # walk whichever side is shorter: the posting list or the matched set
+                if len(posting) <= len(matched):
+                    pairs = ((pid, tf) for pid, tf in posting.items() if pid in matched)
+                else:
+                    pairs = ((pid, posting[pid]) for pid in matched if pid in posting)
+                for pid, tf in pairs:
+                    norm = k1 * (1 - b + b * doc_len[pid] / avg_len)
+                    scores[pid] += idf * tf * (k1 + 1) / (tf + norm)
+
+        key = lambda x: (x[1], x[0])  # noqa: E731
+        if limit:
+            return heapq.nlargest(limit, scores.items(), key=key)
+        return sorted(scores.items(), key=key, reverse=True)
+
+
+_index = ProductSearchIndex()
+
+
+@on_catalog_refresh
+def _sync_index(snapshot, changed_ids):
+    if changed_ids is None:
+        _index.rebuild(snapshot.products.values())
+        return
+    for pid in changed_ids:
+        product = snapshot.get(pid)
+        if product is None:
+            _index.remove(pid)
+        else:
+            _index.upsert(product)
+
+
+def search_products(query, limit=None):
+    """Return [(product, score)] best first."""
+    # get_catalog() makes sure the index has caught up with the latest snapshot
+    catalog = get_catalog()
+    results = []
+    for pid, score in _index.search(query, limit):
+        product = catalog.get(pid)
+        if product is not None:
+            results.append((product, score))
+    return results
@@ -16,16 +16,9 @@ function addToCart(productId, quantity = 1) {
     .then(data => {
         if (data.success) {
             showNotification('Product added to cart!', 'success');
-            updateCartBadge();
+            setCartBadge(data.cart_count);
         } else if (data.error) {
-            if (data.error === 'Please login first') {
-                showNotification('Please login to add items to cart', 'warning');
-                setTimeout(() => {
-                    window.location.href = '/auth';
-                }, 1500);
-            } else {
-                showNotification(data.error, 'error');
-            }
+            showNotification(data.error, 'error');
         }
     })
     .catch(error => {
@@ -47,24 +40,6 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 });
 
-// Update cart badge (defined in main.js but can be called from here)
-function updateCartBadge() {
-    fetch('/api/cart/count')
-        .then(response => response.json())
-        .then(data => {
-            const badge = document.getElementById('cart-badge');
-            if (badge) {
-                badge.textContent = data.count || 0;
-                if (data.count > 0) {
-                    badge.style.display = 'inline-block';
-                } else {
-                    badge.style.display = 'none';
-                }
-            }
-        })
-        .catch(error => console.error('Error updating cart badge:', error));
-}
-
 // Show notification function (if not already defined in main.js)
 function showNotification(message, type = 'success') {
     const notification = document.createElement('div');
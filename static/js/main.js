@@ -1,7 +1,9 @@
 // Main JavaScript file for common functionality
 
 document.addEventListener('DOMContentLoaded', function() {
-    updateCartBadge();
+    getNavState()
+        .then(state => setCartBadge(state.cart_count))
+        .catch(error => console.error('Error loading navbar state:', error));
 
     // Virtual basket chips
     document.querySelectorAll('.chip').forEach(chip => {
@@ -74,19 +76,30 @@ function handleHeroSlideshow() {
 
 
 // ===========================
-// Cart Badge
+// Navbar State (cart + wishlist)
 // ===========================
-function updateCartBadge() {
-    fetch('/api/cart/count')
-        .then(response => response.json())
-        .then(data => {
-            const badge = document.getElementById('cart-badge');
-            if (!badge) return;
-
-            badge.textContent = data.count || 0;
-            badge.style.display = data.count > 0 ? 'inline-block' : 'none';
-        })
-        .catch(error => console.error('Error updating cart badge:', error));
+// One request per page for the cart badge, the wishlist badge and the
+// hearts; every script shares the same promise
+let navStatePromise = null;
+
+function getNavState() {
+    if (!navStatePromise) {
+        navStatePromise = fetch('/api/nav-state')
+            .then(response => response.json())
+            .catch(error => {
+                navStatePromise = null;
+                throw error;
+            });
+    }
+    return navStatePromise;
+}
+
+function setCartBadge(count) {
+    const badge = document.getElementById('cart-badge');
+    if (!badge) return;
+
+    badge.textContent = count || 0;
+    badge.style.display = count > 0 ? 'inline-block' : 'none';
 }
 
 
@@ -0,0 +1,133 @@
+// Typeahead for the search boxes and the virtual basket textarea
+// Mark an input with data-typeahead="search" or a textarea with data-typeahead="basket"
+
+(function() {
+    const cache = new Map();
+    const CACHE_SIZE = 200;
+    let controller = null;
+
+    function fetchSuggestions(query) {
+        const key = query.toLowerCase();
+        if (cache.has(key)) return Promise.resolve(cache.get(key));
+
+        // Only the latest keystroke matters
+        if (controller) controller.abort();
+        controller = window.AbortController ? new AbortController() : null;
+
+        return fetch(`/api/typeahead?q=${encodeURIComponent(query)}`, controller ? { signal: controller.signal } : {})
+            .then(response => response.json())
+            .then(data => {
+                cache.set(key, data.suggestions);
+                if (cache.size > CACHE_SIZE) cache.delete(cache.keys().next().value);
+                return data.suggestions;
+            });
+    }
+
+    // In the basket only the item being typed is completed: the text after the
+    // last comma or newline, keeping a leading quantity like "2 " or "1 pair of "
+    function basketFragment(value) {
+        const start = Math.max(value.lastIndexOf(','), value.lastIndexOf('\n')) + 1;
+        const fragment = value.slice(start);
+        const lead = fragment.match(/^\s*(\d+\s*)?(pairs?\s+of\s+)?/i)[0];
+        return { head: value.slice(0, start) + lead, query: fragment.slice(lead.length) };
+    }
+
+    function attach(input) {
+        const mode = input.dataset.typeahead;
+        const list = document.createElement('ul');
+        list.className = 'typeahead-list';
+        list.style.display = 'none';
+        document.body.appendChild(list);
+
+        let items = [];
+        let active = -1;
+        let timer = null;
+
+        function hide() {
+            list.style.display = 'none';
+            active = -1;
+        }
+
+        function render() {
+            if (!items.length) return hide();
+            list.innerHTML = '';
+            items.forEach((item, index) => {
+                const li = document.createElement('li');
+                li.className = 'typeahead-item' + (index === active ? ' typeahead-item--active' : '');
+                li.innerHTML = `<span></span><small class="typeahead-kind">${item.kind}</small>`;
+                li.firstChild.textContent = item.text;
+                // mousedown fires before the input's blur hides the list
+                li.addEventListener('mousedown', e => {
+                    e.preventDefault();
+                    pick(index);
+                });
+                list.appendChild(li);
+            });
+            const rect = input.getBoundingClientRect();
+            list.style.left = `${rect.left + window.scrollX}px`;
+            list.style.top = `${rect.bottom + window.scrollY}px`;
+            list.style.width = `${rect.width}px`;
+            list.style.display = 'block';
+        }
+
+        function pick(index) {
+            const item = items[index];
+            if (!item) return;
+            hide();
+            if (mode === 'basket') {
+                input.value = basketFragment(input.value).head + item.text.toLowerCase();
+                input.focus();
+                return;
+            }
+            input.value = item.text;
+            if (input.form) {
+                input.form.submit();
+            } else {
+                window.location.href = `/products?search=${encodeURIComponent(item.text)}`;
+            }
+        }
+
+        input.setAttribute('autocomplete', 'off');
+
+        input.addEventListener('input', () => {
+            clearTimeout(timer);
+            const query = mode === 'basket' ? basketFragment(input.value).query : input.value;
+            if (!query.trim()) return hide();
+            timer = setTimeout(() => {
+                fetchSuggestions(query)
+                    .then(suggestions => {
+                        items = suggestions;
+                        active = -1;
+                        render();
+                    })
+                    .catch(error => {
+                        if (error.name !== 'AbortError') console.error('Typeahead error:', error);
+                    });
+            }, 80);
+        });
+
+        input.addEventListener('keydown', e => {
+            if (list.style.display === 'none') return;
+            if (e.key === 'ArrowDown') {
+                active = (active + 1) % items.length;
+                render();
+                e.preventDefault();
+            } else if (e.key === 'ArrowUp') {
+                active = (active - 1 + items.length) % items.length;
+                render();
+                e.preventDefault();
+            } else if (e.key === 'Enter' && active >= 0) {
+                e.preventDefault();
+                pick(active);
+            } else if (e.key === 'Escape') {
+                hide();
+            }
+        });
+
+        input.addEventListener('blur', hide);
+    }
+
+    document.addEventListener('DOMContentLoaded', function() {
+        document.querySelectorAll('[data-typeahead]').forEach(attach);
+    });
+})();
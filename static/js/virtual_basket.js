@@ -3,6 +3,7 @@
 document.addEventListener('DOMContentLoaded', function() {
     const parseButton = document.getElementById('parse-basket-btn');
     const basketInput = document.getElementById('basket-input');
+    const budgetInput = document.getElementById('basket-budget');
     const loadingState = document.getElementById('loading-state');
     const resultsSection = document.getElementById('results-section');
     const emptyState = document.getElementById('empty-state');
@@ -21,13 +22,57 @@ document.addEventListener('DOMContentLoaded', function() {
             resultsSection.style.display = 'none';
             emptyState.style.display = 'none';
             
-            // Call API
+            const payload = {
+                text: inputText,
+                max_budget: budgetInput && budgetInput.value ? budgetInput.value : null
+            };
+            
+            const onError = function(error) {
+                console.error('Error:', error);
+                loadingState.style.display = 'none';
+                showNotification('Failed to process your request', 'error');
+                emptyState.style.display = 'block';
+            };
+            
+            // Stream results as they are built; fall back to the one-shot API
+            // where the browser can't read a response body incrementally
+            if (window.ReadableStream && window.TextDecoder) {
+                streamBasket(payload, {
+                    parsed: function(data) {
+                        loadingState.style.display = 'none';
+                        renderParsedItems(data.parsed_items);
+                        if (data.parsed_items.length > 0) {
+                            startSuggestions(true);
+                        } else {
+                            // nothing else is coming for this basket
+                            renderCombos({ combos: [] });
+                            startSuggestions(false);
+                            finishSuggestions(0);
+                        }
+                        resultsSection.style.display = 'block';
+                    },
+                    suggestion: function(data) {
+                        appendSuggestion(data);
+                    },
+                    combos: function(data) {
+                        renderCombos(data);
+                        finishSuggestions(data.total_items_found);
+                    },
+                    error: function(message) {
+                        loadingState.style.display = 'none';
+                        showNotification(message, 'error');
+                        emptyState.style.display = 'block';
+                    }
+                }).catch(onError);
+                return;
+            }
+            
             fetch('/api/virtual-basket/parse', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ text: inputText })
+                body: JSON.stringify(payload)
             })
             .then(response => response.json())
             .then(data => {
@@ -43,23 +88,69 @@ document.addEventListener('DOMContentLoaded', function() {
                 displayResults(data);
                 resultsSection.style.display = 'block';
             })
-            .catch(error => {
-                console.error('Error:', error);
-                loadingState.style.display = 'none';
-                showNotification('Failed to process your request', 'error');
-                emptyState.style.display = 'block';
-            });
+            .catch(onError);
         });
     }
 });
 
+// Read server-sent events from a POST response and dispatch them by name
+function streamBasket(payload, handlers) {
+    return fetch('/api/virtual-basket/stream', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify(payload)
+    })
+    .then(response => {
+        if (!response.ok) {
+            return response.json().then(data => handlers.error(data.error || 'Failed to process your request'));
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        const dispatch = function(frame) {
+            let name = 'message';
+            let data = '';
+            frame.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) name = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            });
+            if (handlers[name] && data) handlers[name](JSON.parse(data));
+        };
+        
+        const pump = function() {
+            return reader.read().then(({ done, value }) => {
+                if (done) return;
+                buffer += decoder.decode(value, { stream: true });
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    dispatch(buffer.slice(0, boundary));
+                    buffer = buffer.slice(boundary + 2);
+                }
+                return pump();
+            });
+        };
+        return pump();
+    });
+}
+
 function displayResults(data) {
+    renderParsedItems(data.parsed_items);
+    renderCombos(data);
+    startSuggestions(false);
+    (data.suggestions || []).forEach(suggestion => appendSuggestion(suggestion));
+    finishSuggestions((data.suggestions || []).length);
+}
+
+function renderParsedItems(parsedItems) {
     // Display parsed items
     const parsedItemsContainer = document.getElementById('parsed-items');
     parsedItemsContainer.innerHTML = '';
     
-    if (data.parsed_items && data.parsed_items.length > 0) {
-        data.parsed_items.forEach(item => {
+    if (parsedItems && parsedItems.length > 0) {
+        parsedItems.forEach(item => {
             const itemDiv = document.createElement('div');
             itemDiv.className = 'parsed-item';
             itemDiv.innerHTML = `
@@ -71,7 +162,9 @@ function displayResults(data) {
     } else {
         parsedItemsContainer.innerHTML = '<p style="color: var(--color-text-secondary);">No items could be parsed from your input.</p>';
     }
-    
+}
+
+function renderCombos(data) {
     // Display suggested combos FIRST (most important)
     const combosContainer = document.getElementById('suggested-combos');
     combosContainer.innerHTML = '';
@@ -123,7 +216,8 @@ function displayResults(data) {
             <div class="card">
                 <div class="card__body">
                     <p style="text-align: center; color: var(--color-text-secondary);">
-                        ${data.suggestions && data.suggestions.length > 0 ? 
+                        ${data.combo_message ? data.combo_message :
+                          data.total_items_found > 0 ? 
                           'Could not find matching products for all items. Check individual suggestions below.' : 
                           'No combo suggestions available. Try different items or colors!'}
                     </p>
@@ -131,46 +225,19 @@ function displayResults(data) {
             </div>
         `;
     }
-    
-    // Display individual product suggestions (SECONDARY)
+}
+
+// Clear the suggestion areas; combos show a placeholder until they arrive
+function startSuggestions(waitingForCombos) {
     const suggestionsContainer = document.getElementById('product-suggestions');
     suggestionsContainer.innerHTML = '';
     
-    if (data.suggestions && data.suggestions.length > 0) {
-        data.suggestions.forEach(suggestion => {
-            const sectionDiv = document.createElement('div');
-            sectionDiv.style.marginBottom = 'var(--space-32)';
-            
-            const item = suggestion.item;
-            const itemTitle = `${item.quantity}x ${item.color ? item.color + ' ' : ''}${item.type}`;
-            
-            sectionDiv.innerHTML = `
-                <h3 style="margin-bottom: var(--space-16); color: var(--color-text);">
-                    Matching products for: <span style="color: var(--color-primary);">${itemTitle}</span>
-                </h3>
-            `;
-            
-            const productsGrid = document.createElement('div');
-            productsGrid.className = 'products-grid';
-            
-            if (suggestion.products && suggestion.products.length > 0) {
-                suggestion.products.forEach(product => {
-                    const productCard = createProductCard(product);
-                    productsGrid.appendChild(productCard);
-                });
-            } else {
-                productsGrid.innerHTML = '<p style="color: var(--color-text-secondary);">No matching products found for this item.</p>';
-            }
-            
-            sectionDiv.appendChild(productsGrid);
-            suggestionsContainer.appendChild(sectionDiv);
-        });
-    } else {
-        suggestionsContainer.innerHTML = `
+    if (waitingForCombos) {
+        document.getElementById('suggested-combos').innerHTML = `
             <div class="card">
                 <div class="card__body">
                     <p style="text-align: center; color: var(--color-text-secondary);">
-                        No individual product suggestions available.
+                        Building combinations...
                     </p>
                 </div>
             </div>
@@ -178,6 +245,49 @@ function displayResults(data) {
     }
 }
 
+function appendSuggestion(suggestion) {
+    const suggestionsContainer = document.getElementById('product-suggestions');
+    const sectionDiv = document.createElement('div');
+    sectionDiv.style.marginBottom = 'var(--space-32)';
+    
+    const item = suggestion.item;
+    const itemTitle = `${item.quantity}x ${item.color ? item.color + ' ' : ''}${item.type}`;
+    
+    sectionDiv.innerHTML = `
+        <h3 style="margin-bottom: var(--space-16); color: var(--color-text);">
+            Matching products for: <span style="color: var(--color-primary);">${itemTitle}</span>
+        </h3>
+    `;
+    
+    const productsGrid = document.createElement('div');
+    productsGrid.className = 'products-grid';
+    
+    if (suggestion.products && suggestion.products.length > 0) {
+        suggestion.products.forEach(product => {
+            const productCard = createProductCard(product);
+            productsGrid.appendChild(productCard);
+        });
+    } else {
+        productsGrid.innerHTML = '<p style="color: var(--color-text-secondary);">No matching products found for this item.</p>';
+    }
+    
+    sectionDiv.appendChild(productsGrid);
+    suggestionsContainer.appendChild(sectionDiv);
+}
+
+function finishSuggestions(found) {
+    if (found > 0) return;
+    document.getElementById('product-suggestions').innerHTML = `
+        <div class="card">
+            <div class="card__body">
+                <p style="text-align: center; color: var(--color-text-secondary);">
+                    No individual product suggestions available.
+                </p>
+            </div>
+        </div>
+    `;
+}
+
 function createProductCard(product) {
     const card = document.createElement('div');
     card.className = 'product-card';
@@ -219,39 +329,31 @@ function createProductCard(product) {
     return card;
 }
 
-// Function to add entire combo to cart
+// Function to add entire combo to cart (one request; all items or none)
 function addComboToCart(productIds) {
     if (!productIds || productIds.length === 0) return;
     
-    let addedCount = 0;
-    const totalItems = productIds.length;
-    
-    productIds.forEach((productId, index) => {
-        fetch('/api/cart/add', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({ 
-                product_id: parseInt(productId), 
-                quantity: 1
-            })
-        })
-        .then(response => response.json())
-        .then(data => {
-            addedCount++;
-            if (addedCount === totalItems) {
-                if (data.success || addedCount > 0) {
-                    showNotification(`Added ${addedCount} items to cart!`, 'success');
-                    updateCartBadge();
-                } else {
-                    showNotification('Failed to add some items', 'error');
-                }
-            }
+    fetch('/api/cart/add-bulk', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+            items: productIds.map(productId => ({ product_id: parseInt(productId), quantity: 1 }))
         })
-        .catch(error => {
-            console.error('Error:', error);
-        });
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            showNotification(`Added ${productIds.length} items to cart!`, 'success');
+            setCartBadge(data.cart_count);
+        } else {
+            showNotification(data.error || 'Failed to add combo', 'error');
+        }
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        showNotification('An error occurred', 'error');
     });
 }
 
@@ -324,16 +426,9 @@ function addToCart(productId, quantity = 1) {
     .then(data => {
         if (data.success) {
             showNotification('Product added to cart!', 'success');
-            updateCartBadge();
+            setCartBadge(data.cart_count);
         } else if (data.error) {
-            if (data.error === 'Please login first') {
-                showNotification('Please login to add items to cart', 'warning');
-                setTimeout(() => {
-                    window.location.href = '/auth';
-                }, 1500);
-            } else {
-                showNotification(data.error, 'error');
-            }
+            showNotification(data.error, 'error');
         }
     })
     .catch(error => {
@@ -341,20 +436,3 @@ function addToCart(productId, quantity = 1) {
         showNotification('Failed to add item to cart', 'error');
     });
 }
-
-function updateCartBadge() {
-    fetch('/api/cart/count')
-        .then(response => response.json())
-        .then(data => {
-            const badge = document.getElementById('cart-badge');
-            if (badge) {
-                badge.textContent = data.count || 0;
-                if (data.count > 0) {
-                    badge.style.display = 'inline-block';
-                } else {
-                    badge.style.display = 'none';
-                }
-            }
-        })
-        .catch(error => console.error('Error updating cart badge:', error));
-}
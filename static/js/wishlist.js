@@ -18,25 +18,19 @@ function applyHeartEmoji(btn) {
 // 1) Pre-fill hearts + Load wishlist count
 // ====================================================
 document.addEventListener("DOMContentLoaded", () => {
-    // Auto-fill hearts
-    fetch("/wishlist/ids")
-        .then(res => res.json())
-        .then(data => {
-            const ids = data.ids || [];
+    // Shared with the cart badge (getNavState in main.js)
+    getNavState()
+        .then(state => {
+            const ids = state.wishlist_ids || [];
             document.querySelectorAll(".wishlist-heart").forEach(btn => {
                 if (ids.includes(parseInt(btn.dataset.productId))) {
                     btn.classList.add("added");
                 }
                 applyHeartEmoji(btn);
             });
+            updateWishlistBadge(state.wishlist_count || 0);
         })
         .catch(err => console.error("Wishlist preload error:", err));
-
-    // Load count
-    fetch("/wishlist/count")
-        .then(res => res.json())
-        .then(data => updateWishlistBadge(data.count || 0))
-        .catch(err => console.error("Wishlist count error:", err));
 });
 
 // ====================================================
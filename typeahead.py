@@ -0,0 +1,242 @@
+import bisect
+import heapq
+import logging
+import threading
+import hashlib
+from collections import Counter
+
+from flask import current_app
+
+from db import pooled_connection
+from catalog import on_catalog_refresh
+from lexicon import normalize_text, TYPE_SYNONYMS, COLOR_MAP
+from search import stem
+
+logger = logging.getLogger('snapcart.typeahead')
+
+# A prefix matching more keys than this gets its top results precomputed,
+# so no lookup ever scans more than this many keys
+SCAN_LIMIT = 256
+MAX_LIMIT = 20               # most completions one request can ask for
+TOP_KEEP = MAX_LIMIT
+# Completion order when weights tie
+KIND_ORDER = {'search': 0, 'category': 1, 'type': 2, 'color': 3, 'product': 4}
+SEARCH_WEIGHT = 1            # each distinct searcher counts as much as one matching product
+SEARCH_MIN_SEARCHERS = 3     # a query is only shown to everyone once this many people ran it
+SEARCH_MAX_SEARCHERS = 100   # distinct searchers counted per query; the weight stops there
+MAX_TRACKED_SEARCHES = 5000
+
+
+def word_suffixes(key):
+    # "classic white shirt" -> "classic white shirt", "white shirt", "shirt"
+    words = key.split()
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+def count_prefix(keys, prefix):
+    return bisect.bisect_right(keys, prefix + '\U0010ffff') - bisect.bisect_left(keys, prefix)
+
+
+class TypeaheadIndex:
+    """Prefix completion over a sorted key array.
+
+    Every entry is filed under each of its word-suffixes ("classic white
+    shirt", "white shirt", "shirt") so typing any word finds it. A lookup
+    is two bisects plus either a scan of at most SCAN_LIMIT keys or a
+    precomputed top list.
+    """
+
+    def __init__(self):
+        self._state = ([], [], [], {})
+
+    @property
+    def size(self):
+        return len(self._state[2])
+
+    def rebuild(self, entries):
+        """entries: [(text, kind, weight, normalized text)]. Builds off to the side, then swaps in."""
+        entries = sorted(entries, key=lambda e: (-e[2], KIND_ORDER.get(e[1], 9), e[0]))
+        rows = []
+        for entry_id, entry in enumerate(entries):
+            rows.extend((key, entry_id) for key in word_suffixes(entry[3]))
+        rows.sort()
+        keys = [k for k, _ in rows]
+        ids = [e for _, e in rows]
+        # entry ids are in rank order, so the best entries are the smallest ids
+        top = {}
+        pending = [(0, len(keys), 0)]
+        while pending:
+            lo, hi, depth = pending.pop()
+            i = lo
+            while i < hi:
+                if len(keys[i]) <= depth:
+                    i += 1
+                    continue
+                prefix = keys[i][:depth + 1]
+                j = bisect.bisect_right(keys, prefix + '\U0010ffff', i, hi)
+                if j - i > SCAN_LIMIT:
+                    top[prefix] = heapq.nsmallest(TOP_KEEP, set(ids[i:j]))
+                    pending.append((i, j, depth + 1))
+                i = j
+        self._state = (keys, ids, entries, top)
+
+    def complete(self, text, limit=8):
+        keys, ids, entries, top = self._state
+        prefix = normalize_text(text)
+        if not prefix:
+            return []
+        # keep a trailing space meaningful: "red " should not complete to "reddish"
+        if text.endswith(' '):
+            prefix += ' '
+        lo = bisect.bisect_left(keys, prefix)
+        hi = bisect.bisect_right(keys, prefix + '\U0010ffff', lo)
+        if hi - lo > SCAN_LIMIT:
+            best = top.get(prefix) or heapq.nsmallest(limit, set(ids[lo:hi]))
+        else:
+            best = heapq.nsmallest(limit, set(ids[lo:hi]))
+        return [{'text': entries[e][0], 'kind': entries[e][1]} for e in best[:limit]]
+
+
+_index = TypeaheadIndex()
+_names = {}          # product_id -> (name, category) the index was built with
+_searches = {}       # normalized query -> hashes of the distinct searchers who ran it
+_searches_lock = threading.Lock()
+
+
+def record_search(query, searcher):
+    """Count a search that returned results, once per searcher (user id or client address).
+
+    Queries become completions only after SEARCH_MIN_SEARCHERS different
+    people ran them, and only if every word is in the catalog vocabulary
+    (checked when the index is built), so one user cannot put arbitrary
+    text in front of everyone.
+    """
+    query = normalize_text(query)
+    if not query or len(query) > 60:
+        return
+    who = hashlib.blake2b(str(searcher).encode(), digest_size=8).digest()
+    with _searches_lock:
+        searchers = _searches.setdefault(query, set())
+        if len(searchers) < SEARCH_MAX_SEARCHERS:
+            searchers.add(who)
+        if len(_searches) > MAX_TRACKED_SEARCHES:
+            keep = sorted(_searches.items(), key=lambda kv: len(kv[1]), reverse=True)
+            _searches.clear()
+            _searches.update(keep[:MAX_TRACKED_SEARCHES // 2])
+
+
+def _units_sold(app):
+    # Best-effort popularity signal; the index still builds without it.
+    # Scans all of order_items, so only ever called from the rebuild thread.
+    try:
+        with pooled_connection(app) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT product_id, SUM(quantity) FROM order_items GROUP BY product_id")
+                return {product_id: int(sold or 0) for product_id, sold in cursor.fetchall()}
+            finally:
+                cursor.close()
+    except Exception:
+        logger.warning("typeahead: could not load sales counts", exc_info=True)
+        return {}
+
+
+def build_entries(snapshot, sold):
+    with _searches_lock:
+        searches = {query: len(searchers) for query, searchers in _searches.items()
+                    if len(searchers) >= SEARCH_MIN_SEARCHERS}
+
+    # normalized text -> [text, kind, weight, normalized text]; the same
+    # text from several sources keeps the best weight
+    merged = {}
+
+    def add(text, kind, weight):
+        key = normalize_text(text)
+        if not key:
+            return
+        current = merged.get(key)
+        if current is None:
+            merged[key] = [text, kind, weight, key]
+        elif weight > current[2]:
+            current[2] = weight
+
+    per_category = Counter(p['category_id'] for p in snapshot.products.values())
+    for p in snapshot.products.values():
+        add(p['name'], 'product', 1 + sold.get(p['id'], 0))
+    for c in snapshot.categories:
+        add(c['name'], 'category', per_category.get(c['id'], 0))
+
+    # Lexicon words are weighted by how many product names have a word
+    # starting with them; words no product uses would only lead nowhere
+    name_keys = sorted(key for entry in merged.values() if entry[1] == 'product'
+                       for key in word_suffixes(entry[3]))
+    lexicon_words = [(w, 'type') for canon, words in TYPE_SYNONYMS.items() for w in [canon] + words]
+    lexicon_words += [(w, 'color') for words in COLOR_MAP.values() for w in words]
+    for word, kind in lexicon_words:
+        count = count_prefix(name_keys, normalize_text(word))
+        if count:
+            add(word, kind, count)
+
+    # Past searches boost the matching completion, or become one themselves
+    # if every word is one the catalog or the lexicon already knows
+    vocabulary = {stem(word) for key in merged for word in key.split()}
+    for query, n in searches.items():
+        if query in merged:
+            merged[query][2] += n * SEARCH_WEIGHT
+        elif all(stem(word) in vocabulary for word in query.split()):
+            add(query, 'search', n * SEARCH_WEIGHT)
+    return [tuple(e) for e in merged.values()]
+
+
+def _name_key(product):
+    return None if product is None else (product['name'], product['category_id'])
+
+
+_rebuild_state = {'next': None, 'running': False}
+_rebuild_lock = threading.Lock()
+
+
+def _rebuild_worker():
+    # Always builds the newest snapshot queued; older ones are skipped
+    while True:
+        with _rebuild_lock:
+            job = _rebuild_state['next']
+            _rebuild_state['next'] = None
+            if job is None:
+                _rebuild_state['running'] = False
+                return
+        snapshot, app = job
+        try:
+            _index.rebuild(build_entries(snapshot, _units_sold(app)))
+        except Exception:
+            logger.exception("typeahead: rebuild failed, keeping the current index")
+
+
+def _schedule_rebuild(snapshot, app):
+    with _rebuild_lock:
+        _rebuild_state['next'] = (snapshot, app)
+        if _rebuild_state['running']:
+            return
+        _rebuild_state['running'] = True
+    threading.Thread(target=_rebuild_worker, name='typeahead-rebuild', daemon=True).start()
+
+
+@on_catalog_refresh
+def _sync_index(snapshot, changed_ids):
+    # Stock and price updates don't change any completion, so skip those
+    if changed_ids is not None:
+        changed = {pid: _name_key(snapshot.get(pid)) for pid in changed_ids}
+        if all(_names.get(pid) == key for pid, key in changed.items()):
+            return
+    _names.clear()
+    _names.update((pid, _name_key(p)) for pid, p in snapshot.products.items())
+    if not _index.size:
+        # nothing to serve yet, so a first build without sales counts happens inline
+        _index.rebuild(build_entries(snapshot, {}))
+    # the full build, sales counts included, runs off the request thread while
+    # the current index keeps answering
+    _schedule_rebuild(snapshot, current_app._get_current_object())
+
+
+def complete(text, limit=8):
+    return _index.complete(text, limit)
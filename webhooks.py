@@ -0,0 +1,298 @@
+import json
+import heapq
+import atexit
+import random
+import time
+import logging
+import threading
+import itertools
+from datetime import datetime, timedelta
+
+import metrics
+from db import pooled_connection
+from background import periodic_background
+
+logger = logging.getLogger('snapcart.webhooks')
+
+
+class PermanentDeliveryError(Exception):
+    """The receiver rejected the event; retrying would not help."""
+
+
+class WebhookDispatcher:
+    """Background webhook delivery with retries.
+
+    submit() only queues the event, so the caller never waits for the
+    receiver. Worker threads deliver due events; a failure is retried
+    with exponential backoff (with jitter) up to max_attempts, after
+    which the event goes to on_dead_letter(event, error).
+
+    Each event carries an idempotency key, so the receiver can ignore
+    repeats of an event that was delivered but not acknowledged. The
+    queue itself is only in memory: callers that must not lose events
+    write them to a durable outbox first and clear it in on_delivered.
+    """
+
+    def __init__(self, deliver, workers=2, max_attempts=6, base_delay=0.5, max_delay=60.0,
+                 on_dead_letter=None, on_delivered=None):
+        self.deliver = deliver
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.on_dead_letter = on_dead_letter
+        self.on_delivered = on_delivered
+        self._heap = []                 # (due, seq, event)
+        self._keys = set()              # keys queued or in flight
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._busy = 0
+        self.stats = {'delivered': 0, 'retried': 0, 'dead_lettered': 0}
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f'webhook-worker-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, payload, key):
+        """Queue an event. Returns False if the same key is already queued."""
+        self.start()
+        with self._cond:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+        event = {'key': key, 'payload': payload, 'attempts': 0}
+        self._schedule(event, 0)
+        return True
+
+    def _schedule(self, event, delay):
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), event))
+            self._cond.notify()
+
+    def backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap) + self._busy
+
+    def wait_idle(self, timeout=None):
+        """Block until nothing is queued or being delivered (for tests and shutdown)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._heap or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else 0.1)
+        return True
+
+    def _next_event(self):
+        with self._cond:
+            while True:
+                if self._heap:
+                    due = self._heap[0][0]
+                    now = time.monotonic()
+                    if due <= now:
+                        self._busy += 1
+                        return heapq.heappop(self._heap)[2]
+                    self._cond.wait(due - now)
+                else:
+                    self._cond.wait()
+
+    def _run(self):
+        while True:
+            event = self._next_event()
+            try:
+                self._attempt(event)
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self._cond.notify_all()
+
+    def _attempt(self, event):
+        event['attempts'] += 1
+        try:
+            self.deliver(event['payload'], event['key'])
+        except PermanentDeliveryError as e:
+            self._dead_letter(event, e)
+        except Exception as e:
+            if event['attempts'] >= self.max_attempts:
+                self._dead_letter(event, e)
+                return
+            self.stats['retried'] += 1
+            delay = self.backoff(event['attempts'])
+            logger.warning("webhook %s: attempt %d failed (%s), retrying in %.1fs",
+                           event['key'], event['attempts'], e, delay)
+            self._schedule(event, delay)
+        else:
+            self.stats['delivered'] += 1
+            self._forget(event)
+            if self.on_delivered:
+                try:
+                    self.on_delivered(event)
+                except Exception:
+                    # the outbox row stays and the event is sent again; the receiver dedupes it
+                    logger.exception("webhook %s: could not clear outbox entry", event['key'])
+
+    def _forget(self, event):
+        with self._cond:
+            self._keys.discard(event['key'])
+
+    def _dead_letter(self, event, error):
+        self.stats['dead_lettered'] += 1
+        self._forget(event)
+        logger.error("webhook %s: giving up after %d attempts: %s", event['key'], event['attempts'], error)
+        if self.on_dead_letter:
+            try:
+                self.on_dead_letter(event, error)
+            except Exception:
+                logger.exception("webhook %s: could not record dead letter", event['key'])
+
+
+# --------------------------
+# Mock gateway wiring
+# --------------------------
+def idempotency_key(payload):
+    # One key per (transaction, outcome): a resend of the same event is a duplicate
+    return f"{payload['provider_txn_id']}:{payload['status']}"
+
+
+def in_process_delivery(app, path):
+    """Deliver by calling the app's own webhook route, no network involved."""
+    def deliver(payload, key):
+        with app.test_client() as client:
+            response = client.post(path, json=payload, headers={'Idempotency-Key': key})
+        if response.status_code >= 500:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        if response.status_code >= 400:
+            raise PermanentDeliveryError(f"HTTP {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return deliver
+
+
+# --------------------------
+# Outbox
+# --------------------------
+# Every event is written to webhook_outbox in the same transaction as the
+# payment change that caused it, and removed once delivered or
+# dead-lettered. Whatever a restart drops from the in-memory queue is
+# still in the table and gets queued again by the outbox sweep.
+def record_outbox(cursor, payload, key):
+    cursor.execute("""
+        INSERT IGNORE INTO webhook_outbox (idempotency_key, payment_id, payload_json)
+        VALUES (%s, %s, %s)
+    """, (key, payload.get('payment_id'), json.dumps(payload)))
+
+
+def clear_outbox(cursor, key):
+    cursor.execute("DELETE FROM webhook_outbox WHERE idempotency_key = %s", (key,))
+
+
+def stale_outbox(cursor, older_than, limit=500):
+    """[(key, payload)] still undelivered after older_than seconds, oldest first."""
+    cursor.execute("""
+        SELECT idempotency_key, payload_json FROM webhook_outbox
+        WHERE created_at < %s
+        ORDER BY created_at
+        LIMIT %s
+    """, (datetime.now() - timedelta(seconds=older_than), limit))
+    return [(row[0], json.loads(row[1])) for row in cursor.fetchall()]
+
+
+def outbox_delivered(app):
+    def clear(event):
+        with pooled_connection(app) as conn:
+            cursor = conn.cursor()
+            try:
+                clear_outbox(cursor, event['key'])
+                conn.commit()
+            finally:
+                cursor.close()
+    return clear
+
+
+def dead_letter_to_db(app):
+    def record(event, error):
+        with pooled_connection(app) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    INSERT INTO webhook_dead_letters (idempotency_key, payload_json, attempts, last_error)
+                    VALUES (%s, %s, %s, %s)
+                """, (event['key'], json.dumps(event['payload']), event['attempts'], str(error)[:500]))
+                clear_outbox(cursor, event['key'])
+                conn.commit()
+            finally:
+                cursor.close()
+    return record
+
+
+def resubmit_stale(app, dispatcher):
+    """Queue outbox events that were never delivered (lost in a restart). Returns how many."""
+    with pooled_connection(app) as conn:
+        cursor = conn.cursor()
+        try:
+            stale = stale_outbox(cursor, app.config.get('WEBHOOK_OUTBOX_STALE', 300))
+        finally:
+            cursor.close()
+    return sum(1 for key, payload in stale if dispatcher.submit(payload, key))
+
+
+def create_dispatcher(app, path):
+    cfg = app.config
+    return WebhookDispatcher(in_process_delivery(app, path),
+                             workers=cfg.get('WEBHOOK_WORKERS', 2),
+                             max_attempts=cfg.get('WEBHOOK_MAX_ATTEMPTS', 6),
+                             base_delay=cfg.get('WEBHOOK_RETRY_BASE', 0.5),
+                             max_delay=cfg.get('WEBHOOK_RETRY_MAX', 60.0),
+                             on_dead_letter=dead_letter_to_db(app),
+                             on_delivered=outbox_delivered(app))
+
+
+_dispatchers = []
+
+
+def register_dispatcher(dispatcher):
+    _dispatchers.append(dispatcher)
+    return dispatcher
+
+
+# --------------------------
+# Background outbox sweep
+# --------------------------
+def _sweep_outbox(app, dispatcher):
+    queued = resubmit_stale(app, dispatcher)
+    if queued:
+        logger.warning("webhooks: requeued %d undelivered outbox events", queued)
+
+
+def init_app(app, dispatcher):
+    periodic_background(app, 'webhook-outbox-sweep', app.config.get('WEBHOOK_OUTBOX_SWEEP_INTERVAL', 60),
+                        lambda app: _sweep_outbox(app, dispatcher))
+
+    # Clean shutdown: give queued events a chance to go out; the rest stay in the outbox
+    atexit.register(dispatcher.wait_idle, app.config.get('WEBHOOK_DRAIN_TIMEOUT', 10))
+
+
+@metrics.register_collector
+def _webhook_metrics():
+    lines = ['# HELP snapcart_webhook_deliveries_total Webhook delivery outcomes.',
+             '# TYPE snapcart_webhook_deliveries_total counter']
+    totals = {'delivered': 0, 'retried': 0, 'dead_lettered': 0}
+    pending = 0
+    for dispatcher in _dispatchers:
+        for outcome, n in dispatcher.stats.items():
+            totals[outcome] += n
+        pending += dispatcher.pending()
+    for outcome, n in sorted(totals.items()):
+        lines.append(f'snapcart_webhook_deliveries_total{{outcome="{outcome}"}} {n}')
+    lines.append('# TYPE snapcart_webhook_queue_depth gauge')
+    lines.append(f'snapcart_webhook_queue_depth {pending}')
+    return lines
@@ -1,17 +1,10 @@
-from flask import Blueprint, request, jsonify, session, redirect, url_for, flash, render_template, current_app
-import mysql.connector
+from flask import Blueprint, request, jsonify, session, redirect, url_for, flash, render_template
 from datetime import datetime
 
-wishlist_bp = Blueprint('wishlist', __name__)
+from db import get_db_connection
+from http_cache import conditional, bump_user_state
 
-def get_db_connection():
-    app = current_app._get_current_object()
-    return mysql.connector.connect(
-        host=app.config.get('MYSQL_HOST'),
-        user=app.config.get('MYSQL_USER'),
-        password=app.config.get('MYSQL_PASSWORD'),
-        database=app.config.get('MYSQL_DB')
-    )
+wishlist_bp = Blueprint('wishlist', __name__)
 
 # --------------------------
 # Helper: Get wishlist count
@@ -49,6 +42,7 @@ def add_to_wishlist():
             (user_id, product_id)
         )
         conn.commit()
+        bump_user_state()
     except Exception as e:
         conn.rollback()
         return jsonify({'error': str(e)}), 500
@@ -84,6 +78,7 @@ def remove_from_wishlist():
             (user_id, product_id)
         )
         conn.commit()
+        bump_user_state()
     except Exception as e:
         conn.rollback()
         return jsonify({'error': str(e)}), 500
@@ -131,6 +126,7 @@ def list_wishlist():
 # COUNT API
 # --------------------------
 @wishlist_bp.route('/wishlist/count')
+@conditional(catalog=False)
 def wishlist_count():
     if 'user_id' not in session:
         return jsonify({'count': 0})
@@ -144,6 +140,7 @@ def wishlist_count():
 # IDS API
 # --------------------------
 @wishlist_bp.route('/wishlist/ids')
+@conditional(catalog=False)
 def wishlist_ids():
     if 'user_id' not in session:
         return jsonify({'ids': []})